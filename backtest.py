@@ -0,0 +1,48 @@
+"""Бэктест фаз Flow/RSX по локальной истории баров.
+
+    python backtest.py fetch [years] [--interval 1d]    # загрузить историю FUTURES в базу бэктеста
+    python backtest.py [cmd ...] [--interval 1d]        # прогон офлайн по сохранённым барам
+"""
+import os
+import sys
+import json
+import argparse
+
+os.environ.setdefault("BOT_TOKEN", "0:offline")   # main.py требует токен при импорте
+import main
+
+
+def main_cli(argv):
+    parser = argparse.ArgumentParser(description="Бэктест фаз Flow/RSX")
+    parser.add_argument('args', nargs='*', help="fetch [years] или команды активов (по умолчанию — все)")
+    parser.add_argument('--interval', default=main.DEFAULT_INTERVAL, choices=list(main.INTERVALS))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--json', help="сохранить результаты по символам в файл")
+    opts = parser.parse_args(argv)
+
+    if opts.args[:1] == ['fetch']:
+        years = float(opts.args[1]) if len(opts.args) > 1 else 10
+        got   = main.fetch_history(main.FUTURES.values(), int(years * 365), opts.interval)
+        for sym, n in got.items():
+            print(f"{sym:>10}: {n} баров")
+        print(f"→ {main.HISTORY_DB_PATH}")
+        return
+
+    cmds = [a.lower() for a in opts.args] or list(main.FUTURES)
+    unknown = [c for c in cmds if c not in main.FUTURES]
+    if unknown:
+        parser.error(f"неизвестные активы: {', '.join(unknown)}")
+    results = main.run_backtest([main.FUTURES[c] for c in cmds], opts.interval, workers=opts.workers)
+    for cmd in cmds:
+        r = results[main.FUTURES[cmd]]
+        print(f"{cmd.upper():>6}: " + (f"{r['bars']} баров, {r['first'][:10]} — {r['last'][:10]}"
+                                        if r else "нет истории — сначала backtest.py fetch"))
+    print()
+    print(main.summarize_backtest(results).to_string())
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f)
+
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
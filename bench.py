@@ -0,0 +1,1551 @@
+"""Бенчмарки и проверки эквивалентности для горячих функций main.py.
+
+    python bench.py            # все секции
+    python bench.py rsx        # только RSX
+    python bench.py suite      # стадии на фикстурах: время, пик памяти, baseline и golden
+    python bench.py suite --save --sizes small,medium
+"""
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import warnings
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")   # main.py требует токен при импорте
+import main
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt     # только для эталонных реализаций; main.py обходится без pyplot
+
+
+def timeit(fn, *args, repeat=3, **kwargs):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def random_walk(n, seed=0, flat_every=0):
+    rng = np.random.default_rng(seed)
+    x   = 50 + np.cumsum(rng.normal(0, 1, n))
+    if flat_every:
+        # плоские участки — проверка сбросов счётчика прогрева
+        x[::flat_every] = np.roll(x, 1)[::flat_every]
+    return pd.Series(x)
+
+
+def synthetic_ohlcv(n, seed=0):
+    rng   = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+    spread = close * rng.uniform(0.002, 0.02, n)
+    low   = close - spread * rng.uniform(0, 1, n)
+    high  = low + spread
+    vol   = rng.lognormal(10, 0.5, n).round()
+    idx   = pd.date_range('2000-01-03', periods=n, freq='B')
+    return pd.DataFrame({'Open': close, 'High': high, 'Low': low, 'Close': close, 'Volume': vol}, index=idx)
+
+
+# ────────────────────────────────────────────────
+# RSX
+# ────────────────────────────────────────────────
+def rsx_reference(series: pd.Series, length: int = 9) -> pd.Series:
+    """Исходная построчная реализация calculate_rsx — эталон для сравнения."""
+    src = series.values.astype(float)
+    n   = len(src)
+    rsx = np.zeros(n)
+    f8  = np.zeros(n); f10 = np.zeros(n); v8 = np.zeros(n)
+    f18 = 3.0 / (length + 2.0); f20 = 1.0 - f18
+    f28 = np.zeros(n); f30 = np.zeros(n)
+    f38 = np.zeros(n); f40 = np.zeros(n)
+    f48 = np.zeros(n); f50 = np.zeros(n)
+    f58 = np.zeros(n); f60 = np.zeros(n)
+    f68 = np.zeros(n); f70 = np.zeros(n)
+    f78 = np.zeros(n); f80 = np.zeros(n)
+    f88 = np.zeros(n); f90 = np.zeros(n)
+
+    for i in range(n):
+        f8[i]  = 100.0 * src[i]
+        f10[i] = f8[i - 1] if i > 0 else 0.0
+        v8[i]  = f8[i] - f10[i]
+        f28[i] = f20 * (f28[i-1] if i > 0 else 0.0) + f18 * v8[i]
+        f30[i] = f18 * f28[i] + f20 * (f30[i-1] if i > 0 else 0.0)
+        vC     = f28[i] * 1.5 - f30[i] * 0.5
+        f38[i] = f20 * (f38[i-1] if i > 0 else 0.0) + f18 * vC
+        f40[i] = f18 * f38[i] + f20 * (f40[i-1] if i > 0 else 0.0)
+        v10    = f38[i] * 1.5 - f40[i] * 0.5
+        f48[i] = f20 * (f48[i-1] if i > 0 else 0.0) + f18 * v10
+        f50[i] = f18 * f48[i] + f20 * (f50[i-1] if i > 0 else 0.0)
+        v14    = f48[i] * 1.5 - f50[i] * 0.5
+        f58[i] = f20 * (f58[i-1] if i > 0 else 0.0) + f18 * abs(v8[i])
+        f60[i] = f18 * f58[i] + f20 * (f60[i-1] if i > 0 else 0.0)
+        v18    = f58[i] * 1.5 - f60[i] * 0.5
+        f68[i] = f20 * (f68[i-1] if i > 0 else 0.0) + f18 * v18
+        f70[i] = f18 * f68[i] + f20 * (f70[i-1] if i > 0 else 0.0)
+        v1C    = f68[i] * 1.5 - f70[i] * 0.5
+        f78[i] = f20 * (f78[i-1] if i > 0 else 0.0) + f18 * v1C
+        f80[i] = f18 * f78[i] + f20 * (f80[i-1] if i > 0 else 0.0)
+        v20    = f78[i] * 1.5 - f80[i] * 0.5
+        f88[i] = length - 1 if (i > 0 and f90[i-1] == 0 and length - 1 >= 5) else 5
+        f90[i] = (
+            1 if i == 0 or f90[i-1] == 0
+            else f88[i] + 1 if f88[i] <= f90[i-1]
+            else f90[i-1] + 1
+        )
+        f0     = 1 if (f88[i] >= f90[i] and f8[i] != f10[i]) else 0
+        if f88[i] == f90[i] and f0 == 0:
+            f90[i] = 0
+        v4     = (v14 / v20 + 1.0) * 50.0 if (f88[i] < f90[i] and abs(v20) > 1e-8) else 50.0
+        rsx[i] = max(0.0, min(100.0, v4))
+
+    return pd.Series(rsx, index=series.index)
+
+
+def check_rsx():
+    cases = [random_walk(n, seed=n) for n in (1, 2, 5, 6, 7, 175, 5000)]
+    cases += [random_walk(300, seed=1, flat_every=3), pd.Series(np.full(50, 42.0))]
+    for s in cases:
+        for length in (2, 9, 14):
+            ref  = rsx_reference(s, length).values
+            fast = main.calculate_rsx(s, length).values
+            loop = _rsx_without_scipy(s, length)
+            assert np.array_equal(ref, fast), f"RSX lfilter mismatch n={len(s)} length={length}"
+            assert np.array_equal(ref, loop), f"RSX loop mismatch n={len(s)} length={length}"
+    print("rsx: bit-identical to reference")
+
+
+def _rsx_without_scipy(s, length):
+    orig = main._rsx_filters_lfilter
+    main._rsx_filters_lfilter = main._rsx_filters_loop
+    try:
+        return main.calculate_rsx(s, length).values
+    finally:
+        main._rsx_filters_lfilter = orig
+
+
+def bench_rsx():
+    check_rsx()
+    for n in (10_000, 100_000, 1_000_000):
+        s    = random_walk(n)
+        fast = timeit(main.calculate_rsx, s, 9)
+        loop = timeit(_rsx_without_scipy, s, 9, repeat=1)
+        ref  = timeit(rsx_reference, s, 9, repeat=1) if n <= 100_000 else float('nan')
+        print(f"rsx n={n:>9,}: reference {ref*1e3:9.1f} ms | "
+              f"O(1)-loop {loop*1e3:9.1f} ms | lfilter {fast*1e3:8.2f} ms")
+
+
+# ────────────────────────────────────────────────
+# Инкрементальный FlowState
+# ────────────────────────────────────────────────
+def check_flow_state():
+    for n in (20, 60, 175, 600):
+        df    = synthetic_ohlcv(n, seed=n)
+        batch = main.compute_flow(df.copy())
+        st    = main.FlowState(history_days=100_000)
+        flows = [st.update(ts, bar) for ts, bar in df.iterrows()]
+        assert np.allclose(flows, batch['Flow'].values, rtol=1e-9, atol=1e-9), f"FlowState mismatch n={n}"
+        rsx = main.calculate_rsx(batch['Flow']).values
+        assert np.allclose(st.frame()['RSX'].values, rsx, rtol=1e-9, atol=1e-9), f"RSXState mismatch n={n}"
+
+        half = main.FlowState(history_days=100_000)
+        half.extend(df.iloc[:n // 2])
+        half = main.FlowState.from_dict(json.loads(json.dumps(half.to_dict())))
+        half.extend(df)
+        assert np.allclose(half.frame()['Flow'].values, flows, rtol=1e-12, atol=1e-12), "restore mismatch"
+    print("flow_state: matches compute_flow, survives to_dict/from_dict")
+
+
+def bench_flow_state():
+    check_flow_state()
+    df    = synthetic_ohlcv(5000)
+    st    = main.FlowState()
+    st.extend(df.iloc[:-1000])
+    bars  = list(df.iloc[-1000:].iterrows())
+    t0    = time.perf_counter()
+    for ts, bar in bars:
+        st.update(ts, bar)
+    per_bar = (time.perf_counter() - t0) / len(bars)
+    batch   = timeit(main.compute_flow, synthetic_ohlcv(120))
+    print(f"flow_state: update {per_bar*1e6:.1f} us/bar | full compute_flow(120 bars) {batch*1e3:.2f} ms")
+
+
+# ────────────────────────────────────────────────
+# Скользящий ранг объёма
+# ────────────────────────────────────────────────
+def rank_reference(values, window):
+    return pd.Series(values).rolling(window).apply(
+        lambda x: (x[:-1] < x[-1]).sum() / (len(x) - 1) * 100, raw=True
+    ).values
+
+
+def check_rolling_rank():
+    vol = synthetic_ohlcv(3000)['Volume'].values
+    vol_nan = vol.copy(); vol_nan[[5, 700, 701, 2999]] = np.nan
+    ties = np.random.default_rng(1).integers(0, 5, 3000).astype(float)
+    for x in (vol, vol_nan, ties, vol[:10]):
+        for window in (2, 5, 20, 300, 1000):
+            ref = rank_reference(x, window)
+            for path in ('vectorized', 'sorted'):
+                got = _rank_with_path(x, window, path)
+                assert np.array_equal(ref, got, equal_nan=True), f"rank mismatch w={window} {path}"
+    print("rolling_rank: identical to rolling().apply(lambda) on both paths")
+
+
+def _rank_with_path(x, window, path):
+    orig = main.RANK_VECTOR_MAX_WINDOW
+    main.RANK_VECTOR_MAX_WINDOW = 10**9 if path == 'vectorized' else 1
+    try:
+        return main.rolling_rank_pct(x, window)
+    finally:
+        main.RANK_VECTOR_MAX_WINDOW = orig
+
+
+def bench_rolling_rank():
+    check_rolling_rank()
+    for n in (175, 10_000, 100_000):
+        x = synthetic_ohlcv(n)['Volume'].values
+        for window in (20, 100, 250, 1000):
+            if window >= n:
+                continue
+            ref  = timeit(rank_reference, x, window, repeat=1) if n <= 10_000 else float('nan')
+            vec  = timeit(_rank_with_path, x, window, 'vectorized')
+            srt  = timeit(_rank_with_path, x, window, 'sorted')
+            print(f"rank n={n:>7,} w={window:>4}: lambda {ref*1e3:8.2f} ms | "
+                  f"vectorized {vec*1e3:7.2f} ms | sorted {srt*1e3:7.2f} ms")
+
+
+# ────────────────────────────────────────────────
+# Отрисовка make_chart
+# ────────────────────────────────────────────────
+def make_chart_reference(df, symbol, rsx=None, perigees=None):
+    """make_chart до шаблонного рендера: фигура с нуля и bbox_inches='tight'."""
+    import matplotlib.gridspec as gridspec
+
+    if rsx is None:
+        rsx  = main.calculate_rsx(df['Flow'], length=9)
+    if perigees is None:
+        perigees = main.get_lunar_perigees(175)
+    now_ts   = pd.Timestamp(datetime.now()).tz_localize(None)
+
+    if hasattr(df.index, 'tz') and df.index.tz is not None:
+        df = df.copy()
+        df.index = df.index.tz_localize(None)
+        rsx.index = rsx.index.tz_localize(None)
+
+    fig = plt.figure(figsize=(12, 11))
+    gs  = gridspec.GridSpec(3, 1, height_ratios=[2.5, 1, 0.85], hspace=0.08)
+    ax1 = fig.add_subplot(gs[0])
+    ax2 = fig.add_subplot(gs[1], sharex=ax1)
+    ax3 = fig.add_subplot(gs[2])
+    ax3.axis('off')
+
+    ax1.plot(df.index, df['Flow'], label="Participation Index", linewidth=2, color='navy')
+    ax1.axhline(85, color='red',   linestyle='--', linewidth=1, label='Overbought (85)')
+    ax1.axhline(15, color='green', linestyle='--', linewidth=1, label='Oversold (15)')
+    ax1.axhline(50, color='gray',  linestyle='-',  alpha=0.4)
+    ax1.fill_between(df.index, 85, df['Flow'].clip(lower=85), alpha=0.15, color='red')
+    ax1.fill_between(df.index, df['Flow'].clip(upper=15), 15, alpha=0.15, color='blue')
+    ax1.set_title(f"{symbol} — Volume Stress / Participation Index", fontsize=14, fontweight='bold')
+    ax1.set_ylim(0, 100)
+    ax1.legend(loc='upper left', fontsize=9)
+    ax1.grid(alpha=0.3)
+
+    try:
+        last_flow = float(df['Flow'].iloc[-1])
+        last_date = df.index[-1]
+        ax1.annotate(
+            f"{last_date.strftime('%d.%m.%Y')}\n{last_flow:.1f}%",
+            xy=(last_date, last_flow),
+            xytext=(-60, 15), textcoords='offset points',
+            bbox=dict(boxstyle='round,pad=0.3', facecolor='yellow', alpha=0.8),
+            fontsize=9, fontweight='bold',
+        )
+    except Exception:
+        pass
+
+    ax2.plot(df.index, rsx, label="RSX(9)", linewidth=1.5, color='orange')
+    ax2.axhline(70, color='red',   linestyle='--', linewidth=1)
+    ax2.axhline(30, color='green', linestyle='--', linewidth=1)
+    ax2.axhline(50, color='gray',  linestyle='-',  alpha=0.4)
+    ax2.set_ylim(0, 100)
+    ax2.set_ylabel('RSX(9)', fontsize=9)
+    ax2.legend(loc='upper left', fontsize=9)
+    ax2.grid(alpha=0.3)
+
+    try:
+        last_rsx_date = rsx.index[-1]
+        last_rsx_val  = float(rsx.iloc[-1])
+        ax2.annotate(
+            f"{last_rsx_date.strftime('%d.%m.%Y')}\nRSX: {last_rsx_val:.1f}",
+            xy=(last_rsx_date, last_rsx_val),
+            xytext=(-60, 15), textcoords='offset points',
+            bbox=dict(boxstyle='round,pad=0.3', facecolor='lightblue', alpha=0.8),
+            fontsize=9, fontweight='bold',
+        )
+    except Exception:
+        pass
+
+    for p in perigees:
+        p_n = p.tz_localize(None) if p.tzinfo is not None else p
+        if p_n <= now_ts:
+            ax1.axvline(p_n, color='red', linestyle='--', linewidth=0.9, alpha=0.6, zorder=5)
+            ax2.axvline(p_n, color='red', linestyle='--', linewidth=0.9, alpha=0.6, zorder=5)
+        else:
+            ax1.axvline(p_n, color='red', linestyle='--', linewidth=1.4, alpha=0.95, zorder=5)
+            ax2.axvline(p_n, color='red', linestyle='--', linewidth=1.4, alpha=0.95, zorder=5)
+            ax1.text(p_n, 93, f"↓ {p.strftime('%d.%m')}", color='red',
+                     fontsize=7.5, ha='center', fontweight='bold', zorder=6,
+                     bbox=dict(boxstyle='round,pad=0.2', fc='white', ec='crimson', alpha=0.9))
+            break
+
+    phases = [
+        ("Accumulation",  "Накопление",      "30–50",   "40–60",  "Участие начинает появляться",           "Формирование базы, подготовка режима",  "#4169E1"),
+        ("Expansion",     "Экспансия",       "> 60–70", "> 70",   "Резкое ускорение участия",              "Включился импульс режима",              "#32CD32"),
+        ("Trend",         "Тренд",           "> 70",    "50–70",  "Участие держится стабильно",            "Режим устойчив, идёт протяжка",         "#006400"),
+        ("Distribution",  "Распределение",   "> 70",    "↓ LH",   "Импульс участия слабеет",               "Смарт-деньги выгружаются",              "#FF8C00"),
+        ("Balance",       "Сжатие/Баланс",   "45–55",   "40–60",  "Нет явного режима",                     "Переходная зона",                       "#888888"),
+        ("Collapse",      "Коллапс",         "< 40",    "< 30",   "Резкий выход участия вниз",             "Смена режима / ликвидация",             "#DC143C"),
+        ("Bear Exp.",     "Медвежья эксп.",  "< 40",    "< 30",   "Ускорение вниз",                        "Активный продавец",                     "#8B0000"),
+        ("Bear Trend",    "Медвежий тренд",  "< 30",    "30–50",  "Давление удерживается",                 "Стабильный медвежий режим",             "#660000"),
+    ]
+
+    col_labels = ["Фаза", "Рус. название", "Flow", "RSX(Flow)", "Что происходит", "Что это значит"]
+    col_widths  = [0.11,   0.13,            0.07,   0.07,        0.32,             0.30]
+    row_h    = 0.105
+    header_y = 0.95
+
+    x = 0.0
+    for label, w in zip(col_labels, col_widths):
+        ax3.add_patch(plt.Rectangle((x, header_y - 0.04), w, 0.09,
+                                    transform=ax3.transAxes,
+                                    fc='#1a1a2e', ec='none', clip_on=False))
+        ax3.text(x + w/2, header_y, label,
+                 ha='center', va='center', fontsize=7.5, fontweight='bold',
+                 color='white', transform=ax3.transAxes)
+        x += w
+
+    for row_i, (eng, rus, flow_r, rsx_r, what, meaning, color) in enumerate(phases):
+        y  = header_y - 0.04 - (row_i + 1) * row_h
+        bg = '#f4f4f4' if row_i % 2 == 0 else '#ffffff'
+        row_data = [eng, rus, flow_r, rsx_r, what, meaning]
+        x = 0.0
+        for col_i, (val, w) in enumerate(zip(row_data, col_widths)):
+            ax3.add_patch(plt.Rectangle((x, y - row_h*0.45), w, row_h*0.9,
+                                        transform=ax3.transAxes,
+                                        fc=bg, ec='#dddddd', linewidth=0.4,
+                                        clip_on=False))
+            if col_i == 0:
+                ax3.add_patch(plt.Rectangle((x, y - row_h*0.45), 0.005, row_h*0.9,
+                                            transform=ax3.transAxes,
+                                            fc=color, ec='none', clip_on=False))
+            ax3.text(x + w/2, y, val,
+                     ha='center', va='center', fontsize=6.8,
+                     transform=ax3.transAxes, color='#111111')
+            x += w
+
+    buf = io.BytesIO()
+    plt.savefig(buf, format='png', bbox_inches='tight')
+    buf.seek(0)
+    plt.close(fig)
+    return buf
+
+
+def recent_flow(n=120, seed=0):
+    df = synthetic_ohlcv(n, seed)
+    df.index = pd.bdate_range(end=pd.Timestamp.now().normalize(), periods=n)
+    return main.compute_flow(df)
+
+
+def bench_render():
+    perigees = main.get_lunar_perigees(175)
+    frames   = [recent_flow(seed=i) for i in range(5)]
+    rsx      = [main.calculate_rsx(df['Flow']) for df in frames]
+    main.make_chart(frames[0], 'GC', rsx[0], perigees)      # сборка шаблона — один раз на процесс
+
+    def run(fn):
+        for i, df in enumerate(frames):
+            fn(df, 'GC', rsx[i], perigees)
+
+    ref  = timeit(run, make_chart_reference, repeat=1) / len(frames)
+    fast = timeit(run, main.make_chart) / len(frames)
+    print(f"render: from scratch {ref*1e3:.0f} ms/chart | template {fast*1e3:.0f} ms/chart "
+          f"({ref / fast:.1f}x)")
+
+
+# ────────────────────────────────────────────────
+# Перигеи: таблица против сканирования
+# ────────────────────────────────────────────────
+def perigees_reference(now: datetime, days_back: int = 175) -> list:
+    """Исходный get_lunar_perigees со сканированием от now — эталон для таблицы."""
+    try:
+        import ephem
+    except ImportError:
+        return []
+    perigees  = []
+    start     = ephem.Date(now - pd.Timedelta(days=days_back + 30))
+    end       = ephem.Date(now + pd.Timedelta(days=35))
+    moon      = ephem.Moon()
+    cutoff    = pd.Timestamp(now - pd.Timedelta(days=days_back))
+    now_ts    = pd.Timestamp(now)
+    date      = start
+    prev_dist = None
+    prev_date = None
+    while date < end:
+        moon.compute(date)
+        dist = moon.earth_distance
+        if prev_dist is not None and prev_dist < dist:
+            lo, hi = prev_date, date
+            for _ in range(30):
+                m1 = lo + (hi - lo) / 3
+                m2 = lo + (hi - lo) * 2 / 3
+                moon.compute(m1); d1 = moon.earth_distance
+                moon.compute(m2); d2 = moon.earth_distance
+                if d1 < d2:
+                    hi = m2
+                else:
+                    lo = m1
+            perigee = (lo + hi) / 2
+            p = pd.Timestamp(ephem.Date(perigee).datetime())
+            if (not perigees or (p - perigees[-1]).days > 20) and p >= cutoff:
+                perigees.append(p)
+                if p > now_ts:
+                    break
+        prev_dist = dist
+        prev_date = date
+        date += 0.5
+    return perigees
+
+
+def _table_perigees_at(now, days_back=175):
+    orig = main.datetime
+    main.datetime = type('FrozenNow', (datetime,), {'now': classmethod(lambda cls, tz=None: now)})
+    try:
+        return main.get_lunar_perigees(days_back)
+    finally:
+        main.datetime = orig
+
+
+def check_perigees():
+    rng = np.random.default_rng(0)
+    for _ in range(40):
+        now = datetime(1995, 1, 1) + pd.Timedelta(days=float(rng.uniform(0, 60 * 365)))
+        # исходное сканирование на убывающем участке у левой границы окна ловит ложный
+        # «перигей» — сканируем с запасом в 60 дней. Сетка 0.5 суток у него зависит от now,
+        # так что сравниваем с допуском в полсуток и вдали от границ окна.
+        cutoff = pd.Timestamp(now) - pd.Timedelta(days=175)
+        ref  = perigees_reference(now, 175 + 60)
+        got  = _table_perigees_at(now)
+        assert got[-1] > pd.Timestamp(now) - pd.Timedelta(hours=12), f"no upcoming perigee at {now}"
+        lo, hi = cutoff + pd.Timedelta(days=1), pd.Timestamp(now) - pd.Timedelta(days=1)
+        for xs, ys in ((ref, got), (got, ref)):
+            for p in xs:
+                if lo <= p <= hi:
+                    nearest = min(abs(p - q) for q in ys)
+                    assert nearest <= pd.Timedelta(hours=12), f"perigee mismatch at {now}: {p}"
+    print("perigees: table matches the scanning algorithm within 12 h")
+
+
+def bench_perigees():
+    check_perigees()
+    now  = datetime.now()
+    scan = timeit(perigees_reference, now, 175, repeat=1)
+    main.get_lunar_perigees(175)
+    fast = timeit(main.get_lunar_perigees, 175)
+    print(f"perigees: scan {scan*1e3:.0f} ms | table {fast*1e6:.0f} us")
+
+
+# ────────────────────────────────────────────────
+# EMA с переменным alpha
+# ────────────────────────────────────────────────
+def adaptive_ema_reference(sig_vals, span_vals):
+    """Исходный цикл из smart_money_flow."""
+    result    = np.zeros(len(sig_vals))
+    result[0] = sig_vals[0]
+    for i in range(1, len(sig_vals)):
+        alpha     = 2.0 / (span_vals[i] + 1.0)
+        result[i] = alpha * sig_vals[i] + (1 - alpha) * result[i - 1]
+    return result
+
+
+def _ema_inputs(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0, 100, n), rng.integers(3, 11, n)
+
+
+def check_adaptive_ema():
+    for n in (1, 2, 3, 64, 65, 175, 10_000, 200_000):
+        sig, span = _ema_inputs(n, seed=n)
+        ref = adaptive_ema_reference(sig, span)
+        got = main.adaptive_ema(sig, 2.0 / (span + 1.0))
+        assert np.allclose(got, ref, rtol=1e-10, atol=1e-10), f"adaptive_ema mismatch n={n}"
+    sig, span = _ema_inputs(500)
+    panel = np.stack([sig, sig[::-1]], axis=1)
+    spans = np.stack([span, span[::-1]], axis=1)
+    got   = main.adaptive_ema(panel, 2.0 / (spans + 1.0))
+    assert np.allclose(got[:, 1], adaptive_ema_reference(sig[::-1], span[::-1]), rtol=1e-10, atol=1e-10)
+    print("adaptive_ema: matches the scalar recurrence within 1e-10")
+
+
+def bench_adaptive_ema():
+    check_adaptive_ema()
+    for n in (175, 10_000, 1_000_000):
+        sig, span = _ema_inputs(n)
+        alphas = 2.0 / (span + 1.0)
+        ref  = timeit(adaptive_ema_reference, sig, span, repeat=1)
+        fast = timeit(main.adaptive_ema, sig, alphas)
+        err  = np.max(np.abs(main.adaptive_ema(sig, alphas) - adaptive_ema_reference(sig, span)))
+        print(f"adaptive_ema n={n:>9,}: loop {ref*1e3:8.2f} ms | chunked {fast*1e3:7.2f} ms | max err {err:.1e}")
+
+
+# ────────────────────────────────────────────────
+# Flow всей вселенной одним массивом
+# ────────────────────────────────────────────────
+def _universe(n_symbols, n_bars=120):
+    # разная длина истории — проверка выравнивания по последнему бару
+    return {f"s{i}": synthetic_ohlcv(n_bars - (i % 7) * 3, seed=i) for i in range(n_symbols)}
+
+
+def check_flow_panel():
+    dfs = _universe(20)
+    dfs['short'] = synthetic_ohlcv(19)
+    dfs['long']  = synthetic_ohlcv(600, seed=42)
+    dfs['flat']  = synthetic_ohlcv(120, seed=7).assign(Volume=1000.0)
+    panel = main.flow_panel(dfs)
+    assert 'short' not in panel
+    for sym in panel.keys():
+        ref = main.compute_flow(dfs[sym].copy())['Flow']
+        got = panel.series(sym)
+        assert got.index.equals(ref.index), sym
+        assert np.allclose(got.values, ref.values, rtol=0, atol=1e-9), f"flow_panel mismatch: {sym}"
+    sub = panel.select(['s3', 'flat'])
+    assert np.allclose(sub.series('flat').values, panel.series('flat').values)
+    print("flow_panel: every column matches compute_flow within 1e-9")
+
+
+def bench_flow_panel():
+    check_flow_panel()
+    one = timeit(main.compute_flow, synthetic_ohlcv(120))
+    print(f"flow_panel: compute_flow, 1 symbol x 120 bars {one*1e3:7.2f} ms")
+    for n in (6, 25, 100):
+        dfs   = _universe(n)
+        loop  = timeit(main.compute_flows, {k: df.copy() for k, df in dfs.items()})
+        panel = timeit(main.flow_panel, dfs)
+        print(f"flow_panel: {n:>3} symbols: compute_flows {loop*1e3:8.2f} ms | flow_panel {panel*1e3:7.2f} ms")
+
+
+# ────────────────────────────────────────────────
+# Алерты на воспроизведённой ленте
+# ────────────────────────────────────────────────
+def _hourly(n, seed):
+    df = synthetic_ohlcv(n, seed)
+    df.index = pd.date_range('2026-01-05 00:00', periods=n, freq='h')
+    return df
+
+
+def _replay_engine(dfs, start, debounce=0):
+    subs = main.AlertSubscriptions('/nonexistent/alert_subs.json')
+    subs.subscribe(1)
+    sent = []
+
+    async def send(chat_id, text):
+        sent.append((chat_id, text))
+
+    feed   = main.ReplayFeed(dfs, start=start)
+    engine = main.AlertEngine(feed, send, subs, interval='1h', debounce=debounce)
+    return engine, feed, sent
+
+
+def check_alerts():
+    import asyncio
+    dfs      = {f"T{i}": _hourly(300, seed=i) for i in range(5)}
+    universe = {k.lower(): k for k in dfs}
+    start    = 80
+    engine, feed, sent = _replay_engine(dfs, start)
+
+    async def replay():
+        events = []
+        while not feed.exhausted:
+            events += await engine.poll(universe)
+        return events
+    events = asyncio.run(replay())
+
+    expected = []
+    for cmd, ticker in universe.items():
+        flow = main.compute_flow(dfs[ticker].copy())['Flow']
+        vals = {'Flow': flow.values, 'RSX': main.calculate_rsx(flow).values}
+        # прогрев — закрытые бары первого прохода; последний бар ленты так и остаётся незакрытым
+        for i in range(start - 1, len(flow) - 1):
+            prev = {k: v[i - 1] for k, v in vals.items()}
+            cur  = {k: v[i] for k, v in vals.items()}
+            expected += [(cmd, flow.index[i], name, level, side)
+                         for name, level, side in main.crossings(prev, cur)]
+    got = [e[:5] for e in events]
+    assert sorted(got) == sorted(expected), f"alerts mismatch: {len(got)} vs {len(expected)}"
+    assert engine.sent == len(expected) and len(sent) <= engine.polls
+
+    engine, feed, sent = _replay_engine(dfs, start, debounce=3600)
+    asyncio.run(replay())
+    assert engine.sent <= len(universe) * len(main.ALERT_LEVELS) and engine.suppressed > 0
+    print(f"alerts: {len(expected)} crossings on replay match compute_flow + calculate_rsx; debounce holds")
+
+
+def bench_alerts():
+    import asyncio
+    check_alerts()
+    for n in (100, 500):
+        dfs      = {f"T{i}": _hourly(400, seed=i) for i in range(n)}
+        universe = {k.lower(): k for k in dfs}
+        engine, feed, _ = _replay_engine(dfs, start=300)
+
+        async def run():
+            t0 = time.perf_counter()
+            await engine.poll(universe)
+            warm = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            for _ in range(20):
+                await engine.poll(universe)
+            return warm, (time.perf_counter() - t0) / 20
+        warm, per_bar = asyncio.run(run())
+        print(f"alerts: {n:>3} symbols: warm-up 300 bars {warm*1e3:8.1f} ms | new bar {per_bar*1e3:6.1f} ms/poll")
+
+
+# ────────────────────────────────────────────────
+# Бэктест фаз
+# ────────────────────────────────────────────────
+def check_backtest():
+    df = synthetic_ohlcv(1500, seed=3)
+    flow, rsx = main.stream_flow(df)
+    full = main.classify_phases(flow, rsx)
+    for k in (60, 400, 999):
+        # без заглядывания вперёд: обрезанная история даёт те же фазы на своих барах
+        f, r = main.stream_flow(df.iloc[:k])
+        assert np.array_equal(main.classify_phases(f, r), full[:k]), f"look-ahead at k={k}"
+    assert np.allclose(flow, main.compute_flow(df.copy())['Flow'].values, atol=1e-9)
+
+    res = main.backtest_symbol(df)
+    assert sum(res['counts']) == int((full[main.BACKTEST_WARMUP:] >= 0).sum())
+    close = df['Close'].values
+    p0    = np.flatnonzero(full[main.BACKTEST_WARMUP:-1] == 0) + main.BACKTEST_WARMUP
+    assert np.isclose(res['sum'][0][0], (close[p0 + 1] / close[p0] - 1).sum())
+    print(f"backtest: phases are causal; {sum(res['counts'])} of {len(df)} bars classified")
+
+
+def bench_backtest():
+    import tempfile
+    check_backtest()
+    df = synthetic_ohlcv(2500)
+    t  = timeit(main.backtest_symbol, df, repeat=1)
+    print(f"backtest: one symbol x 2500 bars {t*1e3:7.1f} ms")
+    with tempfile.TemporaryDirectory() as tmp:
+        path  = os.path.join(tmp, 'history.sqlite')
+        store = main.BarStore(path, 0, main.HISTORY_BARS)
+        syms  = [f"S{i}" for i in range(8)]
+        for i, sym in enumerate(syms):
+            store.save(sym, '1d', synthetic_ohlcv(2500, seed=i))
+        for workers in sorted({1, os.cpu_count() or 1}):
+            t0  = time.perf_counter()
+            res = main.run_backtest(syms, path=path, workers=workers)
+            print(f"backtest: {len(syms)} symbols x 2500 bars, {workers} process(es) {time.perf_counter() - t0:6.2f} s")
+        print(main.summarize_backtest(res).to_string())
+
+
+# ────────────────────────────────────────────────
+# Нормировка smart A/D
+# ────────────────────────────────────────────────
+def normalize_reference(ad, mode, window=200):
+    s = pd.Series(ad)
+    if mode == 'window':
+        lo, hi = pd.Series(ad.min(), index=s.index), pd.Series(ad.max(), index=s.index)
+    elif mode == 'expanding':
+        lo, hi = s.expanding().min(), s.expanding().max()
+    else:
+        lo, hi = s.rolling(window, min_periods=1).min(), s.rolling(window, min_periods=1).max()
+    return np.where(hi - lo > 1e-8, (s - lo) / (hi - lo) * 100, 50.0)
+
+
+def check_normalize():
+    rng = np.random.default_rng(0)
+    ad  = np.cumsum(rng.normal(0, 1, 3000))
+    for mode in ('window', 'expanding', 'rolling'):
+        assert np.allclose(main.normalize_ad(ad, mode), normalize_reference(ad, mode)), mode
+
+    df = synthetic_ohlcv(400, seed=11)
+    for mode in ('expanding', 'rolling'):
+        full = main.compute_flow(df.copy(), normalize=mode)['Flow'].values
+        for k in (120, 250):
+            # причинная нормировка: с новыми барами прошлые значения не меняются
+            part = main.compute_flow(df.iloc[:k].copy(), normalize=mode)['Flow'].values
+            assert np.allclose(part, full[:k], rtol=0, atol=1e-9), f"{mode}: history rewritten at k={k}"
+        st = main.FlowState(history_days=100_000, normalize=mode)
+        st.extend(df.iloc[:200])
+        st = main.FlowState.from_dict(json.loads(json.dumps(st.to_dict())))
+        st.extend(df)
+        assert np.allclose(st.frame()['Flow'].values, full, rtol=0, atol=1e-9), f"FlowState {mode}"
+        panel = main.flow_panel({'a': df, 'b': df.iloc[50:]}, normalize=mode)
+        assert np.allclose(panel.series('a').values, full, rtol=0, atol=1e-9), f"flow_panel {mode}"
+        ref_b = main.compute_flow(df.iloc[50:].copy(), normalize=mode)['Flow'].values
+        assert np.allclose(panel.series('b').values, ref_b, rtol=0, atol=1e-9), f"flow_panel {mode}"
+    print("normalize: causal modes are append-only and agree across compute_flow, FlowState, flow_panel")
+
+
+def bench_normalize():
+    check_normalize()
+    ad = np.cumsum(np.random.default_rng(1).normal(0, 1, 1_000_000))
+    for mode in ('window', 'expanding', 'rolling'):
+        t = timeit(main.normalize_ad, ad, mode)
+        r = timeit(normalize_reference, ad, mode, repeat=1)
+        print(f"normalize {mode:>9}, 1M bars: {t*1e3:7.1f} ms | pandas {r*1e3:7.1f} ms")
+
+
+# ────────────────────────────────────────────────
+# Конвейер /all
+# ────────────────────────────────────────────────
+class _FakeBot:
+    """send_photo / send_media_group с задержкой сети; запоминает порядок подписей."""
+
+    def __init__(self, latency):
+        self.latency  = latency
+        self.captions = []
+        self.calls    = 0
+
+    def _msg(self):
+        self.calls += 1
+        photo = type('P', (), {'file_id': f"f{self.calls}"})()
+        return type('M', (), {'photo': [photo]})()
+
+    async def send_photo(self, photo=None, caption=None, **kwargs):
+        import asyncio
+        await asyncio.sleep(self.latency)
+        self.captions.append(caption)
+        return self._msg()
+
+    async def send_media_group(self, media=None, **kwargs):
+        import asyncio
+        await asyncio.sleep(self.latency)
+        self.captions += [m.caption for m in media]
+        return [self._msg() for _ in media]
+
+
+def _fake_download(dfs, latency):
+    """Подмена main._yf: модуль с download, отдающим dfs с задержкой latency."""
+    def download(symbols, **kwargs):
+        time.sleep(latency)
+        return pd.concat({s: dfs[s] for s in symbols if s in dfs}, axis=1)
+    return lambda: SimpleNamespace(download=download)
+
+
+async def _all_reference(bot, chat_id):
+    """Исходная последовательная схема /all: всё загрузить, потом по одному активу рисовать и слать."""
+    import asyncio
+    bars  = main.download_many(list(main.FUTURES.values()))
+    flows = main.compute_flows(bars)
+    flow_data = {}
+    for cmd, ticker in main.FUTURES.items():
+        df = flows[ticker]
+        if df is None:
+            continue
+        flow_data[cmd] = df['Flow']
+        key, data = await main.render_chart(df, cmd.upper())
+        await bot.send_photo(photo=data, caption=f"{cmd.upper()} — Volume Stress / Participation Index + RSX(9)")
+    for page in range(1, len(main.dist_pages()) + 1):
+        dist = await main.render_distribution_chart(flow_data, page)
+        if dist:
+            await bot.send_photo(photo=dist[1], caption="Distribution" + main.page_suffix(page))
+
+
+def check_bar_store():
+    import tempfile
+    df = synthetic_ohlcv(130, seed=2)
+    df.index = pd.bdate_range(end=pd.Timestamp(datetime.now()).normalize(), periods=130)
+    calls = []
+
+    def download(symbols, **kwargs):
+        calls.append(kwargs)
+        # первая загрузка удаётся, дальше — биржа молчит
+        return pd.concat({'X': df}, axis=1) if len(calls) == 1 else pd.DataFrame()
+    saved = (main._yf, main.FETCH_BACKOFF)
+    main._yf, main.FETCH_BACKOFF = (lambda: SimpleNamespace(download=download)), 0
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            store = main.BarStore(os.path.join(tmp, "bars.sqlite"), 0)
+            assert store.get_many(['X'])['X'] is not None
+            stale = store.get_many(['X'])['X']
+            assert len(calls) == 1 + main.FETCH_RETRIES, f"failed top-up must be retried: {len(calls)} calls"
+            assert store.failures == main.FETCH_RETRIES and store.stale == 1, store.stats()
+            assert stale is not None and stale.index[-1] == df.index[-1], "stale bars are served after retries"
+            peer = store._conn().execute("SELECT COUNT(*) FROM refreshed").fetchone()[0]
+            assert peer == 1, "a failed top-up must not be marked refreshed"
+
+        # в группе повторяется только упавший символ, со своим счётчиком попыток
+        asked = []
+
+        def download(symbols, **kwargs):
+            asked.append(list(symbols))
+            return pd.concat({'X': df}, axis=1)
+        main._yf = lambda: SimpleNamespace(download=download)
+        with tempfile.TemporaryDirectory() as tmp:
+            store = main.BarStore(os.path.join(tmp, "bars.sqlite"), 0)
+            got   = store.get_many(['X', 'Y'])
+            assert got['X'] is not None and got['Y'] is None, got
+            assert asked == [['X', 'Y']] + [['Y']] * (main.FETCH_RETRIES - 1), asked
+            assert store.failures == main.FETCH_RETRIES, store.stats()
+    finally:
+        main._yf, main.FETCH_BACKOFF = saved
+
+    # внутридневной бар в UTC, в каком бы поясе ни отдал индекс yfinance; дневной — дата сессии
+    bar = pd.DataFrame({c: [1.0] for c in main.OHLCV_COLUMNS})
+    got = {}
+    for tz in ('America/New_York', 'Europe/London'):
+        for interval, ts in (('1h', '2024-05-01 14:30'), ('1d', '2024-05-01')):
+            frame = bar.set_index(pd.DatetimeIndex([pd.Timestamp(ts, tz='UTC' if interval != '1d' else tz)
+                                                    .tz_convert(tz)]))
+            main._yf = lambda frame=frame: SimpleNamespace(download=lambda *a, **k: frame)
+            got[tz, interval] = main._yf_download(['X'], interval=interval)['X'].index[0]
+    main._yf = saved[0]
+    assert {got[tz, '1h'] for tz in ('America/New_York', 'Europe/London')} == {pd.Timestamp('2024-05-01 14:30')}
+    assert {got[tz, '1d'] for tz in ('America/New_York', 'Europe/London')} == {pd.Timestamp('2024-05-01')}
+    print("bars: failed top-up is retried and served stale only after retries; intraday index in UTC")
+
+
+def bench_pipeline():
+    import asyncio
+    import tempfile
+    check_bar_store()
+    n    = 12
+    dfs  = {f"T{i}": synthetic_ohlcv(130, seed=i) for i in range(n)}
+    now  = pd.Timestamp(datetime.now()).normalize()
+    for df in dfs.values():
+        df.index = pd.bdate_range(end=now, periods=len(df))
+    saved = (main.FUTURES.copy(), main._yf, main.bar_store, main.chart_cache)
+    main.FUTURES.clear()
+    main.FUTURES.update({f"t{i}": f"T{i}" for i in range(n)})
+    main._yf = _fake_download(dfs, latency=0.3)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            results = {}
+            for name, run in (('sequential', _all_reference), ('pipeline', None)):
+                main.bar_store   = main.BarStore(os.path.join(tmp, f"{name}.sqlite"), 0)
+                main.chart_cache = main.ChartCache(64)
+                bot = _FakeBot(latency=0.2)
+
+                async def go():
+                    await main.cpu_pool.run(main.make_chart, main.compute_flow(dfs['T0'].copy()), 'warm')
+                    t0 = time.perf_counter()
+                    if run:
+                        await run(bot, 0)
+                    else:
+                        flow_data, _ = await main.deliver_charts(bot, [0], list(main.FUTURES), main.prepare_flows)
+                        await main.deliver_distribution(bot, [0], flow_data, "Distribution")
+                    return time.perf_counter() - t0
+                results[name] = (asyncio.run(go()), bot.captions)
+                main.cpu_pool.shutdown()
+            assert results['sequential'][1] == results['pipeline'][1], "pipeline changed order or captions"
+            for name, (t, caps) in results.items():
+                print(f"pipeline: /all, {n} assets + {len(main.dist_pages())} dist page(s), {name:>10}: {t:6.2f} s")
+    finally:
+        main.FUTURES.clear()
+        main.FUTURES.update(saved[0])
+        main._yf, main.bar_store, main.chart_cache = saved[1:]
+
+
+def _command_update(update_id, chat_id, text):
+    return main.Update.de_json({
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': 0, 'text': text,
+                    'chat': {'id': chat_id, 'type': 'private'}},
+    }, None)
+
+
+def check_webhook():
+    import asyncio
+
+    async def go():
+        flight = main.SingleFlight()
+        runs   = []
+
+        async def slow(x):
+            runs.append(x)
+            await asyncio.sleep(0.05)
+            return x * 2
+        out = await asyncio.gather(*(flight.do('k', slow, 21) for _ in range(20)))
+        assert out == [42] * 20 and runs == [21], "single-flight ran the work more than once"
+        assert flight.stats() == {"in_flight": 0, "calls": 1, "shared": 19}
+
+        clock = [0.0]
+        disp  = main.UpdateDispatcher(None, queue_size=100,
+                                      limiter=main.ChatLimiter(rate=1.0, burst=3, clock=lambda: clock[0]))
+        got = [await disp.submit(_command_update(i, 7, '/gc')) for i in range(5)]
+        assert got == ['queued'] * 3 + ['limited'] * 2, got
+        assert await disp.submit(_command_update(0, 7, '/gc')) == 'duplicate'
+        assert await disp.submit(_command_update(10, 8, '/gc')) == 'queued', "limit must be per chat"
+        clock[0] += 1.0
+        assert await disp.submit(_command_update(11, 7, '/gc')) == 'queued', "bucket must refill"
+        kinds = [disp.queue.get_nowait()[0] for _ in range(disp.queue.qsize())]
+        assert kinds.count('notice') == 1, "limit warning must be sent once"
+
+        # очередь полна: апдейт не теряется молча — повтор от Telegram принимается
+        full = main.UpdateDispatcher(None, queue_size=1)
+        got  = [await full.submit(_command_update(i, i, '/gc')) for i in (300, 301)]
+        assert got == ['queued', 'dropped'], got
+        full.queue.get_nowait()
+        assert await full.submit(_command_update(301, 301, '/gc')) == 'queued', "redelivery after drop"
+    asyncio.run(go())
+    print("webhook: single-flight, dedup, per-chat limit, redelivery after drop OK")
+
+
+def bench_webhook():
+    import asyncio
+    check_webhook()
+    n_chats, per_chat, work = 20, 10, 0.2
+
+    async def go():
+        async def process(update):
+            await asyncio.sleep(work)
+
+        async def notify(chat_id):
+            await asyncio.sleep(work)
+        disp = main.UpdateDispatcher(process, workers=4, queue_size=1000, notify=notify,
+                                     limiter=main.ChatLimiter(rate=0.2, burst=5))
+        disp.start()
+        updates = [_command_update(c * per_chat + i, c, '/gc') for c in range(n_chats) for i in range(per_chat)]
+        t0 = time.perf_counter()
+        for u in updates + updates[:50]:            # 50 ретраев Telegram
+            await disp.submit(u)
+        ack = (time.perf_counter() - t0) / (len(updates) + 50)
+        await disp.queue.join()
+        await disp.stop()
+        return ack, disp.counts
+
+    ack, counts = asyncio.run(go())
+    print(f"webhook: {n_chats} chats x {per_chat} cmds + 50 retries, ack {ack * 1e6:.1f} us/update, "
+          f"{dict(counts)}")
+
+    async def coalesce():
+        flight = main.SingleFlight()
+
+        async def render():
+            await asyncio.sleep(work)
+            return b'png'
+        t0 = time.perf_counter()
+        await asyncio.gather(*(flight.do(('asset', 'gc', '1d'), render) for _ in range(50)))
+        return time.perf_counter() - t0, flight.stats()
+    t, st = asyncio.run(coalesce())
+    print(f"webhook: 50 concurrent /gc -> {st['calls']} render(s) in {t:.2f} s ({st['shared']} shared)")
+
+
+def bench_metrics():
+    n = 200_000
+
+    def noop():
+        return None
+    for name, fn in (('plain', noop), ('timed', main.timed('bench')(noop))):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        print(f"metrics: {name:>5} call {(time.perf_counter() - t0) / n * 1e9:7.0f} ns")
+    h = main.metrics.histogram('smartmoney_stage_seconds', stage='bench')
+    assert h is not None and h.count == n, "timed calls were not recorded"
+
+    # стадии, отработавшие в процессе cpu_pool, видны в /metrics основного процесса
+    import asyncio
+
+    async def render():
+        df = main.compute_flow(synthetic_ohlcv(250, seed=5))
+        return await main.render_chart(df, 'M')
+    asyncio.run(render())
+    main.cpu_pool.shutdown()
+    text = main.metrics.render()
+    for stage in ('rsx', 'make_chart', 'savefig'):
+        assert f'smartmoney_stage_seconds_count{{stage="{stage}"}}' in text, f"stage {stage} missing from /metrics"
+    print("metrics: rsx, make_chart, savefig from cpu_pool are merged into /metrics")
+    t = timeit(main.metrics.render, main.metric_gauges())
+    print(f"metrics: /metrics render, {len(main.metrics.render().splitlines())} lines: {t * 1e3:.2f} ms")
+
+
+# ────────────────────────────────────────────────
+# Воспроизводимый прогон: фикстуры, стадии, baseline, golden
+# ────────────────────────────────────────────────
+FIXTURE_SIZES    = {'small': 250, 'medium': 2_500, 'large': 25_000}   # баров
+FIXTURE_END      = '2019-12-31'     # фикстуры в прошлом: вид графика не зависит от сегодняшней даты
+FIXTURE_UNIVERSE = 24               # активов для распределения (175 баров)
+BASELINE_PATH    = os.path.join(main.DATA_DIR, "bench_baseline.json")      # своя для каждой машины
+GOLDEN_PATH      = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_golden.json")
+GOLDEN_RTOL      = 1e-9
+REGRESSION       = 1.25             # во сколько раз медленнее baseline — уже регрессия
+
+
+def fixture(size: str) -> pd.DataFrame:
+    n  = FIXTURE_SIZES[size]
+    df = synthetic_ohlcv(n, seed=n)
+    df.index = pd.bdate_range(end=FIXTURE_END, periods=n)
+    return df
+
+
+def fixture_universe() -> dict:
+    out = {}
+    for i in range(FIXTURE_UNIVERSE):
+        df = synthetic_ohlcv(175 - (i % 5) * 10, seed=1000 + i)
+        df.index = pd.bdate_range(end=FIXTURE_END, periods=len(df))
+        out[f"A{i}"] = df
+    return out
+
+
+def fixture_perigees(index) -> list:
+    step = max(1, len(index) // 4)
+    return list(index[step::step][:3])
+
+
+def digest(values) -> dict:
+    """Сводка числового ряда для golden: длина, число NaN, сумма и 32 равномерные точки."""
+    x   = np.asarray(values, dtype=float).ravel()
+    idx = np.linspace(0, len(x) - 1, min(32, len(x))).astype(int) if len(x) else []
+    return {
+        'n':      int(len(x)),
+        'nan':    int(np.isnan(x).sum()),
+        'sum':    float(np.nansum(x)),
+        'sample': [None if np.isnan(v) else float(v) for v in x[idx]],
+    }
+
+
+def digest_equal(a: dict, b: dict) -> bool:
+    if a['n'] != b['n'] or a['nan'] != b['nan']:
+        return False
+    fa = np.array([np.nan if v is None else v for v in a['sample']] + [a['sum']], dtype=float)
+    fb = np.array([np.nan if v is None else v for v in b['sample']] + [b['sum']], dtype=float)
+    return bool(np.allclose(fa, fb, rtol=GOLDEN_RTOL, atol=GOLDEN_RTOL, equal_nan=True))
+
+
+def png_digest(buf) -> str:
+    return hashlib.sha256(buf.getvalue()).hexdigest()[:16]
+
+
+def suite_stages(sizes) -> list:
+    """[(имя, баров, fn() -> golden-выходы)] — стадии по размерам и сквозные прогоны."""
+    stages = []
+    for size in sizes:
+        df       = fixture(size)
+        flow     = main.compute_flow(df.copy())
+        rsx      = main.calculate_rsx(flow['Flow'], length=9)
+        perigees = fixture_perigees(df.index)
+        n        = len(df)
+
+        def end_to_end(df=df, perigees=perigees):
+            f = main.compute_flow(df.copy())
+            r = main.calculate_rsx(f['Flow'], length=9)
+            return {'flow': digest(f['Flow']), 'rsx': digest(r),
+                    'png': png_digest(main.make_chart(f, 'BENCH', r, perigees))}
+        stages += [
+            (f"flow@{size}",  n, lambda df=df: {'flow': digest(main.compute_flow(df.copy())['Flow'])}),
+            (f"rsx@{size}",   n, lambda s=flow['Flow']: {'rsx': digest(main.calculate_rsx(s, length=9))}),
+            (f"chart@{size}", n, lambda f=flow, r=rsx, p=perigees:
+                                 {'png': png_digest(main.make_chart(f, 'BENCH', r, p))}),
+            (f"end_to_end@{size}", n, end_to_end),
+        ]
+
+    universe = fixture_universe()
+    bars     = sum(len(df) for df in universe.values())
+    panel    = main.flow_panel(universe)
+
+    def distribution():
+        p = main.flow_panel(universe)
+        return {'flow': digest(p.flow), 'buckets': p.bucket_counts(main.LEVEL_RANGES).tolist(),
+                'png': png_digest(main.make_distribution_chart(p))}
+    stages += [
+        ("panel@universe", bars, lambda: {'flow': digest(main.flow_panel(universe).flow)}),
+        ("dist_chart@universe", bars, lambda: {'png': png_digest(main.make_distribution_chart(panel))}),
+        ("end_to_end@universe", bars, distribution),
+    ]
+    return stages
+
+
+def measure(fn, repeat) -> dict:
+    fn()                                    # прогрев: шаблон графика, таблицы, кэши numpy
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    out  = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'best': min(times), 'median': float(np.median(times)), 'peak_kb': round(peak / 1024, 1)}, out
+
+
+def compare_golden(outputs: dict, golden: dict) -> list:
+    """Расхождения с golden; PNG сравниваются только при той же версии matplotlib."""
+    same_mpl = golden.get('meta', {}).get('matplotlib') == matplotlib.__version__
+    problems = []
+    for stage, out in outputs.items():
+        ref = golden.get('outputs', {}).get(stage)
+        if ref is None:
+            continue
+        for name, value in out.items():
+            expect = ref.get(name)
+            if expect is None or (name == 'png' and not same_mpl):
+                continue
+            ok = digest_equal(value, expect) if isinstance(value, dict) else value == expect
+            if not ok:
+                problems.append(f"{stage}.{name}")
+    return problems
+
+
+def environment() -> dict:
+    return {'python': sys.version.split()[0], 'numpy': np.__version__, 'pandas': pd.__version__,
+            'matplotlib': matplotlib.__version__, 'cpus': os.cpu_count()}
+
+
+def run_suite(argv) -> int:
+    ap = argparse.ArgumentParser(prog="bench.py suite",
+                                 description="Стадии и сквозные прогоны на синтетических фикстурах.")
+    ap.add_argument("--sizes", default=",".join(FIXTURE_SIZES), help="размеры фикстур через запятую")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--baseline", default=BASELINE_PATH, help="JSON с прошлым прогоном для сравнения")
+    ap.add_argument("--save", action="store_true", help="записать этот прогон как baseline")
+    ap.add_argument("--update-golden", action="store_true", help="перезаписать golden-выходы")
+    ap.add_argument("--strict", action="store_true", help="код возврата 1 при регрессии или расхождении")
+    args = ap.parse_args(argv)
+
+    sizes    = [s for s in args.sizes.split(',') if s]
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f).get('results', {})
+
+    results, outputs, regressions = {}, {}, []
+    warnings.filterwarnings('ignore', message='.*tight_layout')     # шум распределения, не результат
+    print(f"{'stage':<22}{'bars':>8}{'median ms':>11}{'best ms':>10}{'kbar/s':>9}{'peak KB':>10}{'vs base':>9}")
+    for name, bars, fn in suite_stages(sizes):
+        res, out  = measure(fn, args.repeat)
+        res['bars_per_s'] = bars / res['median']
+        results[name], outputs[name] = res, out
+        base  = baseline.get(name)
+        ratio = res['median'] / base['median'] if base else None
+        if ratio and ratio > REGRESSION:
+            regressions.append(name)
+        print(f"{name:<22}{bars:>8}{res['median'] * 1e3:>11.2f}{res['best'] * 1e3:>10.2f}"
+              f"{res['bars_per_s'] / 1e3:>9.1f}{res['peak_kb']:>10.0f}"
+              f"{'' if ratio is None else f'{ratio:.2f}x':>9}")
+
+    failed = []
+    if args.update_golden:
+        with open(GOLDEN_PATH, 'w') as f:
+            json.dump({'meta': environment(), 'outputs': outputs}, f, indent=1, sort_keys=True)
+        print(f"golden: записан {GOLDEN_PATH}")
+    elif os.path.exists(GOLDEN_PATH):
+        with open(GOLDEN_PATH) as f:
+            golden = json.load(f)
+        failed = compare_golden(outputs, golden)
+        if golden.get('meta', {}).get('matplotlib') != matplotlib.__version__:
+            print(f"golden: PNG не сравниваются (matplotlib {matplotlib.__version__}, "
+                  f"golden — {golden.get('meta', {}).get('matplotlib')})")
+        print(f"golden: {'расхождения: ' + ', '.join(failed) if failed else 'OK'}")
+
+    if regressions:
+        print(f"регрессии (> {REGRESSION}x baseline): {', '.join(regressions)}")
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline) or '.', exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'meta': environment(), 'results': results}, f, indent=1, sort_keys=True)
+        print(f"baseline: записан {args.baseline}")
+    return 1 if args.strict and (failed or regressions) else 0
+
+
+def _cold(code, repeat=3) -> float:
+    """Лучшее время свежего интерпретатора с кодом code (импорт main и т.п.)."""
+    import subprocess
+    env  = dict(os.environ, BOT_TOKEN=os.environ.get("BOT_TOKEN", "0:bench"))
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, env=env,
+                       cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def bench_startup():
+    # без import bench: он сам тянет pyplot для эталонов
+    chart = ("import main, numpy as np, pandas as pd; x = 100 + np.cumsum(np.random.default_rng(0).normal(0, 1, 250)); "
+             "df = pd.DataFrame({'High': x + 1, 'Low': x - 1, 'Close': x, 'Volume': 1e6}, "
+             "index=pd.bdate_range(end='2019-12-31', periods=250)); "
+             "main.make_chart(main.compute_flow(df), 'GC', perigees=[])")
+    eager = "import yfinance, matplotlib; matplotlib.use('Agg'); import matplotlib.pyplot; "
+    for label, code in (('import main', "import main"), ('import + first chart', chart)):
+        before = _cold(eager + code)
+        after  = _cold(code)
+        print(f"startup: {label:<21} eager imports {before:5.2f} s | lazy {after:5.2f} s "
+              f"(-{before - after:.2f} s)")
+    lazy = "import main, sys; assert not {'yfinance', 'matplotlib.pyplot', 'matplotlib'} & set(sys.modules)"
+    _cold(lazy, repeat=1)
+    print("startup: yfinance and matplotlib are not imported by 'import main'")
+
+
+def check_scheduler():
+    import asyncio
+    import tempfile
+    from datetime import timezone
+
+    async def go(tmp):
+        store = main.JobStore(os.path.join(tmp, "jobs.sqlite"))
+        clock = [datetime(2024, 5, 1, 2, 59, tzinfo=timezone.utc).timestamp()]
+        ran   = []
+
+        async def job(chats):
+            ran.append(chats)
+        store.upsert('daily', 'job', '0 3 * * *', {'chats': [1, 2]}, now=clock[0])
+        workers = [main.Scheduler(store, {'job': job}, owner=w, clock=lambda: clock[0]) for w in 'AB']
+        clock[0] += 1800                                    # 03:29 — процесс проспал 03:00
+        await asyncio.gather(*(w.tick() for w in workers))
+        await asyncio.gather(*(t for w in workers for t in list(w.running.values())))
+        assert ran == [[1, 2]], f"missed run must be caught up exactly once: {ran}"
+        nxt = datetime.fromtimestamp(store.jobs()[0]['next_run'], timezone.utc)
+        assert nxt == datetime(2024, 5, 2, 3, 0, tzinfo=timezone.utc), nxt
+    class Blocked:
+        async def send_media_group(self, chat_id, media):
+            raise RuntimeError(f"bot was blocked by {chat_id}")
+
+    async def deliver():
+        items  = [(f"k{i}", b"png", "c") for i in range(2)]
+        failed = await main.broadcast_album(Blocked(), [1, 2], items)
+        assert failed == [1, 2], failed
+        try:
+            await main.broadcast_album(Blocked(), [1], items, strict=True)
+        except RuntimeError:
+            return
+        raise AssertionError("strict delivery must raise to the command handler")
+    # день месяца '*/2' при заданном дне недели — AND, как в Vixie cron: нечётные понедельники
+    start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    runs  = [start]
+    for _ in range(3):
+        runs.append(main.CronSpec('0 3 */2 * 1').next_after(runs[-1]))
+    assert [r.day for r in runs[1:]] == [13, 27, 3], runs
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(go(tmp))
+    asyncio.run(deliver())
+    main.io_pool.shutdown()
+    print("scheduler: catch-up once across two workers OK, strict delivery raises")
+
+
+def bench_scheduler():
+    import asyncio
+    check_scheduler()
+    n, hung, latency = 1000, 10, 0.05
+
+    async def send(chat_id):
+        await asyncio.sleep(60 if chat_id < hung else latency)
+
+    async def go():
+        t0     = time.perf_counter()
+        failed = await main.fan_out(send, list(range(n)), concurrency=main.FANOUT_CONCURRENCY * 4, timeout=1.0)
+        return time.perf_counter() - t0, failed
+    t, failed = asyncio.run(go())
+    print(f"scheduler: fan-out to {n} chats ({hung} hung, {latency * 1e3:.0f} ms each): "
+          f"{t:.2f} s, {len(failed)} failed")
+
+
+class _FakeRedis:
+    """Минимальный клиент redis для проверки RedisState без сервера (TTL не соблюдает)."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, px=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def eval(self, script, numkeys, key, value, px):
+        # единственный скрипт RedisState — RENEW_SCRIPT: продлить, если значение совпадает
+        return int(self.data.get(key) == value)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, b'0')) + 1).encode()
+        return int(self.data[key])
+
+    def pexpire(self, key, px):
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+def _claim_keys(path, keys, out):
+    """Процесс-воркер: пытается взять каждый ключ; в out — сколько взял и за сколько."""
+    state = main.SQLiteState(path)
+    t0    = time.perf_counter()
+    won   = sum(state.add(k, os.getpid(), 60) for k in keys)
+    out.put((won, time.perf_counter() - t0))
+
+
+def _subscribe_chats(path, chats):
+    """Процесс-воркер: по одному /subscribe на чат в общий файл подписок."""
+    subs = main.AlertSubscriptions(path)
+    for chat in chats:
+        subs.change('subscribe', chat, ['gc'])
+
+
+def check_workers():
+    import asyncio
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backends = (main.SQLiteState(os.path.join(tmp, "state.sqlite")), main.RedisState('redis://', _FakeRedis()))
+        async def dispatch(state):
+            # апдейт, доставленный повторно на другой воркер, обрабатывается один раз
+            a, b = (main.UpdateDispatcher(None, queue_size=100, state=state,
+                                          limiter=main.SharedChatLimiter(state, rate=0.2, burst=5))
+                    for _ in range(2))
+            got = [await a.submit(_command_update(1, 7, '/gc')), await b.submit(_command_update(1, 7, '/gc'))]
+            assert got == ['queued', 'duplicate'], got
+            # лимит чата общий: 5 команд на оба воркера
+            got = [await (a, b)[i % 2].submit(_command_update(100 + i, 9, '/gc')) for i in range(7)]
+            assert got.count('queued') == 5 and got.count('limited') == 2, got
+            notices = [k for d in (a, b) for k, *_ in (d.queue.get_nowait() for _ in range(d.queue.qsize()))]
+            assert notices.count('notice') == 1, "limit warning must be sent once across workers"
+
+        async def locked_submit(state):
+            # база занята чужой транзакцией: submit ждёт в io_pool, event loop продолжает работать
+            import sqlite3
+            other = sqlite3.connect(state.path, isolation_level=None)
+            other.execute("BEGIN IMMEDIATE")
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+            ticker = asyncio.create_task(tick())
+            disp   = main.UpdateDispatcher(None, queue_size=10, state=state, limiter=main.ChatLimiter())
+            submit = asyncio.create_task(disp.submit(_command_update(500, 1, '/gc')))
+            await asyncio.sleep(0.3)
+            other.execute("COMMIT")
+            assert await submit == 'queued'
+            ticker.cancel()
+            assert ticks >= 10, f"event loop stalled while the state was locked: {ticks} ticks"
+
+        for state in backends:
+            asyncio.run(dispatch(state))
+
+            # PNG и file_id, полученные одним воркером, видны другому
+            c1, c2 = main.ChartCache(4, state=state), main.ChartCache(4, state=state)
+            c1.put('k', b'png')
+            c1.remember_file_id('k', 'AgAD')
+            assert c2.get('k') == b'png' and c2.file_id('k') == 'AgAD'
+            c2.forget_file_id('k')
+            assert main.ChartCache(4, state=state).file_id('k') is None
+
+            # off_loop зовёт кэш из нескольких потоков io_pool сразу
+            from concurrent.futures import ThreadPoolExecutor
+            cache, switch = main.ChartCache(4, state=state if state.blocking else None), sys.getswitchinterval()
+
+            def hammer(t):
+                for i in range(3000):
+                    key = f"h{(i * 7 + t) % 6}"
+                    cache.put(key, b'x') if i % 3 else cache.get(key)
+                    cache.remember_file_id(key, 'f') if i % 2 else cache.file_id(key)
+            sys.setswitchinterval(1e-6)
+            try:
+                with ThreadPoolExecutor(8) as ex:
+                    list(ex.map(hammer, range(8)))
+            finally:
+                sys.setswitchinterval(switch)
+
+            # лидер алертов один, пока продлевает аренду
+            assert main.hold_lease(state, 'lease:t', 'A', 60)
+            assert not main.hold_lease(state, 'lease:t', 'B', 60)
+            assert main.hold_lease(state, 'lease:t', 'A', 60)
+            assert not state.renew('lease:t', 'B', 60), "renew must not take someone else's lease"
+            assert state.get('lease:t') == b'A'
+        asyncio.run(locked_submit(backends[0]))
+
+        # второй процесс с той же базой не качает бары, которые первый обновил в пределах TTL
+        dfs   = {'X': synthetic_ohlcv(130, seed=1)}
+        dfs['X'].index = pd.bdate_range(end=pd.Timestamp(datetime.now()).normalize(), periods=130)
+        saved = main._yf
+        main._yf = _fake_download(dfs, latency=0)
+        try:
+            path  = os.path.join(tmp, "bars.sqlite")
+            first, second = main.BarStore(path, 3600), main.BarStore(path, 3600)
+            assert first.get('X') is not None and first.downloads == 1
+            assert second.get('X') is not None and second.downloads == 0 and second.peer_hits == 1
+            assert main.BarStore(path, 0).get('X') is not None, "expired refresh must download again"
+        finally:
+            main._yf = saved
+
+        # задачу, которую взяла другая машина (другой JobStore, общий state), не запускаем
+        async def go():
+            from datetime import timezone
+            state = backends[0]
+            ran   = []
+
+            async def job():
+                ran.append(1)
+            clock   = [datetime(2024, 5, 1, 2, 59, tzinfo=timezone.utc).timestamp()]
+            workers = []
+            for name in 'AB':
+                store = main.JobStore(os.path.join(tmp, f"jobs-{name}.sqlite"))
+                store.upsert('daily', 'job', '0 3 * * *', now=clock[0])
+                workers.append(main.Scheduler(store, {'job': job}, owner=name, clock=lambda: clock[0], state=state))
+            clock[0] += 120
+            await asyncio.gather(*(w.tick() for w in workers))
+            await asyncio.gather(*(t for w in workers for t in list(w.running.values())))
+            assert ran == [1], f"job must run once across machines: {ran}"
+            assert sorted(s for w in workers for s in w.counts.elements()) == ['ok', 'peer']
+        asyncio.run(go())
+        main.io_pool.shutdown()
+    print("workers: shared dedup, chat limit, chart cache, leases, bars, job runs, loop not blocked OK")
+
+
+def bench_workers():
+    import tempfile
+    import multiprocessing as mp
+    check_workers()
+    n, procs = 2000, 4
+    ctx = mp.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "state.sqlite")
+        main.SQLiteState(path).get('warm')          # схема до старта процессов
+        out  = ctx.Queue()
+        keys = [f"update:{i}" for i in range(n)]
+        ps   = [ctx.Process(target=_claim_keys, args=(path, keys, out)) for _ in range(procs)]
+        for p in ps:
+            p.start()
+        results = [out.get() for _ in ps]
+        for p in ps:
+            p.join()
+    won  = sum(w for w, _ in results)
+    rate = procs * n / max(t for _, t in results)
+    assert won == n, f"each key must be claimed by exactly one process: {won} != {n}"
+    print(f"workers: {procs} processes x {n} SET NX on sqlite state: each key claimed once, "
+          f"{rate / 1e3:.1f} k ops/s total")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "alert_subs.json")
+        ps   = [ctx.Process(target=_subscribe_chats, args=(path, range(i * 50, i * 50 + 50))) for i in range(procs)]
+        for p in ps:
+            p.start()
+        for p in ps:
+            p.join()
+        chats = main.AlertSubscriptions(path).chats
+        assert len(chats) == procs * 50, f"concurrent /subscribe lost updates: {len(chats)} of {procs * 50}"
+    print(f"workers: {procs} processes x 50 concurrent /subscribe: no lost updates")
+    for name, state in (('memory', main.MemoryState()), ('sqlite', None)):
+        with tempfile.TemporaryDirectory() as tmp:
+            state = state or main.SQLiteState(os.path.join(tmp, "s.sqlite"))
+            t0 = time.perf_counter()
+            for i in range(n):
+                state.add(f"u:{i}", 1, 60)
+            print(f"workers: dedup check on {name:<6} state: {(time.perf_counter() - t0) / n * 1e6:7.1f} us/update")
+
+
+def bench_api():
+    import gzip
+    import tempfile
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from starlette.testclient import TestClient
+    dfs = {'T0': synthetic_ohlcv(300, seed=3)}
+    dfs['T0'].index = pd.bdate_range(end=pd.Timestamp(datetime.now()).normalize(), periods=300)
+    saved = (main.FUTURES.copy(), main._yf, main.bar_store, main.api_cache)
+    main.FUTURES.clear()
+    main.FUTURES['t0'] = 'T0'
+    main._yf = _fake_download(dfs, latency=0)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            main.bar_store = main.BarStore(os.path.join(tmp, "bars.sqlite"), 300)
+            main.api_cache = main.ApiCache()
+            client = TestClient(main.app)
+
+            t0 = time.perf_counter()
+            r  = client.get('/api/flow/t0', headers={'Accept-Encoding': 'identity'})
+            cold = time.perf_counter() - t0
+            assert r.status_code == 200, r.text
+            body = r.json()
+            ref  = main.flow_columns(main.smart_money_flow('T0'))
+            assert body['columns']['time'] == ref['time'].tolist()
+            assert body['columns']['phase'] == ref['phase'].tolist()
+            assert np.allclose(body['columns']['rsx'], ref['rsx'], atol=10 ** -main.API_DECIMALS)
+            flow = np.array([np.nan if v is None else v for v in body['columns']['flow']])
+            assert np.allclose(flow, ref['flow'], atol=10 ** -main.API_DECIMALS, equal_nan=True)
+
+            gz = client.get('/api/flow/t0', headers={'Accept-Encoding': 'gzip'})
+            assert gz.headers['content-encoding'] == 'gzip' and gz.json() == body
+            etag = gz.headers['etag']
+            nm = client.get('/api/flow/t0', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+            assert nm.status_code == 304 and not nm.content
+            tail = client.get('/api/flow/t0?tail=5').json()['columns']
+            assert tail['time'] == body['columns']['time'][-5:]
+            assert client.get('/api/flow/t0?format=xml').status_code == 400
+            assert client.get('/api/flow/zz').status_code == 404
+            dist = client.get('/api/distribution').json()
+            assert dist['columns']['asset'] == ['t0'] and len(dist['columns']) == 2 + len(main.LEVEL_NAMES)
+            print("api: columns match flow_columns, gzip, ETag/304, tail, errors OK")
+
+            # сколько стоит опрос: 200 из кэша, 304, и тот же клиент через PNG-график
+            def per_call(fn, n=200):
+                t0 = time.perf_counter()
+                for _ in range(n):
+                    fn()
+                return (time.perf_counter() - t0) / n
+            t_200 = per_call(lambda: client.get('/api/flow/t0', headers={'Accept-Encoding': 'gzip'}))
+            t_304 = per_call(lambda: client.get('/api/flow/t0', headers={'Accept-Encoding': 'gzip',
+                                                                         'If-None-Match': etag}))
+            df    = main.compute_flow(dfs['T0'].copy())
+            t_png = per_call(lambda: main.make_chart(df, 'T0', perigees=[]), n=3)
+            png   = main.make_chart(df, 'T0', perigees=[]).getvalue()
+            print(f"api: first request (pools start) {cold * 1e3:6.1f} ms | cached 200 {t_200 * 1e3:5.2f} ms | "
+                  f"304 {t_304 * 1e3:5.2f} ms | make_chart {t_png * 1e3:6.1f} ms")
+            print(f"api: {len(body['columns']['time'])} bars: json {len(r.content) / 1e3:.1f} kB, "
+                  f"gzip {len(gzip.compress(r.content)) / 1e3:.1f} kB, 304 0 B | PNG {len(png) / 1e3:.1f} kB")
+            print(f"api: cache {main.api_cache.stats()}")
+    finally:
+        main.FUTURES.clear()
+        main.FUTURES.update(saved[0])
+        main._yf, main.bar_store, main.api_cache = saved[1:]
+        main.io_pool.shutdown()
+        main.cpu_pool.shutdown()
+
+
+SECTIONS = {
+    'rsx':        bench_rsx,
+    'flow_state': bench_flow_state,
+    'rank':       bench_rolling_rank,
+    'render':     bench_render,
+    'perigees':   bench_perigees,
+    'ema':        bench_adaptive_ema,
+    'panel':      bench_flow_panel,
+    'alerts':     bench_alerts,
+    'backtest':   bench_backtest,
+    'normalize':  bench_normalize,
+    'pipeline':   bench_pipeline,
+    'webhook':    bench_webhook,
+    'metrics':    bench_metrics,
+    'startup':    bench_startup,
+    'scheduler':  bench_scheduler,
+    'workers':    bench_workers,
+    'api':        bench_api,
+}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['suite']:
+        sys.exit(run_suite(sys.argv[2:]))
+    names = sys.argv[1:] or list(SECTIONS)
+    for name in names:
+        SECTIONS[name]()
@@ -0,0 +1,26 @@
+"""Пересчитывает таблицу перигеев perigees.txt для get_lunar_perigees.
+
+    python gen_perigees.py                 # 1990–2060
+    python gen_perigees.py 2000 2100
+"""
+import os
+import sys
+from datetime import datetime
+
+os.environ.setdefault("BOT_TOKEN", "0:offline")   # main.py требует токен при импорте
+import main
+
+
+def main_cli(argv):
+    first = int(argv[0]) if len(argv) > 0 else 1990
+    last  = int(argv[1]) if len(argv) > 1 else 2060
+    perigees = main.scan_perigees(datetime(first, 1, 1), datetime(last + 1, 1, 1))
+    with open(main.PERIGEE_TABLE_PATH, 'w') as f:
+        f.write(f"# Перигеи Луны {first}–{last}, UTC. Сгенерировано gen_perigees.py\n")
+        for p in perigees:
+            f.write(p.isoformat() + "\n")
+    print(f"{len(perigees)} перигеев → {main.PERIGEE_TABLE_PATH}")
+
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
@@ -1,17 +1,32 @@
 import io
 import os
+import re
+import sys
+import json
+import gzip
+import hashlib
+import hmac
+import time
+import socket
+import sqlite3
 import asyncio
-import yfinance as yf
+import threading
+import inspect
 import pandas as pd
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse
-from telegram import Update
+from fastapi.responses import Response
+from telegram import Update, InputMediaPhoto
+from telegram.error import BadRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
-from contextlib import asynccontextmanager
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial, lru_cache, wraps
+from collections import deque, OrderedDict, Counter
+from bisect import bisect_left, bisect_right, insort
+import multiprocessing
 from datetime import datetime, timezone, timedelta   # ✅ добавлен timedelta
 import logging
 
@@ -26,468 +41,3643 @@ if not TOKEN:
 URL     = "https://smartmoney-bot-ilqm.onrender.com"
 CHAT_ID = int(os.getenv("CHAT_ID", "0"))
 
+# Пулы исполнения: потоки — под загрузку yfinance, процессы — под matplotlib
+IO_WORKERS      = int(os.getenv("IO_WORKERS", "8"))
+CPU_WORKERS     = int(os.getenv("CPU_WORKERS", str(min(2, os.cpu_count() or 1))))
+IO_QUEUE_LIMIT  = int(os.getenv("IO_QUEUE_LIMIT", "32"))
+CPU_QUEUE_LIMIT = int(os.getenv("CPU_QUEUE_LIMIT", "16"))
+
+DATA_DIR        = os.getenv("DATA_DIR", "data")
+BAR_DB_PATH     = os.path.join(DATA_DIR, "bars.sqlite")
+PERIGEE_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "perigees.txt")
+BAR_CACHE_TTL   = int(os.getenv("BAR_CACHE_TTL", "300"))    # сек, сколько бары живут в памяти
+FETCH_RETRIES   = int(os.getenv("FETCH_RETRIES", "3"))
+FETCH_BACKOFF   = float(os.getenv("FETCH_BACKOFF", "2"))    # сек до первого повтора, дальше ×2
+
+# Интервалы баров: глубина загрузки в днях, ёмкость кольцевого буфера в памяти (баров)
+# и TTL в памяти (None — BAR_CACHE_TTL). yfinance отдаёт 1h за 730 дней, 15m/5m — за 60.
+INTERVALS = {
+    '1d':  {'days': 175, 'bars': 400,  'ttl': None},
+    '1h':  {'days': 30,  'bars': 1200, 'ttl': 300},
+    '15m': {'days': 10,  'bars': 1200, 'ttl': 120},
+    '5m':  {'days': 5,   'bars': 1600, 'ttl': 60},
+}
+DEFAULT_INTERVAL = '1d'
+
+# Нормировка smart A/D: window — min/max по всему загруженному окну (исходное поведение),
+# expanding / rolling — причинные: Flow прошлых баров не меняется с приходом новых
+AD_NORMALIZE   = os.getenv("AD_NORMALIZE", "window")
+AD_NORM_WINDOW = int(os.getenv("AD_NORM_WINDOW", "200"))
+
+# Алерты о пересечении порогов: интервал баров, частота опроса (0 — выключены)
+# и минимальная пауза между одинаковыми алертами в чат
+ALERT_INTERVAL  = os.getenv("ALERT_INTERVAL", "1h")
+ALERT_POLL_SEC  = int(os.getenv("ALERT_POLL_SEC", "300"))
+ALERT_DEBOUNCE  = int(os.getenv("ALERT_DEBOUNCE", "3600"))
+ALERT_SUBS_PATH = os.path.join(DATA_DIR, "alert_subs.json")
+
+# Планировщик: задачи с cron-расписанием (UTC) в SQLite. Общий файл базы — блокировка задачи
+# между воркерами uvicorn; пропущенный запуск догоняется, если опоздание не больше SCHEDULER_CATCHUP
+SCHEDULER_DB_PATH     = os.path.join(DATA_DIR, "scheduler.sqlite")
+SCHEDULER_POLL        = float(os.getenv("SCHEDULER_POLL", "30"))       # сек между проверками
+SCHEDULER_CATCHUP     = int(os.getenv("SCHEDULER_CATCHUP", "21600"))   # сек, 6 ч
+SCHEDULER_LEASE       = int(os.getenv("SCHEDULER_LEASE", "1800"))      # сек: и таймаут задачи
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "2"))   # задач одновременно в процессе
+DAILY_CRON  = os.getenv("DAILY_CRON", "0 3 * * *")
+DAILY_CHATS = [int(c) for c in os.getenv("DAILY_CHATS", "").split(',') if c.strip()]   # в дополнение к CHAT_ID
+
+# Рассылка одного и того же многим чатам: не больше FANOUT_CONCURRENCY отправок сразу,
+# каждая не дольше FANOUT_TIMEOUT — медленный или заблокировавший бота чат не держит остальных
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "8"))
+FANOUT_TIMEOUT     = float(os.getenv("FANOUT_TIMEOUT", "30"))
+
+# Бэктест: отдельная база с длинной историей (основная держит только interval_bars)
+HISTORY_DB_PATH = os.path.join(DATA_DIR, "history.sqlite")
+HISTORY_BARS    = int(os.getenv("HISTORY_BARS", "10000"))
+
+# Приём апдейтов: вебхук отвечает сразу, обработка — в фоне из ограниченной очереди;
+# лимит команд на чат — token bucket (CHAT_RATE команд в секунду, запас CHAT_BURST)
+UPDATE_WORKERS    = int(os.getenv("UPDATE_WORKERS", "4"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "256"))
+UPDATE_SEEN_TTL   = 3600                                    # сек: столько помним update_id для дедупликации
+CHAT_RATE         = float(os.getenv("CHAT_RATE", "0.2"))
+CHAT_BURST        = int(os.getenv("CHAT_BURST", "5"))
+
+# Несколько воркеров uvicorn (WEB_CONCURRENCY — его же число --workers) делят через
+# STATE_BACKEND дедуп апдейтов, лимиты чатов, PNG и file_id графиков, блокировки задач
+# и лидерство алертов: memory — один процесс, sqlite — воркеры одной машины, redis://… — несколько машин
+WEB_CONCURRENCY  = int(os.getenv("WEB_CONCURRENCY", "1"))
+STATE_BACKEND    = os.getenv("STATE_BACKEND", "sqlite" if WEB_CONCURRENCY > 1 else "memory")
+STATE_DB_PATH    = os.path.join(DATA_DIR, "state.sqlite")
+CHART_SHARED_TTL = int(os.getenv("CHART_SHARED_TTL", "86400"))   # сек жизни PNG и file_id в общем состоянии
+
+# Метрики: гистограммы стадий и /metrics (METRICS=0 — декораторы не оборачивают функции);
+# семплирующий профайлер включается через POST /debug/profile только при заданном PROFILE_TOKEN
+# (передаётся в заголовке X-Profile-Token)
+METRICS_ENABLED = os.getenv("METRICS", "1") != "0"
+LOOP_LAG_EVERY  = float(os.getenv("LOOP_LAG_EVERY", "1"))   # сек между замерами задержки event loop
+PROFILE_TOKEN   = os.getenv("PROFILE_TOKEN", "")
+
+UNIVERSE_SHARD_SIZE = int(os.getenv("UNIVERSE_SHARD_SIZE", "25"))   # тикеров на одну групповую загрузку
+DIST_PAGE_SIZE      = int(os.getenv("DIST_PAGE_SIZE", "8"))         # активов на одной странице /dist
+
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "64"))
+CHART_CACHE_DIR  = os.getenv("CHART_CACHE_DIR", "")         # пусто — кэш только в памяти
+CHART_VERSION    = 2                                        # менять при изменении вида графиков
+CHART_RENDERER   = os.getenv("CHART_RENDERER", "agg")       # ключ RENDERERS
+
+# /api: Flow, RSX, фазы и распределение в json / msgpack / arrow (последние два — если
+# установлены msgpack / pyarrow); ответы кэшируются на время жизни баров
+API_CACHE_SIZE = int(os.getenv("API_CACHE_SIZE", "256"))    # запросов (актив, интервал) в памяти
+API_DECIMALS   = int(os.getenv("API_DECIMALS", "3"))        # знаков после запятой в json / msgpack
+API_GZIP_MIN   = 1024                                       # байт: меньшие ответы не сжимаются
+API_GZIP_LEVEL = 6
+
 # --- Telegram Bot ---
 bot_app = ApplicationBuilder().token(TOKEN).build()
 
-FUTURES = {
+DEFAULT_FUTURES = {
     'gc': 'GC=F', 'cl': 'CL=F', 'pl': 'PL=F',
     '6e': '6E=F', '6j': '6J=F', 'dx': 'DX=F'
 }
+RESERVED_COMMANDS = {'dist', 'all', 'start', 'help', 'subscribe', 'unsubscribe'}
+
+
+def load_universe() -> dict:
+    """{команда: тикер} из UNIVERSE_FILE (JSON-объект) или UNIVERSE ("gc=GC=F,aapl=AAPL").
+
+    Без настроек — DEFAULT_FUTURES. Команды, недопустимые для Telegram, пропускаются.
+    """
+    raw = {}
+    path = os.getenv("UNIVERSE_FILE")
+    if path:
+        with open(path) as f:
+            raw = json.load(f)
+    elif os.getenv("UNIVERSE"):
+        for item in os.getenv("UNIVERSE").split(','):
+            cmd, _, ticker = item.strip().partition('=')
+            if ticker:
+                raw[cmd] = ticker
+    if not raw:
+        return dict(DEFAULT_FUTURES)
+
+    universe = {}
+    for cmd, ticker in raw.items():
+        cmd = str(cmd).strip().lower()
+        if not re.fullmatch(r'[a-z0-9_]{1,32}', cmd) or cmd in RESERVED_COMMANDS:
+            logger.warning(f"Пропускаем команду /{cmd} ({ticker}): недопустимое имя")
+            continue
+        universe[cmd] = str(ticker).strip()
+    return universe
+
+
+FUTURES = load_universe()
+
+
+# ────────────────────────────────────────────────
+# Метрики и профилирование
+# ────────────────────────────────────────────────
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """Накопительная гистограмма в формате Prometheus (границы le, сумма, число)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts  = [0] * (len(buckets) + 1)     # последний — +Inf
+        self.sum     = 0.0
+        self.count   = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+
+class Metrics:
+    """Гистограммы и счётчики с метками; пишутся из event loop и из потоков io_pool.
+
+    В процессе cpu_pool замеры на время задачи копятся в capture и возвращаются вместе
+    с результатом — пул вливает их в метрики основного процесса (merge).
+    """
+
+    def __init__(self):
+        self._lock     = threading.Lock()
+        self._hist     = {}                 # (имя, метки) → Histogram
+        self._counters = Counter()          # (имя, метки) → значение
+        self.loop_lag  = None               # последний замер watch_loop_lag, сек
+        self.capture   = None               # список замеров задачи в процессе cpu_pool
+
+    def observe(self, name, value, **labels):
+        if self.capture is not None:
+            self.capture.append(('observe', name, value, labels))
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._hist.get(key)
+            if hist is None:
+                hist = self._hist[key] = Histogram()
+            hist.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        if self.capture is not None:
+            self.capture.append(('inc', name, value, labels))
+            return
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def merge(self, samples):
+        """Замеры, собранные в capture другого процесса."""
+        for kind, name, value, labels in samples:
+            getattr(self, kind)(name, value, **labels)
+
+    def histogram(self, name, **labels):
+        return self._hist.get((name, tuple(sorted(labels.items()))))
+
+    def render(self, gauges=()) -> str:
+        """Текстовый формат Prometheus; gauges — [(имя, тип, метки, значение)], снятые при запросе."""
+        lines, typed = [], set()
+
+        def sample(name, kind, labels, value):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{_labels(labels)} {value:g}")
+
+        with self._lock:
+            hists    = sorted((k, (list(h.counts), h.sum, h.count)) for k, h in self._hist.items())
+            counters = sorted(self._counters.items())
+        for (name, labels), value in counters:
+            sample(name, 'counter', labels, value)
+        for (name, labels), (counts, total, count) in hists:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cum = 0
+            for le, n in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                cum += n
+                lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cum}")
+            lines.append(f"{name}_sum{_labels(labels)} {total:g}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        # сэмплы одной метрики должны идти подряд
+        for name, kind, labels, value in sorted(gauges, key=lambda g: g[0]):
+            if value is not None:
+                sample(name, kind, tuple(labels.items()), value)
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+metrics = Metrics()
+
+
+class _Span:
+    __slots__ = ('stage', 't0')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        metrics.observe('smartmoney_stage_seconds', time.perf_counter() - self.t0, stage=self.stage)
+        if exc_type is not None:
+            metrics.inc('smartmoney_stage_errors_total', stage=self.stage)
+
+
+_NO_SPAN = nullcontext()
+
+
+def span(stage: str):
+    """with span('savefig'): ... — время участка в smartmoney_stage_seconds{stage}."""
+    return _Span(stage) if METRICS_ENABLED else _NO_SPAN
+
+
+def timed(stage: str):
+    """Декоратор span для функции; при METRICS=0 возвращает её саму, без обёртки.
+
+    В процессах cpu_pool замеры собираются в задаче и попадают в /metrics через пул (_traced).
+    """
+    def decorate(fn):
+        if not METRICS_ENABLED:
+            return fn
+        if asyncio.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with _Span(stage):
+                    return await fn(*args, **kwargs)
+        else:
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with _Span(stage):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+async def watch_loop_lag(every=LOOP_LAG_EVERY):
+    """Задержка event loop: насколько позже заказанного просыпается sleep(every)."""
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(every)
+        lag = max(0.0, loop.time() - t0 - every)
+        metrics.loop_lag = lag
+        metrics.observe('smartmoney_loop_lag_seconds', lag)
+
+
+class SamplingProfiler:
+    """Семплирующий профайлер: раз в interval снимает стеки всех потоков (кроме своего)
+    и копит их в collapsed-формате (flamegraph.pl, speedscope). Включается на ходу."""
+
+    def __init__(self, max_depth=64):
+        self.max_depth = max_depth
+        self.stacks    = Counter()
+        self.samples   = 0
+        self.interval  = None
+        self._stop     = threading.Event()
+        self._thread   = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval=0.01):
+        if self.running:
+            return
+        self.stacks, self.samples, self.interval = Counter(), 0, interval
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        me    = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def report(self) -> str:
+        return ''.join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+profiler = SamplingProfiler()
+
+
+# ────────────────────────────────────────────────
+# Общее состояние воркеров: ключ-значение с TTL
+# ────────────────────────────────────────────────
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _as_bytes(value) -> bytes:
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+class MemoryState:
+    """Ключ-значение с TTL в памяти процесса — для одного воркера и как заглушка Redis.
+
+    Интерфейс общий для всех бэкендов (подмножество Redis): get, set, add (SET NX),
+    renew (продление TTL своего значения), incr, delete. Значения — bytes, TTL — секунды.
+    """
+
+    shared   = False
+    blocking = False        # см. off_loop
+    name     = 'memory'
+
+    def __init__(self, max_keys=100_000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock    = clock
+        self._data    = OrderedDict()       # ключ → (значение, истекает или None)
+        self._lock    = threading.Lock()
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] <= self.clock():
+            del self._data[key]
+            return None
+        return item
+
+    def _store(self, key, value, ttl):
+        self._data[key] = (value, None if ttl is None else self.clock() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_keys:
+            self._data.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key)
+            return None if item is None else item[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, _as_bytes(value), ttl)
+
+    def add(self, key, value, ttl=None) -> bool:
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._store(key, _as_bytes(value), ttl)
+            return True
+
+    def renew(self, key, value, ttl) -> bool:
+        """Новый TTL ключу, только если в нём всё ещё value — атомарный compare-and-set."""
+        with self._lock:
+            item = self._live(key)
+            if item is None or item[0] != _as_bytes(value):
+                return False
+            self._store(key, item[0], ttl)
+            return True
+
+    def incr(self, key, ttl=None) -> int:
+        """+1 к счётчику; TTL ставится при создании ключа, как INCR + EXPIRE NX."""
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                self._store(key, b'1', ttl)
+                return 1
+            value = int(item[0]) + 1
+            self._data[key] = (str(value).encode(), item[1])
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SQLiteState:
+    """Тот же интерфейс поверх файла SQLite: общий для воркеров uvicorn на одной машине."""
+
+    shared   = True
+    blocking = True
+    name     = 'sqlite'
+
+    PRUNE_EVERY = 1000      # записей между удалениями истёкших ключей
+
+    def __init__(self, path, clock=time.time):
+        self.path    = path
+        self.clock   = clock
+        self._local  = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+            self._local.conn = conn
+        return conn
+
+    def _expires(self, ttl):
+        return None if ttl is None else self.clock() + ttl
+
+    def _write(self, fn):
+        """fn(conn, now) в транзакции BEGIN IMMEDIATE — атомарно относительно других процессов."""
+        conn = self._conn()
+        now  = self.clock()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, now)
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM kv WHERE expires <= ?", (now,))
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, self.clock()),
+        ).fetchone()
+        return None if row is None else _as_bytes(row[0])
+
+    def set(self, key, value, ttl=None):
+        self._write(lambda conn, now: conn.execute(
+            "INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, _as_bytes(value), self._expires(ttl))))
+
+    def add(self, key, value, ttl=None) -> bool:
+        def add(conn, now):
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires <= ?", (key, now))
+            return conn.execute("INSERT OR IGNORE INTO kv VALUES (?, ?, ?)",
+                                (key, _as_bytes(value), self._expires(ttl))).rowcount == 1
+        return self._write(add)
+
+    def renew(self, key, value, ttl) -> bool:
+        return self._write(lambda conn, now: conn.execute(
+            "UPDATE kv SET expires = ? WHERE key = ? AND value = ? AND (expires IS NULL OR expires > ?)",
+            (self._expires(ttl), key, _as_bytes(value), now)).rowcount == 1)
+
+    def incr(self, key, ttl=None) -> int:
+        def incr(conn, now):
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires <= ?", (key, now))
+            conn.execute("INSERT INTO kv VALUES (?, '0', ?) ON CONFLICT(key) DO NOTHING", (key, self._expires(ttl)))
+            conn.execute("UPDATE kv SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT) WHERE key = ?", (key,))
+            return int(conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()[0])
+        return self._write(incr)
+
+    def delete(self, key):
+        self._write(lambda conn, now: conn.execute("DELETE FROM kv WHERE key = ?", (key,)))
+
+
+class RedisState:
+    """Тот же интерфейс поверх Redis (или совместимого сервера) — общий и между машинами.
+
+    Пакет redis необязателен: импортируется только при STATE_BACKEND=redis://…
+    """
+
+    shared   = True
+    blocking = True
+    name     = 'redis'
+
+    def __init__(self, url, client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.url    = url
+        self.client = client
+
+    @staticmethod
+    def _px(ttl):
+        return None if ttl is None else max(1, int(ttl * 1000))
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, _as_bytes(value), px=self._px(ttl))
+
+    def add(self, key, value, ttl=None) -> bool:
+        return bool(self.client.set(key, _as_bytes(value), px=self._px(ttl), nx=True))
+
+    # GET и PEXPIRE одним скриптом: между сравнением и продлением ключ не перехватить
+    RENEW_SCRIPT = ("if redis.call('GET', KEYS[1]) == ARGV[1] then "
+                    "return redis.call('PEXPIRE', KEYS[1], ARGV[2]) end return 0")
+
+    def renew(self, key, value, ttl) -> bool:
+        return bool(self.client.eval(self.RENEW_SCRIPT, 1, key, _as_bytes(value), self._px(ttl)))
+
+    def incr(self, key, ttl=None) -> int:
+        value = self.client.incr(key)
+        if value == 1 and ttl is not None:
+            self.client.pexpire(key, self._px(ttl))
+        return value
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+def make_state(spec: str):
+    """memory | sqlite | sqlite:путь | redis://… | rediss://…"""
+    if spec == 'memory':
+        return MemoryState()
+    if spec == 'sqlite' or spec.startswith('sqlite:'):
+        return SQLiteState(spec.partition(':')[2] or STATE_DB_PATH)
+    if spec.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisState(spec)
+    raise ValueError(f"Unknown STATE_BACKEND {spec!r}")
+
+
+def hold_lease(state, name, owner=WORKER_ID, ttl=60) -> bool:
+    """Аренда name на ttl секунд: True, если она у owner (взята или продлена).
+
+    Продление — renew, атомарный compare-and-set: аренду, которую между проверкой и
+    записью успел взять другой воркер, не перезаписать.
+    """
+    return state.add(name, owner, ttl) or state.renew(name, owner, ttl)
+
+
+shared_state = make_state(STATE_BACKEND)
+
+
+# ────────────────────────────────────────────────
+# Пулы исполнения вне event loop
+# ────────────────────────────────────────────────
+class PoolBusy(RuntimeError):
+    pass
+
+
+def _traced(fn, *args, **kwargs):
+    """Вызов fn в процессе пула: (результат, замеры span/timed за время вызова)."""
+    metrics.capture = []
+    try:
+        return fn(*args, **kwargs), metrics.capture
+    finally:
+        metrics.capture = None
+
+
+class WorkerPool:
+    """Не больше limit задач в работе и не больше max_queue в ожидании."""
+
+    def __init__(self, name, make_executor, limit, max_queue, traced=False):
+        self.name           = name
+        self.traced         = traced and METRICS_ENABLED    # задачи в другом процессе: замеры — через _traced
+        self.limit          = limit
+        self.max_queue      = max_queue
+        self._make_executor = make_executor
+        self._executor      = None
+        self._sem           = asyncio.Semaphore(limit)
+        self.waiting   = 0
+        self.active    = 0
+        self.completed = 0
+        self.failed    = 0
+        self.rejected  = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = self._make_executor()
+        return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise PoolBusy(f"Server is busy ({self.name} queue full), try again later")
+        self.waiting += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        t0 = time.perf_counter()
+        try:
+            loop   = asyncio.get_running_loop()
+            if self.traced:
+                result, samples = await loop.run_in_executor(self._get_executor(),
+                                                             partial(_traced, fn, *args, **kwargs))
+                metrics.merge(samples)
+            else:
+                result = await loop.run_in_executor(self._get_executor(), partial(fn, *args, **kwargs))
+        except BrokenProcessPool:
+            # упавший воркер ломает весь ProcessPoolExecutor — пересоздаём при следующем вызове
+            self.failed   += 1
+            self._executor = None
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.active -= 1
+            self._sem.release()
+            if METRICS_ENABLED:
+                metrics.observe('smartmoney_pool_task_seconds', time.perf_counter() - t0,
+                                pool=self.name, fn=getattr(fn, '__name__', '?'))
+        self.completed += 1
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "limit":     self.limit,
+            "max_queue": self.max_queue,
+            "active":    self.active,
+            "waiting":   self.waiting,
+            "completed": self.completed,
+            "failed":    self.failed,
+            "rejected":  self.rejected,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+io_pool = WorkerPool(
+    "io", lambda: ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io"),
+    limit=IO_WORKERS, max_queue=IO_QUEUE_LIMIT,
+)
+# spawn, а не fork: форк процесса с работающим event loop и потоками небезопасен
+cpu_pool = WorkerPool(
+    "cpu", lambda: ProcessPoolExecutor(max_workers=CPU_WORKERS,
+                                       mp_context=multiprocessing.get_context("spawn")),
+    limit=CPU_WORKERS, max_queue=CPU_QUEUE_LIMIT, traced=True,
+)
+
+
+async def off_loop(obj, fn, *args):
+    """fn(*args) — метод obj: если obj.blocking (SQLite, Redis, диск), то в io_pool,
+    чтобы транзакция или сетевой запрос не держали event loop; иначе — сразу."""
+    if obj.blocking:
+        return await io_pool.run(fn, *args)
+    return fn(*args)
+
+
+# ────────────────────────────────────────────────
+# Лунные перигеи
+# ────────────────────────────────────────────────
+def scan_perigees(start, end) -> list:
+    """Перигеи Луны между start и end (UTC): шаг 0.5 суток + тернарный поиск минимума."""
+    import ephem
+    moon  = ephem.Moon()
+    start = pd.Timestamp(start)
+    end   = pd.Timestamp(end)
+
+    def dist(d):
+        moon.compute(d)
+        return moon.earth_distance
+
+    perigees = []
+    date   = ephem.Date(start.to_pydatetime()) - 0.5
+    stop   = ephem.Date(end.to_pydatetime()) + 0.5
+    d0, d1 = dist(date - 0.5), dist(date)
+    while date < stop:
+        nxt = date + 0.5
+        d2  = dist(nxt)
+        if d1 < d0 and d1 <= d2:
+            # минимум где-то в [date - 0.5, date + 0.5]
+            lo, hi = date - 0.5, nxt
+            for _ in range(30):
+                m1 = lo + (hi - lo) / 3
+                m2 = lo + (hi - lo) * 2 / 3
+                if dist(m1) < dist(m2):
+                    hi = m2
+                else:
+                    lo = m1
+            p = pd.Timestamp(ephem.Date((lo + hi) / 2).datetime()).round('s')
+            if start <= p <= end and (not perigees or (p - perigees[-1]).days > 20):
+                perigees.append(p)
+        date, d0, d1 = nxt, d1, d2
+    return perigees
+
+
+def load_perigee_table(path=None) -> list:
+    path = path or PERIGEE_TABLE_PATH
+    try:
+        with open(path) as f:
+            return [pd.Timestamp(line.strip()) for line in f if line.strip() and not line.startswith('#')]
+    except FileNotFoundError:
+        return []
+
+
+@lru_cache(maxsize=1)
+def _perigee_table() -> tuple:
+    return tuple(load_perigee_table())
+
+
+@lru_cache(maxsize=8)
+def _scan_perigees_cached(first_day, last_day) -> tuple:
+    try:
+        return tuple(scan_perigees(first_day - timedelta(days=30), last_day))
+    except ImportError:
+        return ()
+
+
+@timed('perigees')
+def get_lunar_perigees(days_back: int = 175) -> list:
+    """Возвращает даты перигеев за последние days_back дней + один следующий."""
+    now    = pd.Timestamp(datetime.now())
+    cutoff = now - pd.Timedelta(days=days_back)
+    table  = _perigee_table()
+    if not table or table[0] > cutoff or table[-1] < now + pd.Timedelta(days=35):
+        # таблица не покрывает период — считаем его сами (один раз на дату)
+        table = _scan_perigees_cached(cutoff.date(), (now + pd.Timedelta(days=35)).date())
+    i = bisect_left(table, cutoff)
+    j = bisect_right(table, now)
+    return list(table[i:j + 1])
+
+
+# ────────────────────────────────────────────────
+# Скользящий ранг (перцентиль) окна
+# ────────────────────────────────────────────────
+RANK_VECTOR_MAX_WINDOW = 800        # до этого окна sliding_window_view быстрее sorted-окна
+RANK_CHUNK_CELLS       = 4_000_000  # ограничение на размер временной матрицы сравнений
+
+
+def rolling_rank_pct(values, window: int) -> np.ndarray:
+    """Доля первых window-1 значений окна строго меньше последнего, в процентах.
+
+    То же, что rolling(window).apply(lambda x: (x[:-1] < x[-1]).sum() / (len(x) - 1) * 100),
+    включая NaN до заполнения окна и в окнах, где встречается NaN.
+    """
+    if window < 2:
+        raise ValueError("window must be >= 2")
+    x   = np.asarray(values, dtype=float)
+    n   = len(x)
+    out = np.full(n, np.nan)
+    if n < window:
+        return out
+    nan_mask = np.isnan(x)
+    if window <= RANK_VECTOR_MAX_WINDOW:
+        counts = _rank_counts_vectorized(x, window)
+    else:
+        counts = _rank_counts_sorted(np.where(nan_mask, 0.0, x), window)
+    out[window - 1:] = counts / (window - 1) * 100
+    if nan_mask.any():
+        csum = np.concatenate(([0], np.cumsum(nan_mask)))
+        out[window - 1:][csum[window:] - csum[:-window] > 0] = np.nan
+    return out
+
+
+def _rank_counts_vectorized(x: np.ndarray, window: int) -> np.ndarray:
+    from numpy.lib.stride_tricks import sliding_window_view
+    win    = sliding_window_view(x, window)
+    counts = np.empty(len(win), dtype=np.int64)
+    step   = max(1, RANK_CHUNK_CELLS // window)
+    for start in range(0, len(win), step):
+        w = win[start:start + step]
+        counts[start:start + step] = (w[:, :-1] < w[:, -1:]).sum(axis=1)
+    return counts
+
+
+def _rank_counts_sorted(x: np.ndarray, window: int) -> np.ndarray:
+    vals   = x.tolist()
+    prev   = sorted(vals[:window - 1])      # предыдущие window-1 значений
+    counts = np.empty(len(vals) - window + 1, dtype=np.int64)
+    for j, i in enumerate(range(window - 1, len(vals))):
+        cur       = vals[i]
+        counts[j] = bisect_left(prev, cur)
+        del prev[bisect_left(prev, vals[i - window + 1])]
+        insort(prev, cur)
+    return counts
+
+
+# ────────────────────────────────────────────────
+# EMA с переменным alpha
+# ────────────────────────────────────────────────
+EMA_CHUNK = 64      # длина блока: произведение (1 - alpha) внутри блока не уходит в денормалы
+
+
+def adaptive_ema(values, alphas, chunk: int = EMA_CHUNK) -> np.ndarray:
+    """y[0] = x[0], y[i] = a[i] * x[i] + (1 - a[i]) * y[i-1] — по оси 0, для 1-D и 2-D.
+
+    Внутри блока рекурсия разворачивается через cumprod/cumsum с нормировкой на
+    произведение (1 - a) с начала блока; между блоками переносится только последнее
+    значение. Если 1 - a слишком мало для такой нормировки — обычный цикл.
+    """
+    x = np.asarray(values, dtype=float)
+    a = np.broadcast_to(np.asarray(alphas, dtype=float), x.shape)
+    n = len(x)
+    if n == 0:
+        return x.copy()
+    decay = 1.0 - a[1:]
+    if n == 1 or decay.min() < 1e-4:
+        return _adaptive_ema_loop(x, a)
+
+    tail   = x.shape[1:]
+    m      = n - 1
+    blocks = -(-m // chunk)
+    pad    = blocks * chunk - m
+    # хвост добиваем a = 0: такие шаги просто переносят значение дальше
+    d  = np.concatenate([decay, np.ones((pad,) + tail)]).reshape((blocks, chunk) + tail)
+    ax = np.concatenate([a[1:] * x[1:], np.zeros((pad,) + tail)]).reshape((blocks, chunk) + tail)
+
+    q     = np.cumprod(d, axis=1)
+    local = q * np.cumsum(ax / q, axis=1)   # решение блока при нулевом входном значении
+
+    carry = np.empty((blocks,) + tail)
+    c = x[0]
+    for b in range(blocks):
+        carry[b] = c
+        c = q[b, -1] * c + local[b, -1]
+
+    y = local + q * carry[:, None]
+    return np.concatenate([x[:1], y.reshape((blocks * chunk,) + tail)[:m]])
+
+
+def _adaptive_ema_loop(x: np.ndarray, a: np.ndarray) -> np.ndarray:
+    y = np.empty_like(x)
+    y[0] = x[0]
+    for i in range(1, len(x)):
+        y[i] = a[i] * x[i] + (1 - a[i]) * y[i - 1]
+    return y
+
+
+# ────────────────────────────────────────────────
+# Локальный кэш баров (SQLite + TTL в памяти)
+# ────────────────────────────────────────────────
+OHLCV_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+
+def _yf():
+    """yfinance импортируется при первой загрузке, а не при старте: он один — заметная доля
+    холодного старта, а процессам cpu_pool не нужен вовсе."""
+    import yfinance
+    return yfinance
+
+
+@timed('fetch')
+def _yf_download(symbols, **kwargs) -> dict:
+    """Одна групповая загрузка; возвращает {symbol: DataFrame} только для символов с данными."""
+    df = _yf().download(list(symbols), progress=False, auto_adjust=True,
+                     group_by='ticker', threads=True, **kwargs)
+    if df is None or len(df) == 0:
+        return {}
+    if getattr(df.index, 'tz', None) is not None:
+        # внутридневные — в UTC: yfinance отдаёт индекс в поясе, преобладающем в группе,
+        # и без перевода время бара зависело бы от того, с какими символами его качали;
+        # дневные — дата сессии (полночь по бирже), в UTC она съехала бы на 04:00–05:00
+        daily    = kwargs.get('interval', DEFAULT_INTERVAL) == DEFAULT_INTERVAL
+        df.index = (df.index if daily else df.index.tz_convert('UTC')).tz_localize(None)
+    out = {}
+    for sym in symbols:
+        if isinstance(df.columns, pd.MultiIndex):
+            if sym not in df.columns.get_level_values(0):
+                continue
+            part = df[sym]
+        else:
+            part = df
+        part = part[OHLCV_COLUMNS].dropna(how='all')
+        if len(part):
+            out[sym] = part
+    return out
+
+
+class BarRing:
+    """Последние capacity баров одного символа в кольцевом буфере.
+
+    Столбцы компактные: время — int64 (нс), OHLC — float32, объём — int64. Память
+    фиксирована при создании и не растёт, сколько бы баров ни пришло.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ts     = np.zeros(capacity, dtype=np.int64)
+        self.prices = np.zeros((capacity, 4), dtype=np.float32)
+        self.volume = np.zeros(capacity, dtype=np.int64)
+        self.head   = 0
+        self.size   = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        return self.ts.nbytes + self.prices.nbytes + self.volume.nbytes
+
+    def _order(self) -> np.ndarray:
+        return (self.head + np.arange(self.size)) % self.capacity
+
+    def first_time(self) -> pd.Timestamp:
+        return pd.Timestamp(int(self.ts[self.head]))
+
+    def last_time(self) -> pd.Timestamp:
+        return pd.Timestamp(int(self.ts[(self.head + self.size - 1) % self.capacity]))
+
+    def extend(self, df):
+        """Добавляет бары df; бары буфера с того же времени и позже заменяются."""
+        df = df[OHLCV_COLUMNS].iloc[-self.capacity:]
+        if not len(df):
+            return
+        ts = df.index.values.astype('datetime64[ns]').view(np.int64)
+        if self.size:
+            self.size = int(np.searchsorted(self.ts[self._order()], ts[0], side='left'))
+        pos = (self.head + self.size + np.arange(len(ts))) % self.capacity
+        self.ts[pos]     = ts
+        self.prices[pos] = df[OHLCV_COLUMNS[:4]].to_numpy(dtype=np.float32)
+        self.volume[pos] = np.nan_to_num(df['Volume'].to_numpy(dtype=float)).astype(np.int64)
+        self.size += len(ts)
+        if self.size > self.capacity:
+            self.head = (self.head + self.size - self.capacity) % self.capacity
+            self.size = self.capacity
+
+    def frame(self) -> pd.DataFrame:
+        """Бары в порядке времени — DataFrame float64 для расчётов."""
+        order = self._order()
+        data  = np.column_stack([self.prices[order].astype(float), self.volume[order].astype(float)])
+        return pd.DataFrame(data, columns=OHLCV_COLUMNS, index=pd.to_datetime(self.ts[order]))
+
+
+def interval_bars(interval) -> int:
+    return INTERVALS.get(interval, INTERVALS[DEFAULT_INTERVAL])['bars']
+
+
+class BarStore:
+    """Бары по (symbol, interval) в SQLite, поверх — TTL-кэш в памяти.
+
+    В памяти и на диске хранится не больше capacity (по умолчанию interval_bars(interval))
+    последних баров на символ: в памяти — BarRing, в SQLite старые строки удаляются
+    при сохранении.
+
+    При промахе докачивает только бары с последнего сохранённого (с перекрытием
+    TOPUP_OVERLAP_DAYS — последний бар мог быть незакрытым); не загрузившийся символ
+    повторяется, и только после всех попыток отдаются сохранённые бары. Параллельные запросы
+    одного символа ждут одну загрузку. Если символ недавно (в пределах TTL) обновил
+    другой процесс с тем же файлом базы, бары читаются из неё без загрузки.
+    """
+
+    TOPUP_OVERLAP_DAYS = 5          # для внутридневных интервалов — сутки
+
+    def __init__(self, path, ttl, capacity=None):
+        self.path         = path
+        self.ttl          = ttl
+        self.capacity     = capacity
+        self._mem         = {}
+        self._locks       = {}
+        self._locks_guard = threading.Lock()
+        self._local       = threading.local()
+        self.hits      = 0
+        self.misses    = 0
+        self.downloads = 0
+        self.topups    = 0
+        self.failures  = 0
+        self.peer_hits = 0
+        self.stale     = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS bars ("
+                " symbol TEXT, interval TEXT, ts INTEGER,"
+                " open REAL, high REAL, low REAL, close REAL, volume REAL,"
+                " PRIMARY KEY (symbol, interval, ts))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS refreshed ("
+                " symbol TEXT, interval TEXT, at REAL, PRIMARY KEY (symbol, interval))"
+            )
+            if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+                # до версии 1 внутридневные бары хранились во времени биржи, теперь — в UTC:
+                # старые строки смешались бы с новыми со сдвигом, их проще скачать заново
+                with conn:
+                    conn.execute("DELETE FROM bars WHERE interval != ?", (DEFAULT_INTERVAL,))
+                    conn.execute("DELETE FROM refreshed WHERE interval != ?", (DEFAULT_INTERVAL,))
+                conn.execute("PRAGMA user_version = 1")
+            self._local.conn = conn
+        return conn
+
+    def _capacity(self, interval) -> int:
+        return self.capacity or interval_bars(interval)
+
+    def _lock_for(self, key):
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def load(self, symbol, interval=DEFAULT_INTERVAL):
+        """BarRing с последними сохранёнными барами или None."""
+        rows = self._conn().execute(
+            "SELECT ts, open, high, low, close, volume FROM bars"
+            " WHERE symbol = ? AND interval = ? ORDER BY ts DESC LIMIT ?",
+            (symbol, interval, self._capacity(interval)),
+        ).fetchall()
+        if not rows:
+            return None
+        arr  = np.array(rows[::-1], dtype=float)
+        ring = BarRing(self._capacity(interval))
+        ring.extend(pd.DataFrame(arr[:, 1:], columns=OHLCV_COLUMNS,
+                                 index=pd.to_datetime(arr[:, 0].astype(np.int64))))
+        return ring
+
+    def save(self, symbol, interval, df, keep_from=None):
+        """Сохраняет бары df; строки старше keep_from (Timestamp) удаляются."""
+        df   = df[OHLCV_COLUMNS].dropna(how='all')
+        rows = [(symbol, interval, int(ts.value), *map(float, vals))
+                for ts, vals in zip(df.index, df.values)]
+        conn = self._conn()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            if keep_from is not None:
+                conn.execute("DELETE FROM bars WHERE symbol = ? AND interval = ? AND ts < ?",
+                             (symbol, interval, int(keep_from.value)))
+
+    def get(self, symbol, days=None, interval=DEFAULT_INTERVAL):
+        return self.get_many([symbol], days, interval, retries=1)[symbol]
+
+    def get_many(self, symbols, days=None, interval=DEFAULT_INTERVAL, retries=None) -> dict:
+        """Бары для нескольких символов: промахи кэша качаются одним групповым запросом,
+        повторяются только упавшие символы — каждый со своей экспоненциальной паузой.
+        Ошибка загрузки поднимается, только если ни для одного упавшего символа нет
+        даже сохранённых баров."""
+        if interval not in INTERVALS:
+            raise ValueError(f"unsupported interval {interval!r}")
+        days    = INTERVALS[interval]['days'] if days is None else days
+        retries = max(1, FETCH_RETRIES if retries is None else retries)
+        out     = {}
+        missing = []
+        for sym in dict.fromkeys(symbols):
+            df = self._cached((sym, interval))
+            if df is None:
+                missing.append(sym)
+            else:
+                self.hits += 1
+                out[sym] = df
+
+        # блокировки берутся в одном порядке, чтобы пересекающиеся get_many не зависли;
+        # символ отпускается, как только для него есть ответ, а не после повторов остальных
+        held = {sym: self._lock_for((sym, interval)) for sym in sorted(missing)}
+        for lock in held.values():
+            lock.acquire()
+
+        def settle(syms):
+            for sym in syms:
+                held.pop(sym).release()
+        try:
+            pending = []
+            for sym in missing:
+                df = self._cached((sym, interval))
+                if df is None:
+                    pending.append(sym)
+                else:
+                    self.hits += 1
+                    out[sym] = df
+            if pending:
+                peers    = self._from_peers(pending, interval)
+                pending  = [sym for sym in pending if sym not in peers]
+                self.hits      += len(peers)
+                self.peer_hits += len(peers)
+                out.update(peers)
+            settle([sym for sym in missing if sym in out])
+            self.misses += len(pending)
+
+            # у каждого символа свои попытки и пауза; символы, чей срок подошёл, качаются вместе
+            left  = dict.fromkeys(pending, retries)
+            delay = dict.fromkeys(pending, FETCH_BACKOFF)
+            due   = dict.fromkeys(pending, time.monotonic())
+            error = None
+            while left:
+                wait = min(due.values()) - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                now   = time.monotonic()
+                batch = [sym for sym in left if due[sym] <= now]
+                try:
+                    out.update(self._refresh_many(batch, interval, days))
+                except Exception as e:
+                    error = e
+                    logger.warning(f"Ошибка загрузки {batch}: {e}")
+                settle([sym for sym in batch if sym in out])
+                for sym in batch:
+                    if sym in out:
+                        del left[sym], due[sym]
+                        continue
+                    self.failures += 1
+                    left[sym] -= 1
+                    if not left[sym]:
+                        del left[sym], due[sym]
+                        continue
+                    logger.warning(f"Повтор загрузки {sym} через {delay[sym]:g} сек")
+                    due[sym]    = now + delay[sym]
+                    delay[sym] *= 2
+            failed = [sym for sym in pending if sym not in out]
+            for sym in failed:
+                # повторы исчерпаны: сохранённые бары лучше, чем ничего, но свежими они
+                # не считаются — ни в кэше памяти, ни для других процессов (refreshed)
+                ring = self._stored(sym, interval)
+                if ring is not None:
+                    logger.warning(f"{sym}: загрузка не удалась, отдаю бары до {ring.last_time()}")
+                    self.stale += 1
+                    out[sym] = ring.frame()
+            if error is not None and failed and not any(sym in out for sym in failed):
+                raise error
+        finally:
+            settle(list(held))
+
+        cutoff = pd.Timestamp(datetime.now()) - pd.Timedelta(days=days)
+        return {
+            sym: out[sym][out[sym].index >= cutoff].copy() if sym in out else None
+            for sym in symbols
+        }
+
+    def _cached(self, key):
+        hit = self._mem.get(key)
+        if hit is not None and hit[0] > time.monotonic():
+            return hit[1].frame()
+        return None
+
+    def _from_peers(self, symbols, interval) -> dict:
+        """Бары символов, которые другой процесс обновил меньше TTL назад: {символ: df}."""
+        ttl  = self._ttl(interval)
+        now  = time.time()
+        rows = self._conn().execute(
+            "SELECT symbol, at FROM refreshed WHERE interval = ? AND at > ?"
+            f" AND symbol IN ({','.join('?' * len(symbols))})",
+            (interval, now - ttl, *symbols),
+        ).fetchall()
+        out = {}
+        for sym, at in rows:
+            ring = self.load(sym, interval)
+            if ring is not None:
+                self._mem[(sym, interval)] = (time.monotonic() + at + ttl - now, ring)
+                out[sym] = ring.frame()
+        return out
+
+    def _ttl(self, interval):
+        ttl = INTERVALS.get(interval, {}).get('ttl')
+        return self.ttl if ttl is None else min(ttl, self.ttl)
+
+    def _stored(self, symbol, interval):
+        hit = self._mem.get((symbol, interval))
+        return hit[1] if hit is not None else self.load(symbol, interval)
+
+    def _refresh_many(self, symbols, interval, days) -> dict:
+        start  = pd.Timestamp(datetime.now()) - pd.Timedelta(days=days)
+        stored = {sym: self._stored(sym, interval) for sym in symbols}
+        overlap = pd.Timedelta(days=self.TOPUP_OVERLAP_DAYS if interval == '1d' else 1)
+        topup  = {sym: ring for sym, ring in stored.items()
+                  if ring is not None and ring.first_time() <= start + overlap}
+        full   = [sym for sym in symbols if sym not in topup]
+
+        fresh = {}
+        if topup:
+            since = min(ring.last_time() for ring in topup.values()) - overlap
+            fresh.update(_yf_download(list(topup), start=str(since.date()), interval=interval))
+            self.topups += 1
+        if full:
+            fresh.update(_yf_download(full, period=f"{days}d", interval=interval))
+            self.downloads += 1
+
+        out = {}
+        for sym in symbols:
+            ring, new = stored[sym], fresh.get(sym)
+            if new is None:
+                continue                # не загрузился — get_many повторит, старые бары отдаст в конце
+            if ring is None or sym not in topup:
+                ring = BarRing(self._capacity(interval))
+            ring.extend(new)
+            self.save(sym, interval, new, keep_from=ring.first_time())
+            self._mem[(sym, interval)] = (time.monotonic() + self._ttl(interval), ring)
+            out[sym] = ring.frame()
+        if out:
+            conn = self._conn()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO refreshed VALUES (?, ?, ?)",
+                                 [(sym, interval, time.time()) for sym in out])
+        return out
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits":      self.hits,
+            "misses":    self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else None,
+            "downloads": self.downloads,
+            "topups":    self.topups,
+            "failures":  self.failures,
+            "peer_hits": self.peer_hits,
+            "stale":     self.stale,
+            "series":    len(self._mem),
+            "memory_kb": round(sum(ring.nbytes for _, ring in list(self._mem.values())) / 1024, 1),
+        }
+
+
+bar_store = BarStore(BAR_DB_PATH, BAR_CACHE_TTL)
+
+
+# ────────────────────────────────────────────────
+# Smart Money Flow
+# ────────────────────────────────────────────────
+def download_ohlcv(symbol, days=None, interval=DEFAULT_INTERVAL):
+    return bar_store.get(symbol, days, interval)
+
+
+def download_many(symbols, days=None, interval=DEFAULT_INTERVAL) -> dict:
+    return bar_store.get_many(symbols, days, interval)
+
+
+def compute_flows(dfs: dict) -> dict:
+    return {sym: compute_flow(df) if df is not None and len(df) >= 20 else None
+            for sym, df in dfs.items()}
+
+
+@timed('smart_money_flow')
+def smart_money_flow(symbol, days=None, interval=DEFAULT_INTERVAL):
+    """df c Flow по барам interval; days по умолчанию — глубина из INTERVALS."""
+    df = download_ohlcv(symbol, days, interval)
+    if df is None or len(df) < 20:
+        return None
+    return compute_flow(df)
+
+
+def normalize_ad(ad, mode=None, window=None) -> np.ndarray:
+    """smart A/D → 0–100 min-max нормировкой по оси 0 (1-D и 2-D, NaN пропускаются).
+
+    window    — min/max по всему окну данных: новый бар может пересчитать всю историю;
+    expanding — по всем барам до текущего включительно;
+    rolling   — по последним window (AD_NORM_WINDOW) барам.
+    Если размах не больше 1e-8 — 50.
+    """
+    mode = mode or AD_NORMALIZE
+    ad   = np.asarray(ad, dtype=float)
+    if mode == 'window':
+        lo, hi = np.nanmin(ad, axis=0), np.nanmax(ad, axis=0)
+    elif mode == 'expanding':
+        lo, hi = np.fmin.accumulate(ad, axis=0), np.fmax.accumulate(ad, axis=0)
+    elif mode == 'rolling':
+        roll   = pd.DataFrame(ad.reshape(len(ad), -1)).rolling(window or AD_NORM_WINDOW, min_periods=1)
+        lo, hi = roll.min().to_numpy().reshape(ad.shape), roll.max().to_numpy().reshape(ad.shape)
+    else:
+        raise ValueError(f"unknown A/D normalization {mode!r}")
+    rng = hi - lo
+    return np.where(rng > 1e-8, (ad - lo) / np.where(rng > 1e-8, rng, 1) * 100, 50.0)
+
+
+@timed('compute_flow')
+def compute_flow(df, normalize=None):
+    """Добавляет в df колонки индикатора и итоговый Flow (0–100).
+
+    normalize — режим normalize_ad (по умолчанию AD_NORMALIZE).
+    """
+    df['Vol_Pct'] = rolling_rank_pct(df['Volume'].values, 20)
+
+    raw_trend       = df['Volume'].rolling(5).mean() / (df['Volume'].rolling(20).mean() + 1e-8) - 1
+    df['Vol_Trend'] = (raw_trend.clip(-1, 1) + 1) * 50
+
+    raw_acc         = df['Close'].pct_change().diff().fillna(0)
+    df['Price_Acc'] = (raw_acc.clip(-0.03, 0.03) / 0.03 + 1) * 50
+
+    df['Signal'] = (
+        0.7 * df['Vol_Pct'] +
+        0.2 * df['Vol_Trend'] +
+        0.1 * df['Price_Acc']
+    ).fillna(50)
+
+    vol_std   = df['Volume'].rolling(20).std() / (df['Volume'].rolling(20).mean() + 1e-8)
+    span_vals = (3 + (1 - vol_std.clip(0, 1)) * 7).fillna(5).round().astype(int).values
+    result    = adaptive_ema(df['Signal'].values, 2.0 / (span_vals + 1.0))
+
+    vol_z     = (df['Volume'] - df['Volume'].rolling(20).mean()) / (df['Volume'].rolling(20).std() + 1e-8)
+    mfm       = ((df['Close'] - df['Low']) - (df['High'] - df['Close'])) / (df['High'] - df['Low'] + 1e-8)
+    smart_vol = (mfm * df['Volume'] * vol_z.clip(lower=1)).fillna(0)
+    smart_ad  = smart_vol.cumsum().ewm(span=5).mean().values
+    smart_ad_pct = normalize_ad(smart_ad, normalize)
+    smart_ad_s  = pd.Series(smart_ad_pct, index=df.index)
+    center      = smart_ad_s.rolling(200, min_periods=50).median()
+    direction   = np.sign(smart_ad_s - center).fillna(0).values
+
+    flow_signed  = 50 + (result - 50) * direction
+    flow_clipped = np.clip(flow_signed, 0, 100)
+
+    flow_s   = pd.Series(flow_clipped)
+    envelope = np.where(
+        flow_s >= 50,
+        flow_s.rolling(5, min_periods=1).max(),
+        flow_s.rolling(5, min_periods=1).min()
+    )
+    smoothed = pd.Series(envelope).ewm(span=3).mean().values
+
+    df['Flow'] = smoothed
+    return df
+
+
+# ────────────────────────────────────────────────
+# Flow сразу для всей вселенной: массив бар × символ
+# ────────────────────────────────────────────────
+class FlowPanel:
+    """Flow набора символов в одном массиве (T баров × S символов).
+
+    Столбцы выровнены по последнему бару: строка — номер бара с конца, а не дата,
+    у каждого символа свой календарь. Начало короткого столбца — NaN (в dates — NaT),
+    start[j] — первая строка с данными.
+    """
+
+    def __init__(self, labels, dates, flow, start):
+        self.labels = list(labels)
+        self.dates  = dates       # datetime64[ns], (T, S)
+        self.flow   = flow        # float64, (T, S)
+        self.start  = start       # int64, (S,)
+        self._pos   = {label: j for j, label in enumerate(self.labels)}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self._pos
+
+    def keys(self) -> list:
+        return list(self.labels)
+
+    def series(self, label) -> pd.Series:
+        j = self._pos[label]
+        s = self.start[j]
+        return pd.Series(self.flow[s:, j], index=pd.DatetimeIndex(self.dates[s:, j]), name='Flow')
+
+    def last(self) -> np.ndarray:
+        return self.flow[-1]
+
+    def bucket_counts(self, ranges) -> np.ndarray:
+        """(len(ranges), S): число баров каждого символа с Flow в (low, high]."""
+        return np.array([((self.flow > low) & (self.flow <= high)).sum(axis=0) for low, high in ranges])
+
+    def select(self, labels) -> 'FlowPanel':
+        cols = [self._pos[label] for label in labels if label in self._pos]
+        top  = int(self.start[cols].min()) if cols else len(self.flow)
+        return FlowPanel([self.labels[j] for j in cols], self.dates[top:, cols],
+                         self.flow[top:, cols], self.start[cols] - top)
+
+
+PANEL_COLUMNS = ['High', 'Low', 'Close', 'Volume']
+
+
+@timed('flow_panel')
+def flow_panel(dfs: dict, normalize=None) -> FlowPanel:
+    """FlowPanel по {метка: OHLCV df}; символы без данных или короче 20 баров пропускаются.
+
+    Столбец j совпадает с compute_flow(dfs[labels[j]])['Flow'] с точностью до округления.
+    """
+    dfs    = {k: df for k, df in dfs.items() if df is not None and len(df) >= 20}
+    labels = list(dfs)
+    n_rows = max((len(df) for df in dfs.values()), default=0)
+    start  = np.array([n_rows - len(dfs[k]) for k in labels], dtype=np.int64)
+    dates  = np.full((n_rows, len(labels)), np.datetime64('NaT'), dtype='datetime64[ns]')
+    ohlcv  = np.full((n_rows, len(labels), 4), np.nan)
+    for j, k in enumerate(labels):
+        s = start[j]
+        dates[s:, j]    = dfs[k].index.values.astype('datetime64[ns]')
+        idx = dfs[k].columns.get_indexer(PANEL_COLUMNS)
+        if (idx < 0).any():
+            raise KeyError(f"{k}: нет колонок {[c for c, i in zip(PANEL_COLUMNS, idx) if i < 0]}")
+        ohlcv[s:, j, :] = dfs[k].to_numpy(dtype=float)[:, idx]
+    if labels:
+        flow = _flow_panel_values(*(ohlcv[..., c] for c in range(4)), start, normalize)
+    else:
+        flow = np.empty((n_rows, 0))
+    return FlowPanel(labels, dates, flow, start)
+
+
+def _flow_panel_values(high, low, close, volume, start, normalize=None) -> np.ndarray:
+    """compute_flow по столбцам сразу; в строках до start — NaN."""
+    head = np.arange(len(close))[:, None] < start[None, :]
+
+    w20    = _panel_windows(volume, 20)
+    mean20 = w20.mean(axis=2)
+    std20  = w20.std(axis=2, ddof=1)
+    mean5  = _panel_windows(volume, 5).mean(axis=2)
+
+    vol_pct = (w20[..., :-1] < w20[..., -1:]).sum(axis=2) / 19 * 100
+    vol_pct[np.isnan(mean20)] = np.nan      # окно неполное или с NaN — как у rolling.apply
+
+    vol_trend = (np.clip(mean5 / (mean20 + 1e-8) - 1, -1, 1) + 1) * 50
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ret = np.vstack([np.full((1, close.shape[1]), np.nan), close[1:] / close[:-1] - 1])
+    acc       = np.nan_to_num(np.vstack([np.full((1, close.shape[1]), np.nan), np.diff(ret, axis=0)]), nan=0.0)
+    price_acc = (np.clip(acc, -0.03, 0.03) / 0.03 + 1) * 50
+
+    signal = 0.7 * vol_pct + 0.2 * vol_trend + 0.1 * price_acc
+    signal[np.isnan(signal)] = 50
+
+    spans  = np.round(3 + (1 - np.clip(std20 / (mean20 + 1e-8), 0, 1)) * 7)
+    spans[np.isnan(spans)] = 5
+    result = adaptive_ema(_fill_head(signal, start), 2.0 / (spans + 1.0))
+
+    vol_z     = (volume - mean20) / (std20 + 1e-8)
+    mfm       = ((close - low) - (high - close)) / (high - low + 1e-8)
+    smart_vol = mfm * volume * np.maximum(vol_z, 1)
+    smart_vol[np.isnan(smart_vol)] = 0
+    smart_ad  = _ewm_panel(np.cumsum(smart_vol, axis=0), 5, start)
+    smart_ad[head] = np.nan
+
+    ad_pct = normalize_ad(smart_ad, normalize)
+    ad_pct[head] = np.nan
+    center    = _rolling_nanmedian(ad_pct, 200, 50)
+    direction = np.nan_to_num(np.sign(ad_pct - center), nan=0.0)
+
+    flow_clipped = _fill_head(np.clip(50 + (result - 50) * direction, 0, 100), start)
+    w5       = _panel_windows(flow_clipped, 5, edge=True)
+    envelope = np.where(flow_clipped >= 50, w5.max(axis=2), w5.min(axis=2))
+    smoothed = _ewm_panel(envelope, 3, start)
+    smoothed[head] = np.nan
+    return smoothed
+
+
+def _panel_windows(x: np.ndarray, window: int, edge: bool = False) -> np.ndarray:
+    """(T, S, window): окно, заканчивающееся на каждой строке.
+
+    Недостающее начало — NaN, либо (edge=True) копии первой строки: для min/max
+    с min_periods=1 повтор значения, которое и так в окне, ничего не меняет.
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+    fill = np.repeat(x[:1], window - 1, axis=0) if edge else np.full((window - 1,) + x.shape[1:], np.nan)
+    return sliding_window_view(np.concatenate([fill, x]), window, axis=0)
+
+
+def _fill_head(x: np.ndarray, start: np.ndarray) -> np.ndarray:
+    """Строки до start[j] заполняются значением столбца в start[j]."""
+    head = np.arange(len(x))[:, None] < start[None, :]
+    return np.where(head, x[start, np.arange(x.shape[1])], x)
+
+
+def _ewm_panel(x: np.ndarray, span: float, start: np.ndarray) -> np.ndarray:
+    """ewm(span, adjust=True).mean() по столбцам, каждый — со своей строки start.
+
+    adjust=True — та же рекурсия с alpha_k = 1 / sum_{i<=k} (1 - a)^i; строки до start
+    заполнены первым значением, так что к start EMA приходит ровно к нему.
+    """
+    a = 2.0 / (span + 1.0)
+    k = np.arange(len(x))[:, None] - start[None, :]
+    weight = (1 - (1 - a) ** (np.maximum(k, 0) + 1)) / a
+    return adaptive_ema(_fill_head(x, start), np.where(k >= 1, 1 / weight, a))
+
+
+def _rolling_nanmedian(x: np.ndarray, window: int, min_periods: int) -> np.ndarray:
+    """rolling(window, min_periods).median() по столбцам; NaN не считаются наблюдениями."""
+    window = max(1, min(window, len(x)))    # окно длиннее истории — то же, что вся история
+    out    = np.full(x.shape, np.nan)
+    step   = max(1, RANK_CHUNK_CELLS // (window * max(1, x.shape[1])))
+    for top in range(0, len(x), step):
+        lo  = max(0, top - window + 1)
+        win = np.sort(_panel_windows(x[lo:top + step], window)[top - lo:], axis=2)   # NaN — в конце
+        cnt = (~np.isnan(win)).sum(axis=2)
+        mid = np.stack([np.maximum(cnt - 1, 0) // 2, cnt // 2], axis=2)
+        med = np.take_along_axis(win, np.minimum(mid, window - 1), axis=2).mean(axis=2)
+        out[top:top + step] = np.where(cnt >= min_periods, med, np.nan)
+    return out
+
+
+# ────────────────────────────────────────────────
+# RSX Джурика
+# ────────────────────────────────────────────────
+def _rsx_warmup_mask(f8: np.ndarray, f10: np.ndarray, length: int) -> np.ndarray:
+    """Счётчик прогрева f88/f90: True там, где RSX уже считается (f88 < f90)."""
+    n     = len(f8)
+    valid = np.ones(n, dtype=bool)
+    f90p  = 0
+    for i in range(n):
+        if i == 0 or f90p == 0:
+            f88 = length - 1 if (i > 0 and length - 1 >= 5) else 5
+            f90 = 1
+        else:
+            f88 = 5
+            f90 = f88 + 1 if f88 <= f90p else f90p + 1
+        f0 = f88 >= f90 and f8[i] != f10[i]
+        if f88 == f90 and not f0:
+            f90 = 0
+        valid[i] = f88 < f90
+        if f88 == 5 and f90 == 6:
+            # f90 дошёл до 6 — дальше счётчик стоит и сбросов больше не бывает
+            break
+        f90p = f90
+    return valid
+
+
+def _rsx_filters_lfilter(v8: np.ndarray, f18: float, f20: float):
+    from scipy.signal import lfilter
+    b, a = [f18], [1.0, -f20]
+
+    def stage(x):
+        # y[i] = f20 * y[i-1] + f18 * x[i] — ровно та же рекурсия, что и в цикле
+        f_a = lfilter(b, a, x)
+        f_b = lfilter(b, a, f_a)
+        return f_a * 1.5 - f_b * 0.5
+
+    v14 = stage(stage(stage(v8)))
+    v20 = stage(stage(stage(np.abs(v8))))
+    return v14, v20
+
+
+def _rsx_filters_loop(v8: np.ndarray, f18: float, f20: float):
+    n   = len(v8)
+    v14 = np.empty(n)
+    v20 = np.empty(n)
+    f28 = f30 = f38 = f40 = f48 = f50 = 0.0
+    f58 = f60 = f68 = f70 = f78 = f80 = 0.0
+    for i, x in enumerate(v8.tolist()):
+        f28 = f20 * f28 + f18 * x
+        f30 = f18 * f28 + f20 * f30
+        vC  = f28 * 1.5 - f30 * 0.5
+        f38 = f20 * f38 + f18 * vC
+        f40 = f18 * f38 + f20 * f40
+        v10 = f38 * 1.5 - f40 * 0.5
+        f48 = f20 * f48 + f18 * v10
+        f50 = f18 * f48 + f20 * f50
+        v14[i] = f48 * 1.5 - f50 * 0.5
+        f58 = f20 * f58 + f18 * abs(x)
+        f60 = f18 * f58 + f20 * f60
+        v18 = f58 * 1.5 - f60 * 0.5
+        f68 = f20 * f68 + f18 * v18
+        f70 = f18 * f68 + f20 * f70
+        v1C = f68 * 1.5 - f70 * 0.5
+        f78 = f20 * f78 + f18 * v1C
+        f80 = f18 * f78 + f20 * f80
+        v20[i] = f78 * 1.5 - f80 * 0.5
+    return v14, v20
+
+
+@timed('rsx')
+def calculate_rsx(series: pd.Series, length: int = 9) -> pd.Series:
+    """RSX Джурика: каскад IIR-фильтров через scipy.signal.lfilter, без scipy — цикл с O(1) состоянием.
+
+    Результат побитово совпадает с исходной построчной реализацией.
+    """
+    src = series.values.astype(float)
+    if len(src) == 0:
+        return pd.Series(np.zeros(0), index=series.index)
+    f18 = 3.0 / (length + 2.0); f20 = 1.0 - f18
+    f8  = 100.0 * src
+    f10 = np.concatenate(([0.0], f8[:-1]))
+    v8  = f8 - f10
+    try:
+        v14, v20 = _rsx_filters_lfilter(v8, f18, f20)
+    except ImportError:
+        # scipy есть в requirements.txt; цикл — запасной путь для окружения без него
+        v14, v20 = _rsx_filters_loop(v8, f18, f20)
+
+    valid = _rsx_warmup_mask(f8, f10, length) & (np.abs(v20) > 1e-8)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v4 = np.where(valid, (v14 / v20 + 1.0) * 50.0, 50.0)
+    rsx = np.fmax(0.0, np.fmin(100.0, v4))
+    return pd.Series(rsx, index=series.index)
+
+
+# ────────────────────────────────────────────────
+# Инкрементальное состояние Flow / RSX
+# ────────────────────────────────────────────────
+class RSXState:
+    """Потоковый RSX: update(x) за O(1), результат совпадает с calculate_rsx."""
+
+    _FILTERS = ('f28', 'f30', 'f38', 'f40', 'f48', 'f50',
+                'f58', 'f60', 'f68', 'f70', 'f78', 'f80')
+
+    def __init__(self, length: int = 9):
+        self.length = length
+        self.f18    = 3.0 / (length + 2.0)
+        self.f20    = 1.0 - self.f18
+        self.i      = 0
+        self.f8     = 0.0
+        self.f90    = 0
+        for name in self._FILTERS:
+            setattr(self, name, 0.0)
+
+    def update(self, x: float) -> float:
+        f18, f20, length = self.f18, self.f20, self.length
+        f8  = 100.0 * float(x)
+        f10 = self.f8
+        v8  = f8 - f10
+        self.f28 = f20 * self.f28 + f18 * v8
+        self.f30 = f18 * self.f28 + f20 * self.f30
+        vC       = self.f28 * 1.5 - self.f30 * 0.5
+        self.f38 = f20 * self.f38 + f18 * vC
+        self.f40 = f18 * self.f38 + f20 * self.f40
+        v10      = self.f38 * 1.5 - self.f40 * 0.5
+        self.f48 = f20 * self.f48 + f18 * v10
+        self.f50 = f18 * self.f48 + f20 * self.f50
+        v14      = self.f48 * 1.5 - self.f50 * 0.5
+        self.f58 = f20 * self.f58 + f18 * abs(v8)
+        self.f60 = f18 * self.f58 + f20 * self.f60
+        v18      = self.f58 * 1.5 - self.f60 * 0.5
+        self.f68 = f20 * self.f68 + f18 * v18
+        self.f70 = f18 * self.f68 + f20 * self.f70
+        v1C      = self.f68 * 1.5 - self.f70 * 0.5
+        self.f78 = f20 * self.f78 + f18 * v1C
+        self.f80 = f18 * self.f78 + f20 * self.f80
+        v20      = self.f78 * 1.5 - self.f80 * 0.5
+
+        if self.i == 0 or self.f90 == 0:
+            f88 = length - 1 if (self.i > 0 and length - 1 >= 5) else 5
+            f90 = 1
+        else:
+            f88 = 5
+            f90 = f88 + 1 if f88 <= self.f90 else self.f90 + 1
+        f0 = f88 >= f90 and f8 != f10
+        if f88 == f90 and not f0:
+            f90 = 0
+        v4 = (v14 / v20 + 1.0) * 50.0 if (f88 < f90 and abs(v20) > 1e-8) else 50.0
+
+        self.f8  = f8
+        self.f90 = f90
+        self.i  += 1
+        return max(0.0, min(100.0, v4))
+
+    def to_dict(self) -> dict:
+        d = {'length': self.length, 'i': self.i, 'f8': self.f8, 'f90': self.f90}
+        d.update({name: getattr(self, name) for name in self._FILTERS})
+        return d
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "RSXState":
+        st = cls(d['length'])
+        for k, v in d.items():
+            if k != 'length':
+                setattr(st, k, v)
+        return st
+
+
+class _EWMState:
+    """ewm(span).mean() с adjust=True — та же рекурсия, что в pandas."""
+
+    def __init__(self, span: float, weighted=None, old_wt=1.0):
+        self.span     = span
+        alpha         = 1.0 / (1.0 + (span - 1) / 2.0)
+        self.factor   = 1.0 - alpha
+        self.weighted = weighted
+        self.old_wt   = old_wt
+
+    def update(self, x: float) -> float:
+        if self.weighted is None:
+            self.weighted = x
+            return x
+        self.old_wt *= self.factor
+        if self.weighted != x:
+            self.weighted = (self.old_wt * self.weighted + x) / (self.old_wt + 1.0)
+        self.old_wt += 1.0
+        return self.weighted
+
+    def to_dict(self) -> dict:
+        return {'span': self.span, 'weighted': self.weighted, 'old_wt': self.old_wt}
+
+
+class _RollingMedian:
+    """Медиана последних window значений: sorted-окно, вставка/удаление через bisect."""
+
+    def __init__(self, window: int, values=()):
+        self.window = window
+        self.values = deque(maxlen=window)
+        self.sorted = []
+        for v in values:
+            self.push(v)
+
+    def push(self, x: float):
+        if len(self.values) == self.window:
+            old = self.values[0]
+            del self.sorted[bisect_left(self.sorted, old)]
+        self.values.append(x)
+        insort(self.sorted, x)
+
+    def median(self) -> float:
+        n   = len(self.sorted)
+        mid = n // 2
+        if n % 2:
+            return self.sorted[mid]
+        return (self.sorted[mid - 1] + self.sorted[mid]) / 2.0
+
+
+class _RollingExtremes:
+    """Минимум и максимум последних window значений за амортизированное O(1): монотонные
+    очереди (номер, значение) — возрастающая для минимума, убывающая для максимума."""
+
+    def __init__(self, window: int, values=()):
+        self.window = window
+        self.values = deque(maxlen=window)
+        self.lows   = deque()
+        self.highs  = deque()
+        self.n      = 0
+        for v in values:
+            self.push(v)
+
+    def push(self, x: float):
+        self.values.append(x)
+        while self.lows and self.lows[-1][1] >= x:
+            self.lows.pop()
+        while self.highs and self.highs[-1][1] <= x:
+            self.highs.pop()
+        self.lows.append((self.n, x))
+        self.highs.append((self.n, x))
+        self.n += 1
+        start = self.n - self.window
+        if self.lows[0][0] < start:
+            self.lows.popleft()
+        if self.highs[0][0] < start:
+            self.highs.popleft()
+
+    def min(self) -> float:
+        return self.lows[0][1]
+
+    def max(self) -> float:
+        return self.highs[0][1]
+
+
+class FlowState:
+    """Потоковый Smart Money Flow + RSX(Flow): update() на каждый новый бар.
+
+    Повторяет compute_flow для последнего бара: бары, поданные в update() по порядку,
+    дают тот же Flow, что compute_flow(df, normalize) на DataFrame из этих же баров.
+    В режиме window нормировка smart A/D — аффинное преобразование, поэтому знак
+    относительно скользящей медианы считается прямо по smart A/D.
+    """
+
+    def __init__(self, history_days: int = 175, rsx_length: int = 9, normalize=None):
+        self.normalize    = normalize or AD_NORMALIZE
+        if self.normalize not in ('window', 'expanding', 'rolling'):
+            raise ValueError(f"unknown A/D normalization {self.normalize!r}")
+        self.history_days = history_days
+        self.last_ts      = None
+        self.n            = 0
+        self.vols         = deque(maxlen=19)   # предыдущие 19 объёмов
+        self.vols_sorted  = []                 # они же, отсортированные
+        self.prev_close   = None
+        self.prev_ret     = None
+        self.result       = None
+        self.cum_vol      = 0.0
+        self.ad_ewm       = _EWMState(5)
+        self.ad_median    = _RollingMedian(200)
+        self.ad_min       = float('inf')
+        self.ad_max       = float('-inf')
+        self.ad_window    = _RollingExtremes(AD_NORM_WINDOW)   # для normalize='rolling'
+        self.flows        = deque(maxlen=5)
+        self.flow_ewm     = _EWMState(3)
+        self.rsx          = RSXState(rsx_length)
+        self.history      = deque()     # (ts, flow, rsx) за последние history_days
+
+    def update(self, ts, bar) -> float:
+        """Добавляет бар (mapping с High/Low/Close/Volume) и возвращает новый Flow."""
+        high, low  = float(bar['High']), float(bar['Low'])
+        close, vol = float(bar['Close']), float(bar['Volume'])
+        nan = float('nan')
+
+        if len(self.vols) == 19:
+            # окно 20 = предыдущие 19 + текущий; Vol_Pct — доля предыдущих строго меньше текущего
+            vol_pct   = bisect_left(self.vols_sorted, vol) / 19 * 100
+            window    = list(self.vols) + [vol]
+            mean20    = sum(window) / 20
+            std20     = (sum((v - mean20) ** 2 for v in window) / 19) ** 0.5
+            mean5     = sum(window[-5:]) / 5
+            raw_trend = mean5 / (mean20 + 1e-8) - 1
+            vol_trend = (min(max(raw_trend, -1.0), 1.0) + 1) * 50
+            vol_std   = std20 / (mean20 + 1e-8)
+            span      = round(3 + (1 - min(max(vol_std, 0.0), 1.0)) * 7)
+            vol_z     = (vol - mean20) / (std20 + 1e-8)
+            del self.vols_sorted[bisect_left(self.vols_sorted, self.vols[0])]
+        else:
+            vol_pct = vol_trend = vol_z = nan
+            span    = 5
+        self.vols.append(vol)
+        insort(self.vols_sorted, vol)
+
+        ret = close / self.prev_close - 1 if self.prev_close is not None else nan
+        acc = ret - self.prev_ret if self.prev_ret is not None else nan
+        acc = 0.0 if acc != acc else acc
+        price_acc = (min(max(acc, -0.03), 0.03) / 0.03 + 1) * 50
+        self.prev_close, self.prev_ret = close, ret
+
+        signal = 0.7 * vol_pct + 0.2 * vol_trend + 0.1 * price_acc
+        signal = 50.0 if signal != signal else signal
+        if self.result is None:
+            self.result = signal
+        else:
+            alpha       = 2.0 / (span + 1.0)
+            self.result = alpha * signal + (1 - alpha) * self.result
+
+        mfm       = ((close - low) - (high - close)) / (high - low + 1e-8)
+        smart_vol = mfm * vol * max(vol_z, 1.0) if vol_z == vol_z else 0.0
+        self.cum_vol += smart_vol
+        ad = self.ad_ewm.update(self.cum_vol)
+        self.ad_min, self.ad_max = min(self.ad_min, ad), max(self.ad_max, ad)
+        if self.normalize == 'window':
+            value = ad
+            ready = self.ad_max - self.ad_min > 1e-8
+        else:
+            if self.normalize == 'rolling':
+                self.ad_window.push(ad)
+                lo, hi = self.ad_window.min(), self.ad_window.max()
+            else:
+                lo, hi = self.ad_min, self.ad_max
+            value = (ad - lo) / (hi - lo) * 100 if hi - lo > 1e-8 else 50.0
+            ready = True
+        self.ad_median.push(value)
+
+        if ready and len(self.ad_median.values) >= 50:
+            diff      = value - self.ad_median.median()
+            direction = (diff > 0) - (diff < 0)
+        else:
+            direction = 0
+        flow_clipped = min(max(50 + (self.result - 50) * direction, 0.0), 100.0)
+        self.flows.append(flow_clipped)
+        envelope = max(self.flows) if flow_clipped >= 50 else min(self.flows)
+        flow     = self.flow_ewm.update(envelope)
+        rsx      = self.rsx.update(flow)
+
+        ts = pd.Timestamp(ts)
+        self.history.append((ts, flow, rsx))
+        cutoff = ts - pd.Timedelta(days=self.history_days)
+        while self.history and self.history[0][0] < cutoff:
+            self.history.popleft()
+        self.last_ts = ts
+        self.n      += 1
+        return flow
+
+    def stream(self, df):
+        """Подаёт все бары df по порядку; на каждый отдаёт (ts, Flow, RSX)."""
+        rows = df.to_numpy(dtype=float)[:, df.columns.get_indexer(PANEL_COLUMNS)]
+        for ts, (high, low, close, vol) in zip(df.index, rows.tolist()):
+            flow = self.update(ts, {'High': high, 'Low': low, 'Close': close, 'Volume': vol})
+            yield ts, flow, self.history[-1][2]
+
+    def extend(self, df) -> int:
+        """Подаёт только бары новее last_ts; возвращает число обработанных."""
+        idx = df.index
+        if getattr(idx, 'tz', None) is not None:
+            idx = idx.tz_localize(None)
+        mask = np.ones(len(df), dtype=bool) if self.last_ts is None else np.asarray(idx > self.last_ts)
+        for ts, (_, bar) in zip(idx[mask], df[mask].iterrows()):
+            self.update(ts, bar)
+        return int(mask.sum())
+
+    def frame(self) -> pd.DataFrame:
+        """История Flow/RSX в формате, который понимает make_chart."""
+        ts, flow, rsx = zip(*self.history) if self.history else ((), (), ())
+        return pd.DataFrame({'Flow': flow, 'RSX': rsx}, index=pd.DatetimeIndex(ts))
+
+    def to_dict(self) -> dict:
+        return {
+            'normalize':    self.normalize,
+            'history_days': self.history_days,
+            'last_ts':      self.last_ts.isoformat() if self.last_ts is not None else None,
+            'n':            self.n,
+            'vols':         list(self.vols),
+            'prev_close':   self.prev_close,
+            'prev_ret':     self.prev_ret,
+            'result':       self.result,
+            'cum_vol':      self.cum_vol,
+            'ad_ewm':       self.ad_ewm.to_dict(),
+            'ad_values':    list(self.ad_median.values),
+            'ad_min':       self.ad_min,
+            'ad_max':       self.ad_max,
+            'ad_window':    list(self.ad_window.values),
+            'flows':        list(self.flows),
+            'flow_ewm':     self.flow_ewm.to_dict(),
+            'rsx':          self.rsx.to_dict(),
+            'history':      [(t.isoformat(), f, r) for t, f, r in self.history],
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "FlowState":
+        st = cls(d['history_days'], d['rsx']['length'], d.get('normalize', 'window'))
+        st.last_ts     = pd.Timestamp(d['last_ts']) if d['last_ts'] else None
+        st.n           = d['n']
+        st.vols.extend(d['vols'])
+        st.vols_sorted = sorted(st.vols)
+        st.prev_close  = d['prev_close']
+        st.prev_ret    = d['prev_ret']
+        st.result      = d['result']
+        st.cum_vol     = d['cum_vol']
+        st.ad_ewm      = _EWMState(**d['ad_ewm'])
+        st.ad_median   = _RollingMedian(200, d['ad_values'])
+        st.ad_min      = d['ad_min']
+        st.ad_max      = d['ad_max']
+        st.ad_window   = _RollingExtremes(AD_NORM_WINDOW, d.get('ad_window', ()))
+        st.flows.extend(d['flows'])
+        st.flow_ewm    = _EWMState(**d['flow_ewm'])
+        st.rsx         = RSXState.from_dict(d['rsx'])
+        st.history     = deque((pd.Timestamp(t), f, r) for t, f, r in d['history'])
+        return st
+
+
+def write_json(path, data):
+    """Атомарная запись JSON: во временный файл, затем os.replace."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"      # у каждого воркера свой временный файл
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+# ────────────────────────────────────────────────
+# График: Flow + RSX + таблица фаз
+# ────────────────────────────────────────────────
+PHASES = [
+    ("Accumulation",  "Накопление",      "30–50",   "40–60",  "Участие начинает появляться",           "Формирование базы, подготовка режима",  "#4169E1"),
+    ("Expansion",     "Экспансия",       "> 60–70", "> 70",   "Резкое ускорение участия",              "Включился импульс режима",              "#32CD32"),
+    ("Trend",         "Тренд",           "> 70",    "50–70",  "Участие держится стабильно",            "Режим устойчив, идёт протяжка",         "#006400"),
+    ("Distribution",  "Распределение",   "> 70",    "↓ LH",   "Импульс участия слабеет",               "Смарт-деньги выгружаются",              "#FF8C00"),
+    ("Balance",       "Сжатие/Баланс",   "45–55",   "40–60",  "Нет явного режима",                     "Переходная зона",                       "#888888"),
+    ("Collapse",      "Коллапс",         "< 40",    "< 30",   "Резкий выход участия вниз",             "Смена режима / ликвидация",             "#DC143C"),
+    ("Bear Exp.",     "Медвежья эксп.",  "< 40",    "< 30",   "Ускорение вниз",                        "Активный продавец",                     "#8B0000"),
+    ("Bear Trend",    "Медвежий тренд",  "< 30",    "30–50",  "Давление удерживается",                 "Стабильный медвежий режим",             "#660000"),
+]
+
+CHART_FIGSIZE = (12, 11)
+CHART_DPI     = 100
+
+
+def new_figure(figsize, dpi=None):
+    """Фигура на Agg-холсте без pyplot: ни менеджера фигур, ни глобального состояния,
+    ни plt.close — фигура освобождается вместе с последней ссылкой. matplotlib
+    импортируется здесь, при первом графике в процессе."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _draw_phase_table(ax3):
+    from matplotlib.patches import Rectangle
+
+    col_labels = ["Фаза", "Рус. название", "Flow", "RSX(Flow)", "Что происходит", "Что это значит"]
+    col_widths  = [0.11,   0.13,            0.07,   0.07,        0.32,             0.30]
+    row_h    = 0.105
+    header_y = 0.95
+
+    x = 0.0
+    for label, w in zip(col_labels, col_widths):
+        ax3.add_patch(Rectangle((x, header_y - 0.04), w, 0.09,
+                                transform=ax3.transAxes,
+                                fc='#1a1a2e', ec='none', clip_on=False))
+        ax3.text(x + w/2, header_y, label,
+                 ha='center', va='center', fontsize=7.5, fontweight='bold',
+                 color='white', transform=ax3.transAxes)
+        x += w
+
+    for row_i, (eng, rus, flow_r, rsx_r, what, meaning, color) in enumerate(PHASES):
+        y  = header_y - 0.04 - (row_i + 1) * row_h
+        bg = '#f4f4f4' if row_i % 2 == 0 else '#ffffff'
+        row_data = [eng, rus, flow_r, rsx_r, what, meaning]
+        x = 0.0
+        for col_i, (val, w) in enumerate(zip(row_data, col_widths)):
+            ax3.add_patch(Rectangle((x, y - row_h*0.45), w, row_h*0.9,
+                                    transform=ax3.transAxes,
+                                    fc=bg, ec='#dddddd', linewidth=0.4,
+                                    clip_on=False))
+            if col_i == 0:
+                ax3.add_patch(Rectangle((x, y - row_h*0.45), 0.005, row_h*0.9,
+                                        transform=ax3.transAxes,
+                                        fc=color, ec='none', clip_on=False))
+            ax3.text(x + w/2, y, val,
+                     ha='center', va='center', fontsize=6.8,
+                     transform=ax3.transAxes, color='#111111')
+            x += w
+
+
+class _ChartTemplate:
+    """Каркас графика make_chart, собранный один раз на процесс.
+
+    Пороговые линии, легенды, подписи и сетка создаются при сборке; таблица фаз
+    растеризуется в картинку один раз. На каждый запрос меняются только данные линий,
+    заливки, аннотации и перигеи — и фигура рисуется один раз, без bbox_inches='tight'.
+    """
+
+    def __init__(self):
+        import matplotlib.gridspec as gridspec
+
+        self.fig = fig = new_figure(CHART_FIGSIZE, CHART_DPI)
+        gs  = gridspec.GridSpec(3, 1, height_ratios=[2.5, 1, 0.85], hspace=0.08,
+                                left=0.06, right=0.98, top=0.96, bottom=0.01)
+        self.ax1 = ax1 = fig.add_subplot(gs[0])
+        self.ax2 = ax2 = fig.add_subplot(gs[1], sharex=ax1)
+        self.ax3 = ax3 = fig.add_subplot(gs[2])
+        ax3.axis('off')
+
+        # фиктивные даты, чтобы ось сразу получила конвертер дат
+        x0 = pd.DatetimeIndex([pd.Timestamp('2000-01-01'), pd.Timestamp('2000-01-02')])
+        self.flow_line, = ax1.plot(x0, [50, 50], label="Participation Index", linewidth=2, color='navy')
+        ax1.axhline(85, color='red',   linestyle='--', linewidth=1, label='Overbought (85)')
+        ax1.axhline(15, color='green', linestyle='--', linewidth=1, label='Oversold (15)')
+        ax1.axhline(50, color='gray',  linestyle='-',  alpha=0.4)
+        ax1.set_ylim(0, 100)
+        ax1.legend(loc='upper left', fontsize=9)
+        ax1.grid(alpha=0.3)
+
+        self.rsx_line, = ax2.plot(x0, [50, 50], label="RSX(9)", linewidth=1.5, color='orange')
+        ax2.axhline(70, color='red',   linestyle='--', linewidth=1)
+        ax2.axhline(30, color='green', linestyle='--', linewidth=1)
+        ax2.axhline(50, color='gray',  linestyle='-',  alpha=0.4)
+        ax2.set_ylim(0, 100)
+        ax2.set_ylabel('RSX(9)', fontsize=9)
+        ax2.legend(loc='upper left', fontsize=9)
+        ax2.grid(alpha=0.3)
+
+        ax3.imshow(self._rasterize_table(ax3.get_position()), extent=(0, 1, 0, 1),
+                   aspect='auto', interpolation='none', transform=ax3.transAxes)
+        ax3.set_xlim(0, 1)
+        ax3.set_ylim(0, 1)
+        self.dynamic = []
+
+    @staticmethod
+    def _rasterize_table(pos):
+        w_in = CHART_FIGSIZE[0] * pos.width
+        h_in = CHART_FIGSIZE[1] * pos.height
+        fig  = new_figure((w_in, h_in), CHART_DPI)
+        ax   = fig.add_axes((0, 0, 1, 1))
+        ax.axis('off')
+        _draw_phase_table(ax)
+        fig.canvas.draw()
+        return np.asarray(fig.canvas.buffer_rgba()).copy()
+
+    def render(self, df, symbol, rsx, perigees, interval=DEFAULT_INTERVAL) -> io.BytesIO:
+        ax1, ax2 = self.ax1, self.ax2
+        for artist in self.dynamic:
+            artist.remove()
+        self.dynamic = dyn = []
+        now_ts = pd.Timestamp(datetime.now()).tz_localize(None)
+
+        self.flow_line.set_data(df.index, df['Flow'].values)
+        self.rsx_line.set_data(rsx.index, rsx.values)
+        dyn.append(ax1.fill_between(df.index, 85, df['Flow'].clip(lower=85), alpha=0.15, color='red'))
+        dyn.append(ax1.fill_between(df.index, df['Flow'].clip(upper=15), 15, alpha=0.15, color='blue'))
+        label = symbol if interval == DEFAULT_INTERVAL else f"{symbol} {interval}"
+        ax1.set_title(f"{label} — Volume Stress / Participation Index", fontsize=14, fontweight='bold')
+        date_fmt = '%d.%m.%Y' if interval == DEFAULT_INTERVAL else '%d.%m %H:%M'
+
+        try:
+            last_flow = float(df['Flow'].iloc[-1])
+            last_date = df.index[-1]
+            dyn.append(ax1.annotate(
+                f"{last_date.strftime(date_fmt)}\n{last_flow:.1f}%",
+                xy=(last_date, last_flow),
+                xytext=(-60, 15), textcoords='offset points',
+                bbox=dict(boxstyle='round,pad=0.3', facecolor='yellow', alpha=0.8),
+                fontsize=9, fontweight='bold',
+            ))
+        except Exception:
+            pass
+
+        try:
+            last_rsx_date = rsx.index[-1]
+            last_rsx_val  = float(rsx.iloc[-1])
+            dyn.append(ax2.annotate(
+                f"{last_rsx_date.strftime(date_fmt)}\nRSX: {last_rsx_val:.1f}",
+                xy=(last_rsx_date, last_rsx_val),
+                xytext=(-60, 15), textcoords='offset points',
+                bbox=dict(boxstyle='round,pad=0.3', facecolor='lightblue', alpha=0.8),
+                fontsize=9, fontweight='bold',
+            ))
+        except Exception:
+            pass
+
+        for p in perigees:
+            p_n = p.tz_localize(None) if p.tzinfo is not None else p
+            if p_n <= now_ts:
+                dyn.append(ax1.axvline(p_n, color='red', linestyle='--', linewidth=0.9, alpha=0.6, zorder=5))
+                dyn.append(ax2.axvline(p_n, color='red', linestyle='--', linewidth=0.9, alpha=0.6, zorder=5))
+            else:
+                dyn.append(ax1.axvline(p_n, color='red', linestyle='--', linewidth=1.4, alpha=0.95, zorder=5))
+                dyn.append(ax2.axvline(p_n, color='red', linestyle='--', linewidth=1.4, alpha=0.95, zorder=5))
+                dyn.append(ax1.text(p_n, 93, f"↓ {p.strftime('%d.%m')}", color='red',
+                                    fontsize=7.5, ha='center', fontweight='bold', zorder=6,
+                                    bbox=dict(boxstyle='round,pad=0.2', fc='white', ec='crimson', alpha=0.9)))
+                break
+
+        # x-пределы — по данным и перигеям, как при построении с нуля
+        for ax in (ax1, ax2):
+            ax.relim()
+            ax.autoscale_view(scaley=False)
+
+        buf = io.BytesIO()
+        with span('savefig'):
+            self.fig.savefig(buf, format='png')
+        buf.seek(0)
+        return buf
+
+
+# ────────────────────────────────────────────────
+# Рендереры: бэкенды рисования за make_chart / make_distribution_chart
+# ────────────────────────────────────────────────
+class ChartRenderer(ABC):
+    """Интерфейс бэкенда: получает готовые данные, возвращает PNG в BytesIO.
+
+    Подготовка данных (RSX, перигеи, ранги распределения) остаётся в make_chart и
+    make_distribution_chart — бэкенд только рисует. Новый бэкенд регистрируется
+    декоратором register_renderer и выбирается переменной CHART_RENDERER.
+    """
+
+    name = None
+
+    @abstractmethod
+    def chart(self, df, symbol, rsx, perigees, interval=DEFAULT_INTERVAL) -> io.BytesIO:
+        ...
+
+    @abstractmethod
+    def distribution(self, assets, scores, counts, page_label='') -> io.BytesIO:
+        ...
+
+
+RENDERERS = {}
+
+
+def register_renderer(cls):
+    """Декоратор класса-бэкенда: неполный бэкенд (без chart или distribution) или без
+    name отвергается при импорте, а не на первом графике."""
+    if not issubclass(cls, ChartRenderer) or inspect.isabstract(cls):
+        missing = sorted(getattr(cls, '__abstractmethods__', ()))
+        raise TypeError(f"{cls.__name__} is not a complete ChartRenderer (missing: {', '.join(missing) or '?'})")
+    if not cls.name:
+        raise TypeError(f"{cls.__name__}.name is not set")
+    RENDERERS[cls.name] = cls
+    return cls
+
+
+@register_renderer
+class AggRenderer(ChartRenderer):
+    """matplotlib напрямую через Figure + FigureCanvasAgg, без pyplot; каркас графика
+    актива собирается один раз на процесс (_ChartTemplate)."""
+
+    name = 'agg'
+
+    def __init__(self):
+        self._template = None
+
+    def chart(self, df, symbol, rsx, perigees, interval=DEFAULT_INTERVAL) -> io.BytesIO:
+        if self._template is None:
+            self._template = _ChartTemplate()
+        return self._template.render(df, symbol, rsx, perigees, interval)
+
+    def distribution(self, assets, scores, counts, page_label='') -> io.BytesIO:
+        return _draw_distribution(assets, scores, counts, page_label)
+
+
+_renderer = None
+
+
+def get_renderer() -> ChartRenderer:
+    """Рендерер процесса (у каждого процесса cpu_pool — свой, создаётся при первом графике)."""
+    global _renderer
+    if _renderer is None:
+        if CHART_RENDERER not in RENDERERS:
+            raise ValueError(f"Unknown CHART_RENDERER {CHART_RENDERER!r}, expected one of {sorted(RENDERERS)}")
+        _renderer = RENDERERS[CHART_RENDERER]()
+    return _renderer
+
+
+def chart_perigees(index, interval=DEFAULT_INTERVAL) -> list:
+    """Перигеи для графика: на дневном — за 175 дней и ближайший будущий,
+    на внутридневном — только попавшие в окно данных, чтобы не растягивать ось."""
+    perigees = get_lunar_perigees(175)
+    if interval == DEFAULT_INTERVAL or not len(index):
+        return perigees
+    first, last = index[0], index[-1]
+    return [p for p in perigees if first <= (p.tz_localize(None) if p.tzinfo is not None else p) <= last]
+
+
+@timed('make_chart')
+def make_chart(df, symbol, rsx=None, perigees=None, interval=DEFAULT_INTERVAL):
+    if rsx is None:
+        rsx  = calculate_rsx(df['Flow'], length=9)
+    if perigees is None:
+        perigees = chart_perigees(df.index, interval)
+
+    if hasattr(df.index, 'tz') and df.index.tz is not None:
+        df = df.copy()
+        df.index = df.index.tz_localize(None)
+        rsx = rsx.copy()
+        rsx.index = rsx.index.tz_localize(None)
+
+    return get_renderer().chart(df, symbol, rsx, perigees, interval)
+
+
+# ────────────────────────────────────────────────
+# График распределения
+# ────────────────────────────────────────────────
+LEVEL_RANGES = [(70, 100), (55, 70), (45, 55), (30, 45), (0, 30)]
+LEVEL_NAMES  = ['Strong Bulls', 'Bulls', 'Neutral', 'Bears', 'Strong Bears']
+
+
+def make_distribution_chart(flow_data=None, page_label=''):
+    """flow_data — FlowPanel или {актив: серия Flow}; по умолчанию — весь FUTURES."""
+    if flow_data is None:
+        bars      = download_many(FUTURES.values())
+        flow_data = flow_panel({a: bars[FUTURES[a]] for a in FUTURES})
+    if not len(flow_data):
+        return None
+    assets_list = list(flow_data.keys())
+    if isinstance(flow_data, FlowPanel):
+        scores = list(flow_data.last() / 100.0)
+        counts = flow_data.bucket_counts(LEVEL_RANGES)
+    else:
+        scores = [float(flow_data[k].iloc[-1]) / 100.0 if len(flow_data[k]) > 0 else 0.0 for k in assets_list]
+        counts = np.array([
+            [int(((flow_data[asset] > low) & (flow_data[asset] <= high)).sum()) for asset in assets_list]
+            for low, high in LEVEL_RANGES
+        ])
+    return get_renderer().distribution(assets_list, scores, counts, page_label)
+
+
+def _draw_distribution(assets_list, scores, counts, page_label=''):
+    from matplotlib.lines import Line2D
+
+    # ширина растёт с числом активов на странице, до 6 — прежние 19 дюймов
+    fig = new_figure((max(19, 6 + 2.2 * len(assets_list)), 9))
+    gs  = fig.add_gridspec(1, 2, wspace=0.35)
+
+    ax1 = fig.add_subplot(gs[0, 0])
+    bar_colors = [
+        '#006400' if s > 0.7 else
+        '#32CD32' if s > 0.55 else
+        'gray'    if s > 0.45 else
+        '#FF8C00' if s > 0.30 else
+        '#DC143C'
+        for s in scores
+    ]
+    bars = ax1.bar([a.upper() for a in assets_list], scores, color=bar_colors, edgecolor='black', linewidth=1.0)
+    ax1.set_ylim(0, 1)
+    ax1.set_ylabel('Sentiment (0-1)')
+    ax1.set_title('Current Sentiment (CFTC, last trading day)', fontsize=12, fontweight='bold')
+    ax1.grid(axis='y', alpha=0.3)
+    for bar, score in zip(bars, scores):
+        ax1.text(bar.get_x() + bar.get_width() / 2, bar.get_height() + 0.02,
+                 f'{score*100:.1f}%', ha='center', va='bottom', fontweight='bold', fontsize=9)
+
+    ax2 = fig.add_subplot(gs[0, 1])
+    colors       = ['#006400', '#32CD32', 'gray', '#FF8C00', '#DC143C']
+    x     = np.arange(len(assets_list))
+    width = 0.15
+
+    for i, values in enumerate(counts):
+        bottom = np.zeros(len(assets_list))
+        ax2.bar(x + i * width, values, width, bottom=bottom, color=colors[i], edgecolor='black')
+        for j, td_count in enumerate(values):
+            if td_count > 0:
+                ax2.text(x[j] + i * width, bottom[j] + td_count / 2, f'{td_count} d.',
+                         ha='center', va='center', fontsize=8, color='black', fontweight='bold')
+
+    ax2.set_xticks(x + width * 2)
+    ax2.set_xticklabels([a.upper() for a in assets_list], fontsize=11)
+    ax2.set_ylabel('Number of trading days')
+    ax2.set_title('Distribution over 175 trading days', fontsize=12, fontweight='bold')
+    ax2.set_ylim(0, 175)
+    ax2.grid(axis='y', alpha=0.3)
+    legend_elements = [
+        Line2D([0], [0], marker='s', color='w', markerfacecolor=colors[i],
+               markersize=10, label=LEVEL_NAMES[i])
+        for i in range(len(LEVEL_NAMES))
+    ]
+    ax2.legend(handles=legend_elements, fontsize=8, loc='center left', bbox_to_anchor=(1.02, 0.5))
+    fig.suptitle(
+        'Sentiment: ' + ', '.join([a.upper() for a in assets_list]) +
+        ' (CFTC, 175 Trading Days)' + (f' — {page_label}' if page_label else '') + '\nby Megatrend',
+        fontsize=14, fontweight='bold', y=0.995
+    )
+    fig.tight_layout(rect=[0, 0, 1, 0.96])
+    buf = io.BytesIO()
+    with span('savefig'):
+        fig.savefig(buf, format='png', bbox_inches='tight')
+    buf.seek(0)
+    return buf
+
+
+# ────────────────────────────────────────────────
+# Кэш готовых графиков и file_id Telegram
+# ────────────────────────────────────────────────
+class ChartCache:
+    """PNG по ключу содержимого: LRU в памяти, опционально — файлы в directory
+    и общее состояние воркеров state (PNG и file_id живут там CHART_SHARED_TTL).
+
+    Для того же ключа запоминается file_id Telegram, чтобы не загружать одинаковое фото повторно.
+    С диском или state методы вызываются из потоков io_pool (off_loop): словари в памяти —
+    под _lock, чтение и запись файлов и state — вне его.
+    """
+
+    def __init__(self, size, directory=None, state=None):
+        self.size      = size
+        self.directory = directory
+        self.state     = state
+        self._mem      = OrderedDict()
+        self._file_ids = OrderedDict()
+        self._lock     = threading.Lock()
+        self.hits      = 0
+        self.misses    = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return data
+        if self.directory:
+            try:
+                with open(os.path.join(self.directory, key + '.png'), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+        if data is None and self.state is not None:
+            data = self.state.get(f"png:{key}")
+        if data is not None:
+            self._remember(self._mem, key, data)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, data: bytes):
+        self._remember(self._mem, key, data)
+        if self.directory:
+            path = os.path.join(self.directory, key + '.png')
+            tmp  = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self._prune_disk()
+        if self.state is not None:
+            self.state.set(f"png:{key}", data, CHART_SHARED_TTL)
+
+    @property
+    def blocking(self) -> bool:
+        """Есть ли диск или общее состояние: тогда вызовы — через off_loop."""
+        return self.directory is not None or self.state is not None
+
+    def file_id(self, key):
+        with self._lock:
+            file_id = self._file_ids.get(key)
+        if file_id is None and self.state is not None:
+            file_id = self.state.get(f"file_id:{key}")
+            if file_id is not None:
+                file_id = file_id.decode()
+                self._remember(self._file_ids, key, file_id, limit=self.size * 4)
+        return file_id
+
+    def remember_file_id(self, key, file_id):
+        self._remember(self._file_ids, key, file_id, limit=self.size * 4)
+        if self.state is not None:
+            self.state.set(f"file_id:{key}", file_id, CHART_SHARED_TTL)
+
+    def forget_file_id(self, key):
+        with self._lock:
+            self._file_ids.pop(key, None)
+        if self.state is not None:
+            self.state.delete(f"file_id:{key}")
+
+    def file_ids(self, keys) -> list:
+        return [self.file_id(key) for key in keys]
+
+    def remember_file_ids(self, pairs):
+        for key, file_id in pairs:
+            self.remember_file_id(key, file_id)
+
+    def forget_file_ids(self, keys):
+        for key in keys:
+            self.forget_file_id(key)
+
+    def _remember(self, store, key, value, limit=None):
+        with self._lock:
+            store[key] = value
+            store.move_to_end(key)
+            while len(store) > (limit or self.size):
+                store.popitem(last=False)
+
+    def _prune_disk(self):
+        files = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.png')]
+        if len(files) <= self.size * 4:
+            return
+
+        def mtime(path):
+            try:
+                return os.path.getmtime(path)
+            except OSError:             # удалён соседним потоком
+                return 0.0
+        files.sort(key=mtime)
+        for path in files[:len(files) - self.size * 4]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits":      self.hits,
+            "misses":    self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else None,
+            "entries":   len(self._mem),
+            "file_ids":  len(self._file_ids),
+        }
+
+
+chart_cache = ChartCache(CHART_CACHE_SIZE, CHART_CACHE_DIR or None,
+                         shared_state if shared_state.shared else None)
+
+
+def chart_key(kind, *parts) -> str:
+    """Хэш содержимого графика: серии, их индекс и параметры отрисовки."""
+    h = hashlib.sha1(f"{kind}:{CHART_VERSION}".encode())
+    for part in parts:
+        if isinstance(part, pd.Series):
+            h.update(np.asarray(part.index.astype('int64')).tobytes())
+            h.update(np.ascontiguousarray(part.values, dtype=float).tobytes())
+        elif isinstance(part, FlowPanel):
+            h.update(repr(part.labels).encode())
+            h.update(np.ascontiguousarray(part.dates).view('int64').tobytes())
+            h.update(np.ascontiguousarray(part.flow, dtype=float).tobytes())
+        else:
+            h.update(repr(part).encode())
+    return h.hexdigest()
+
+
+async def render_chart(df, symbol, rsx=None, interval=DEFAULT_INTERVAL):
+    """(ключ, PNG) графика make_chart — из кэша или отрисованный в cpu_pool.
+
+    RSX(9) однозначно задаётся Flow, поэтому в ключ не входит: без rsx он считается
+    в той же задаче cpu_pool, что и отрисовка, а не отдельной задачей до проверки кэша.
+    """
+    perigees = chart_perigees(df.index, interval)
+    key  = chart_key('chart', symbol, interval, df['Flow'], 'rsx', 9, [p.isoformat() for p in perigees])
+    data = await off_loop(chart_cache, chart_cache.get, key)
+    if data is None:
+        buf  = await cpu_pool.run(make_chart, df, symbol, rsx, perigees, interval)
+        data = buf.getvalue()
+        await off_loop(chart_cache, chart_cache.put, key, data)
+    return key, data
+
+
+@timed('upload')
+async def send_chart(send_photo, key, data, **kwargs):
+    """Отправляет фото, повторно используя file_id уже загруженного такого же графика."""
+    file_id = await off_loop(chart_cache, chart_cache.file_id, key)
+    if file_id:
+        try:
+            return await send_photo(photo=file_id, **kwargs)
+        except BadRequest:
+            await off_loop(chart_cache, chart_cache.forget_file_id, key)
+    msg = await send_photo(photo=data, **kwargs)
+    if msg is not None and msg.photo:
+        await off_loop(chart_cache, chart_cache.remember_file_id, key, msg.photo[-1].file_id)
+    return msg
+
+
+def shards(items, size=None):
+    items = list(items)
+    size  = size or UNIVERSE_SHARD_SIZE
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+async def fetch_bars(tickers, interval=DEFAULT_INTERVAL) -> dict:
+    """Бары по шардам: каждый шард — одна групповая загрузка, шарды идут параллельно в io_pool."""
+    parts = await asyncio.gather(*(
+        io_pool.run(download_many, shard, None, interval) for shard in shards(tickers)
+    ))
+    return {sym: df for part in parts for sym, df in part.items()}
+
+
+def dist_pages() -> list:
+    """Команды FUTURES, разбитые на страницы /dist по DIST_PAGE_SIZE."""
+    return shards(FUTURES.keys(), DIST_PAGE_SIZE)
+
+
+async def collect_flow_data(assets=None) -> FlowPanel:
+    """FlowPanel по командам assets (по умолчанию — весь FUTURES): бары шардами, расчёт одним массивом."""
+    assets = list(FUTURES.keys()) if assets is None else assets
+    bars   = await fetch_bars([FUTURES[a] for a in assets])
+    return await cpu_pool.run(flow_panel, {a: bars[FUTURES[a]] for a in assets})
+
+
+async def render_distribution_chart(flow_data=None, page=1):
+    """(ключ, PNG) страницы page графика распределения или None, если данных нет."""
+    pages = dist_pages()
+    if not 1 <= page <= len(pages):
+        return None
+    if flow_data is None:
+        flow_data = await collect_flow_data(pages[page - 1])
+    elif isinstance(flow_data, FlowPanel):
+        flow_data = flow_data.select(pages[page - 1])
+    else:
+        flow_data = {a: flow_data[a] for a in pages[page - 1] if a in flow_data}
+    if not len(flow_data):
+        return None
+    label = f"page {page}/{len(pages)}" if len(pages) > 1 else ''
+    if isinstance(flow_data, FlowPanel):
+        key = chart_key('dist', label, flow_data)
+    else:
+        key = chart_key('dist', label, *[part for a, flow in flow_data.items() for part in (a, flow)])
+    data  = await off_loop(chart_cache, chart_cache.get, key)
+    if data is None:
+        buf  = await cpu_pool.run(make_distribution_chart, flow_data, label)
+        data = buf.getvalue()
+        await off_loop(chart_cache, chart_cache.put, key, data)
+    return key, data
+
+ALBUM_SIZE = 10     # больше фото в одном альбоме Telegram не принимает
+
+
+@timed('upload_album')
+async def send_album(bot, chat_id, items):
+    """Отправляет [(ключ, PNG, подпись)] одним альбомом (одно фото — обычным сообщением).
+
+    Для уже загруженных графиков подставляется file_id; если Telegram его не принял —
+    альбом повторяется с файлами.
+    """
+    if len(items) == 1:
+        key, data, caption = items[0]
+        return [await send_chart(bot.send_photo, key, data, chat_id=chat_id, caption=caption)]
+
+    keys     = [key for key, _, _ in items]
+    file_ids = await off_loop(chart_cache, chart_cache.file_ids, keys)
+
+    def media(reuse):
+        return [InputMediaPhoto(media=(file_id if reuse else None) or data, caption=caption)
+                for file_id, (_, data, caption) in zip(file_ids, items)]
+
+    reuse = any(file_ids)
+    try:
+        msgs = await bot.send_media_group(chat_id=chat_id, media=media(reuse))
+    except BadRequest:
+        if not reuse:
+            raise
+        await off_loop(chart_cache, chart_cache.forget_file_ids, keys)
+        msgs = await bot.send_media_group(chat_id=chat_id, media=media(False))
+    await off_loop(chart_cache, chart_cache.remember_file_ids,
+                   [(key, msg.photo[-1].file_id) for key, msg in zip(keys, msgs) if msg is not None and msg.photo])
+    return msgs
+
+
+async def fan_out(send, chats, concurrency=FANOUT_CONCURRENCY, timeout=FANOUT_TIMEOUT) -> list:
+    """send(chat_id) для каждого чата: не больше concurrency сразу, каждый не дольше timeout.
+    Ошибки чатов логируются и не прерывают рассылку; возвращает чаты, которым не ушло."""
+    slots  = asyncio.Semaphore(concurrency)
+    failed = []
+
+    async def one(chat_id):
+        async with slots:
+            try:
+                await asyncio.wait_for(send(chat_id), timeout)
+            except Exception as e:
+                logger.warning(f"Чат {chat_id}: не отправлено: {e!r}")
+                failed.append(chat_id)
+    await asyncio.gather(*(one(chat_id) for chat_id in chats))
+    return failed
+
+
+async def broadcast_album(bot, chats, items, strict=False) -> list:
+    """send_album во все чаты: сначала первому — файлы загружаются и file_id запоминаются,
+    остальным параллельно уходят уже file_id. Возвращает чаты, которым не ушло.
+
+    strict — для интерактивной команды: чаты по очереди, без FANOUT_TIMEOUT, ошибка
+    отправки не глотается, а поднимается к вызывающему.
+    """
+    if strict:
+        for chat_id in chats:
+            await send_album(bot, chat_id, items)
+        return []
+
+    def send(chat_id):
+        return send_album(bot, chat_id, items)
+    failed = await fan_out(send, chats[:1])
+    return failed + await fan_out(send, chats[1:])
+
+
+async def stream_asset_charts(cmds, prepare):
+    """Конвейер графиков активов: отдаёт (команда, df, ключ, PNG) строго в порядке cmds.
+
+    prepare(шард команд) -> {команда: df с Flow (и RSX) или None} — загрузка и расчёт;
+    шарды идут параллельно. Каждый график рисуется отдельной задачей в cpu_pool, как
+    только готов его шард, не дожидаясь остальных. Для активов без данных или с
+    ошибкой отрисовки df, ключ и PNG — None.
+    """
+    loop   = asyncio.get_running_loop()
+    ready  = {cmd: loop.create_future() for cmd in cmds}
+    slots  = asyncio.Semaphore(max(1, cpu_pool.max_queue // 2))   # не переполнять очередь cpu_pool
+    tasks  = set()
+
+    def done(cmd, result):
+        if not ready[cmd].done():
+            ready[cmd].set_result(result)
+
+    async def render_one(cmd, df):
+        try:
+            async with slots:
+                key, data = await render_chart(df, cmd.upper(), df['RSX'] if 'RSX' in df else None)
+            done(cmd, (df, key, data))
+        except Exception as e:
+            logger.error(f"{cmd.upper()}: ошибка отрисовки: {e}")
+            done(cmd, (None, None, None))
+
+    async def run_shard(shard):
+        try:
+            async with slots:
+                dfs = await prepare(shard)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки {shard}: {e}")
+            dfs = {}
+        for cmd in shard:
+            df = dfs.get(cmd)
+            if df is None:
+                done(cmd, (None, None, None))
+            else:
+                task = asyncio.create_task(render_one(cmd, df))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+    for shard in shards(cmds):
+        task = asyncio.create_task(run_shard(shard))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    try:
+        for cmd in cmds:
+            df, key, data = await ready[cmd]
+            yield cmd, df, key, data
+    finally:
+        for task in list(tasks):
+            task.cancel()
+
+
+async def deliver_charts(bot, chats, cmds, prepare, caption="{} — Volume Stress / Participation Index + RSX(9)",
+                         strict=False):
+    """Графики cmds альбомами по ALBUM_SIZE по мере готовности в чаты chats; возвращает
+    ({команда: Flow} для графика распределения, [команды без графика]).
+    strict — как у broadcast_album: ошибка отправки прерывает доставку."""
+    flow_data, missing, album = {}, [], []
+    async for cmd, df, key, data in stream_asset_charts(cmds, prepare):
+        if df is None:
+            missing.append(cmd)
+            continue
+        flow_data[cmd] = df['Flow']
+        album.append((key, data, caption.format(cmd.upper())))
+        if len(album) == ALBUM_SIZE:
+            await broadcast_album(bot, chats, album, strict)
+            album = []
+    if album:
+        await broadcast_album(bot, chats, album, strict)
+    return flow_data, missing
+
+
+async def deliver_distribution(bot, chats, flow_data, caption, strict=False):
+    """Все страницы графика распределения по уже посчитанным Flow — отрисовка параллельно."""
+    pages = range(1, len(dist_pages()) + 1)
+    dists = await asyncio.gather(*(render_distribution_chart(flow_data, page) for page in pages))
+    items = [(*dist, caption + page_suffix(page)) for page, dist in zip(pages, dists) if dist]
+    for album in shards(items, ALBUM_SIZE):
+        await broadcast_album(bot, chats, album, strict)
+
+
+async def prepare_flows(cmds) -> dict:
+    """Шаг конвейера /all: бары шарда одной загрузкой, Flow — в cpu_pool."""
+    bars  = await io_pool.run(download_many, [FUTURES[c] for c in cmds])
+    flows = await cpu_pool.run(compute_flows, bars)
+    return {c: flows[FUTURES[c]] for c in cmds}
+
+
+# ────────────────────────────────────────────────
+# Планировщик задач: cron-расписание в SQLite
+# ────────────────────────────────────────────────
+class CronSpec:
+    """Пять полей cron (минута час день месяц день_недели) в UTC: *, */n, a-b, a-b/n и списки.
+
+    Как в Vixie cron: если оба поля дня (месяца и недели) не начинаются с '*', подходит
+    любое из них; иначе нужны оба — так '*/2' в дне месяца сужает дни, а не включает
+    OR с днём недели. День недели: 0 или 7 — воскресенье.
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, spec: str):
+        parts = spec.split()
+        if len(parts) != 5:
+            raise ValueError(f"cron {spec!r}: нужно 5 полей")
+        self.spec = spec
+        minutes, hours, days, months, weekdays = (
+            self._parse(part, lo, hi, spec) for part, (lo, hi) in zip(parts, self.FIELDS))
+        self.minutes, self.hours = minutes, hours
+        self.days, self.months   = set(days), set(months)
+        self.weekdays            = {d % 7 for d in weekdays}
+        # флаги DOM_STAR/DOW_STAR Vixie cron: поле начинается с '*', в том числе '*/n'
+        self.any_day     = parts[2].startswith('*')
+        self.any_weekday = parts[4].startswith('*')
+
+    @staticmethod
+    def _parse(field, lo, hi, spec) -> list:
+        values = set()
+        for part in field.split(','):
+            rng, _, step = part.partition('/')
+            try:
+                step = int(step) if step else 1
+                if rng == '*':
+                    a, b = lo, hi
+                elif '-' in rng:
+                    a, b = map(int, rng.split('-'))
+                else:
+                    a = int(rng)
+                    b = hi if step != 1 else a
+            except ValueError:
+                raise ValueError(f"cron {spec!r}: не разобрать {part!r}") from None
+            if not lo <= a <= b <= hi or step < 1:
+                raise ValueError(f"cron {spec!r}: {part!r} вне {lo}–{hi}")
+            values.update(range(a, b + 1, step))
+        return sorted(values)
+
+    def _day_matches(self, day) -> bool:
+        dom = day.day in self.days
+        dow = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return dom and dow
+        return dom or dow
+
+    def next_after(self, t: datetime) -> datetime:
+        """Первый запуск строго после t (aware datetime), в UTC."""
+        t   = (t.astimezone(timezone.utc) + timedelta(minutes=1)).replace(second=0, microsecond=0)
+        day = t.date()
+        for _ in range(366 * 8):            # 8 лет хватает и расписанию на 29 февраля
+            if day.month in self.months and self._day_matches(day):
+                for h in self.hours:
+                    for m in self.minutes:
+                        run = datetime(day.year, day.month, day.day, h, m, tzinfo=timezone.utc)
+                        if run >= t:
+                            return run
+            day += timedelta(days=1)
+        raise ValueError(f"cron {self.spec!r} не срабатывает")
+
+
+class JobStore:
+    """Задачи планировщика в SQLite: расписание, аргументы, следующий запуск и аренда.
+
+    Аренда (lease_owner, lease_until) — блокировка: задачу запускает тот процесс, чей
+    UPDATE её захватил; если он умер, по истечении аренды задачу подхватит другой.
+    """
+
+    def __init__(self, path):
+        self.path   = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, kind TEXT NOT NULL, cron TEXT NOT NULL, args TEXT NOT NULL,"
+                " catch_up INTEGER, next_run REAL NOT NULL,"
+                " last_run REAL, last_status TEXT, last_error TEXT,"
+                " runs INTEGER DEFAULT 0, failures INTEGER DEFAULT 0,"
+                " lease_owner TEXT, lease_until REAL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def upsert(self, job_id, kind, cron, args=None, catch_up=None, now=None):
+        """Создаёт задачу или обновляет её; следующий запуск пересчитывается только при смене cron."""
+        now      = now or time.time()
+        next_run = CronSpec(cron).next_after(datetime.fromtimestamp(now, timezone.utc)).timestamp()
+        conn     = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, cron, args, catch_up, next_run) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(id) DO UPDATE SET kind = excluded.kind, args = excluded.args,"
+                " catch_up = excluded.catch_up,"
+                " next_run = CASE WHEN cron = excluded.cron THEN next_run ELSE excluded.next_run END,"
+                " cron = excluded.cron",
+                (job_id, kind, cron, json.dumps(args or {}), catch_up, next_run),
+            )
+
+    def remove(self, job_id):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def jobs(self) -> list:
+        return [dict(r) for r in self._conn().execute("SELECT * FROM jobs ORDER BY next_run")]
+
+    def due(self, now) -> list:
+        return [dict(r) for r in self._conn().execute(
+            "SELECT * FROM jobs WHERE next_run <= ? AND (lease_until IS NULL OR lease_until < ?)"
+            " ORDER BY next_run", (now, now))]
+
+    def next_run(self):
+        row = self._conn().execute("SELECT MIN(next_run) FROM jobs").fetchone()
+        return row[0]
+
+    def claim(self, job, owner, now, lease) -> bool:
+        """Захват запуска job: удаётся ровно одному процессу (и только для этого next_run)."""
+        conn = self._conn()
+        with conn:
+            cur = conn.execute(
+                "UPDATE jobs SET lease_owner = ?, lease_until = ?"
+                " WHERE id = ? AND next_run = ? AND (lease_until IS NULL OR lease_until < ?)",
+                (owner, now + lease, job['id'], job['next_run'], now),
+            )
+        return cur.rowcount == 1
+
+    def finish(self, job, owner, status, next_run, ran_at, error=None):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET next_run = ?, last_run = ?, last_status = ?, last_error = ?,"
+                " runs = runs + 1, failures = failures + ?, lease_owner = NULL, lease_until = NULL"
+                " WHERE id = ? AND lease_owner = ?",
+                (next_run, ran_at, status, error, int(status == 'error'), job['id'], owner),
+            )
+
+
+class Scheduler:
+    """Запускает наступившие задачи JobStore: kinds — {вид: async fn(**args)}.
+
+    Несколько процессов с одним JobStore не запустят задачу дважды (аренда). Запуск,
+    пропущенный на время простоя, выполняется один раз, если опоздание не больше catch_up
+    (у задачи — свой catch_up или общий), иначе пропускается до следующего по расписанию.
+    В процессе одновременно идёт не больше concurrency задач; задача дольше lease отменяется.
+    С общим state запуск дополнительно захватывается там — для машин с разными файлами базы.
+    """
+
+    def __init__(self, store, kinds, concurrency=SCHEDULER_CONCURRENCY, catch_up=SCHEDULER_CATCHUP,
+                 lease=SCHEDULER_LEASE, poll=SCHEDULER_POLL, owner=None, clock=time.time, state=None):
+        self.store       = store
+        self.state       = state
+        self.kinds       = kinds
+        self.concurrency = concurrency
+        self.catch_up    = catch_up
+        self.lease       = lease
+        self.poll        = poll
+        self.owner       = owner or WORKER_ID
+        self.clock       = clock
+        self.running     = {}           # id задачи → asyncio.Task
+        self.next_due    = None
+        self.counts      = Counter()
+
+    async def tick(self) -> list:
+        """Захватывает и запускает наступившие задачи; возвращает их id."""
+        now     = self.clock()
+        started = []
+        for job in await io_pool.run(self.store.due, now):
+            if len(self.running) >= self.concurrency:
+                break
+            if job['id'] in self.running or not await io_pool.run(self.store.claim, job, self.owner, now, self.lease):
+                continue
+            self.running[job['id']] = asyncio.create_task(self._run(job))
+            started.append(job['id'])
+        self.next_due = await io_pool.run(self.store.next_run)
+        return started
+
+    async def _run(self, job):
+        now    = self.clock()
+        late   = now - job['next_run']
+        limit  = self.catch_up if job['catch_up'] is None else job['catch_up']
+        status, error = 'ok', None
+        try:
+            run_key = f"job:{job['id']}:{job['next_run']}"
+            if self.state is not None and not await io_pool.run(self.state.add, run_key, self.owner, self.lease):
+                status = 'peer'             # этот запуск уже взял процесс на другой машине
+            elif late > limit:
+                status = 'skipped'
+                logger.warning(f"Задача {job['id']}: запуск опоздал на {late:.0f} сек — пропущен")
+            else:
+                fn = self.kinds[job['kind']]
+                logger.info(f"Задача {job['id']} ({job['kind']}): запуск")
+                await asyncio.wait_for(fn(**json.loads(job['args'])), self.lease)
+        except Exception as e:
+            status, error = 'error', repr(e)
+            logger.error(f"Задача {job['id']}: ошибка: {e!r}")
+        finally:
+            self.counts[status] += 1
+            done_at  = self.clock()
+            next_run = CronSpec(job['cron']).next_after(datetime.fromtimestamp(done_at, timezone.utc))
+            try:
+                await io_pool.run(self.store.finish, job, self.owner, status, next_run.timestamp(), now, error)
+            except Exception as e:
+                logger.error(f"Задача {job['id']}: не удалось сохранить результат: {e!r}")
+            self.running.pop(job['id'], None)
+        logger.info(f"Задача {job['id']}: {status}, следующий запуск {next_run.strftime('%Y-%m-%d %H:%M UTC')}")
+
+    async def run(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error(f"Ошибка планировщика: {e!r}")
+            wait = self.poll
+            if self.next_due is not None:
+                wait = min(wait, max(1.0, self.next_due - self.clock()))
+            await asyncio.sleep(wait)
+
+    async def stop(self):
+        for task in list(self.running.values()):
+            task.cancel()
+        await asyncio.gather(*self.running.values(), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "owner":    self.owner,
+            "running":  sorted(self.running),
+            "next_due": (datetime.fromtimestamp(self.next_due, timezone.utc).strftime('%Y-%m-%d %H:%M UTC')
+                         if self.next_due else None),
+            **self.counts,
+        }
+
+
+async def daily_charts_job(chats):
+    """Задача планировщика: графики всех активов и распределение в чаты chats.
+
+    Графики — те же, что у /gc и /dist (prepare_flows: compute_flow по окну INTERVALS).
+    Новое за сутки докачивает bar_store; актив, у которого последний бар старше самого
+    свежего среди остальных, попадает в лог как отстающий.
+    """
+    last_bar = {}
+
+    async def prepare(cmds):
+        flows = await prepare_flows(cmds)
+        last_bar.update({c: df.index[-1] for c, df in flows.items() if df is not None and len(df)})
+        return flows
+
+    flow_data, missing = await deliver_charts(bot_app.bot, chats, list(FUTURES), prepare)
+    logger.info(f"Отправлено графиков: {len(flow_data)} в {len(chats)} чат(ов) ✅")
+    if last_bar:
+        newest = max(last_bar.values())
+        idle   = sorted(c for c, ts in last_bar.items() if ts < newest)
+        if idle:
+            logger.warning(f"Нет бара за {newest:%d.%m.%Y}: {', '.join(idle)}")
+    if missing:
+        logger.error(f"Нет данных после всех попыток: {', '.join(missing)}")
+        text = (f"⚠️ {', '.join(c.upper() for c in missing)}: "
+                f"не удалось получить данные после {FETCH_RETRIES} попыток")
+        await fan_out(lambda chat_id: bot_app.bot.send_message(chat_id=chat_id, text=text), chats)
+    if flow_data:
+        await deliver_distribution(bot_app.bot, chats, flow_data, "Distribution (175 Trading Days)")
+
+
+JOB_KINDS = {
+    'daily_charts': daily_charts_job,
+}
+
+
+def seed_jobs(store):
+    """Ежедневная рассылка из настроек: CHAT_ID и DAILY_CHATS по расписанию DAILY_CRON."""
+    chats = list(dict.fromkeys(([CHAT_ID] if CHAT_ID else []) + DAILY_CHATS))
+    if not chats:
+        logger.warning("CHAT_ID не задан — ежедневная отправка отключена")
+        store.remove('daily')
+        return
+    store.upsert('daily', 'daily_charts', DAILY_CRON, {'chats': chats})
+
+
+job_store = JobStore(SCHEDULER_DB_PATH)
+scheduler = Scheduler(job_store, JOB_KINDS, state=shared_state if shared_state.shared else None)
+
+
+# ────────────────────────────────────────────────
+# Алерты: пересечение порогов Flow и RSX
+# ────────────────────────────────────────────────
+ALERT_LEVELS = (('Flow', 85), ('Flow', 15), ('RSX', 70), ('RSX', 30))   # те же линии, что на make_chart
+
+
+def crossings(prev: dict, cur: dict) -> list:
+    """[(индикатор, уровень, 'up' | 'down')] при переходе prev → cur ({'Flow': .., 'RSX': ..})."""
+    out = []
+    for name, level in ALERT_LEVELS:
+        a, b = prev[name], cur[name]
+        if a < level <= b:
+            out.append((name, level, 'up'))
+        elif a > level >= b:
+            out.append((name, level, 'down'))
+    return out
+
+
+class AlertSubscriptions:
+    """Подписки чатов: {chat_id: множество команд активов}, '*' — все активы."""
+
+    def __init__(self, path=None):
+        self.path   = path or ALERT_SUBS_PATH
+        self.chats  = {}
+        self._mtime = None
+        self.reload()
+
+    def reload(self):
+        """Перечитывает файл, если его изменил другой воркер; без файла подписки не трогает."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            with open(self.path) as f:
+                self.chats = {int(k): set(v) for k, v in json.load(f).items()}
+            self._mtime = mtime
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать {self.path}: {e} — подписки не изменены")
+
+    def change(self, op, chat_id, cmds=None) -> set:
+        """subscribe / unsubscribe с записью в файл. Чтение → изменение → запись идут под
+        блокировкой файла path.lock: иначе параллельные /subscribe на разных воркерах
+        затирали бы изменения друг друга (write_json атомарна только сама по себе)."""
+        import fcntl
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._mtime = None
+            self.reload()
+            # меняем копию и подменяем словарь целиком: chats_for в event loop в это время
+            # перебирает прежний словарь, который больше никто не трогает
+            chats = {chat: set(subs) for chat, subs in self.chats.items()}
+            subs  = getattr(self, op)(chat_id, cmds, chats)
+            write_json(self.path, self.to_dict(chats))
+            self.chats  = chats
+            self._mtime = os.stat(self.path).st_mtime_ns
+        return set(subs)
+
+    def subscribe(self, chat_id, cmds=None, chats=None) -> set:
+        chats = self.chats if chats is None else chats
+        subs  = chats.setdefault(chat_id, set())
+        if not cmds or '*' in subs:
+            subs.clear()
+            subs.add('*')
+        else:
+            subs.update(cmds)
+        return subs
+
+    def unsubscribe(self, chat_id, cmds=None, chats=None) -> set:
+        chats = self.chats if chats is None else chats
+        subs  = chats.get(chat_id, set())
+        if '*' in subs and cmds:
+            subs = set(FUTURES) - set(cmds)
+        elif cmds:
+            subs = subs - set(cmds)
+        else:
+            subs = set()
+        if subs:
+            chats[chat_id] = subs
+        else:
+            chats.pop(chat_id, None)
+        return subs
+
+    def chats_for(self, cmd) -> list:
+        return [chat for chat, subs in self.chats.items() if '*' in subs or cmd in subs]
+
+    def to_dict(self, chats=None) -> dict:
+        chats = self.chats if chats is None else chats
+        return {str(chat): sorted(subs) for chat, subs in chats.items()}
+
+
+class ReplayFeed:
+    """Лента из готовых {тикер: df} для проверки алертов без сети.
+
+    Каждый вызов открывает ещё step баров; последний открытый бар, как и у живой
+    ленты, считается незакрытым.
+    """
+
+    def __init__(self, dfs: dict, start: int = 60, step: int = 1):
+        self.dfs    = dfs
+        self.cursor = start
+        self.step   = step
+
+    @property
+    def exhausted(self) -> bool:
+        return self.cursor > max((len(df) for df in self.dfs.values()), default=0)
+
+    async def __call__(self, tickers) -> dict:
+        out = {t: self.dfs[t].iloc[:self.cursor] if t in self.dfs else None for t in tickers}
+        self.cursor += self.step
+        return out
+
+
+class AlertEngine:
+    """Опрос ленты баров и рассылка текстовых алертов о пересечении порогов.
+
+    На каждый актив — FlowState, который продвигается только по закрытым барам, так
+    что новый бар стоит O(1). Первый проход по активу только прогревает состояние:
+    исторические пересечения не рассылаются. Одинаковый алерт (чат, актив, индикатор,
+    уровень) не повторяется чаще debounce секунд. Расчёт идёт шардами в io_pool,
+    чтобы сотни активов не блокировали event loop.
+    """
+
+    HISTORY_DAYS = 2     # FlowState.history для алертов не нужна — держим минимум
+
+    def __init__(self, feed, send, subs, interval=ALERT_INTERVAL, debounce=ALERT_DEBOUNCE,
+                 clock=time.monotonic, state=None):
+        self.feed     = feed        # async (tickers) -> {ticker: df или None}
+        self.state    = state       # общее состояние: опрашивает только воркер-лидер
+        self.send     = send        # async (chat_id, text)
+        self.subs     = subs
+        self.interval = interval
+        self.debounce = debounce
+        self.clock    = clock
+        self.states   = {}          # команда -> FlowState
+        self.last     = {}          # команда -> {'Flow', 'RSX'} последнего закрытого бара
+        self._sent    = {}          # (чат, команда, индикатор, уровень) -> время отправки
+        self.polls      = 0
+        self.events     = 0
+        self.sent       = 0
+        self.suppressed = 0
+
+    async def poll(self, universe=None) -> list:
+        """Один проход: забирает бары, продвигает состояния, рассылает алерты; возвращает события."""
+        universe = FUTURES if universe is None else universe
+        watched  = [(cmd, ticker) for cmd, ticker in universe.items() if self.subs.chats_for(cmd)]
+        if not watched:
+            return []
+        bars   = await self.feed(list(dict.fromkeys(ticker for _, ticker in watched)))
+        events = []
+        for batch in shards(watched):
+            events += await io_pool.run(self._advance, batch, bars)
+        self.polls  += 1
+        self.events += len(events)
+        await self._dispatch(events)
+        return events
+
+    def _advance(self, batch, bars) -> list:
+        events = []
+        for cmd, ticker in batch:
+            df = bars.get(ticker)
+            if df is None or len(df) < 2:
+                continue
+            state  = self.states.get(cmd)
+            warmup = state is None
+            if warmup:
+                state = self.states[cmd] = FlowState(history_days=self.HISTORY_DAYS)
+            first = 0 if state.last_ts is None else df.index.searchsorted(state.last_ts, side='right')
+            if first >= len(df) - 1:
+                continue
+            prev = self.last.get(cmd)
+            for ts, flow, rsx in state.stream(df.iloc[first:-1]):
+                cur = {'Flow': flow, 'RSX': rsx}
+                if prev is not None and not warmup:
+                    events += [(cmd, ts, name, level, side, cur[name])
+                               for name, level, side in crossings(prev, cur)]
+                prev = cur
+            if prev is not None:
+                self.last[cmd] = prev
+        return events
+
+    async def _dispatch(self, events):
+        now   = self.clock()
+        lines = {}
+        for cmd, ts, name, level, side, value in events:
+            for chat in self.subs.chats_for(cmd):
+                key = (chat, cmd, name, level)
+                if now - self._sent.get(key, float('-inf')) < self.debounce:
+                    self.suppressed += 1
+                    continue
+                self._sent[key] = now
+                arrow = '↑' if side == 'up' else '↓'
+                lines.setdefault(chat, []).append(
+                    f"{cmd.upper()}: {name} {arrow} {level} ({value:.1f}) — {ts.strftime('%d.%m %H:%M')}"
+                )
+        for chat, text in lines.items():
+            try:
+                await self.send(chat, f"🔔 Alerts ({self.interval}):\n" + "\n".join(text))
+                self.sent += len(text)
+            except Exception as e:
+                logger.error(f"Не удалось отправить алерт в {chat}: {e}")
+
+    async def run(self, every=ALERT_POLL_SEC):
+        while True:
+            try:
+                # лидерство продлевается каждым опросом; умер лидер — через 3 периода опрашивает другой
+                if self.state is None or await io_pool.run(hold_lease, self.state, 'lease:alerts', WORKER_ID, every * 3):
+                    await io_pool.run(self.subs.reload)
+                    await self.poll()
+            except Exception as e:
+                logger.error(f"Ошибка опроса алертов: {e}")
+            await asyncio.sleep(every)
+
+    def stats(self) -> dict:
+        return {
+            "interval":   self.interval,
+            "symbols":    len(self.states),
+            "chats":      len(self.subs.chats),
+            "polls":      self.polls,
+            "events":     self.events,
+            "sent":       self.sent,
+            "suppressed": self.suppressed,
+        }
+
+
+async def send_alert(chat_id, text):
+    await bot_app.bot.send_message(chat_id=chat_id, text=text)
+
+
+alert_subs   = AlertSubscriptions()
+alert_engine = AlertEngine(partial(fetch_bars, interval=ALERT_INTERVAL), send_alert, alert_subs,
+                           state=shared_state if shared_state.shared else None)
+
+
+# ────────────────────────────────────────────────
+# Бэктест фаз Flow/RSX
+# ────────────────────────────────────────────────
+BACKTEST_HORIZONS = (1, 5, 20)      # доходность через столько баров
+BACKTEST_WARMUP   = 50              # до 50 значений smart A/D направление Flow не определено
+
+
+def classify_phases(flow, rsx) -> np.ndarray:
+    """Индекс строки PHASES для каждого бара, -1 — ни одна строка не подошла.
+
+    Диапазоны — из таблицы фаз; при пересечении побеждает первая строка. Смотрит только
+    на текущий и прошлые бары: «↓ LH» у Distribution — RSX ниже, чем на прошлом баре,
+    «резкий выход» у Collapse — Flow был >= 40 в одном из 5 предыдущих баров.
+    """
+    f = np.asarray(flow, dtype=float)
+    r = np.asarray(rsx, dtype=float)
+    falling  = np.concatenate([[False], r[1:] < r[:-1]])
+    was_high = (pd.Series(f).shift(1).rolling(5, min_periods=1).max() >= 40).values
+    conds = [
+        (30 <= f) & (f <= 50) & (40 <= r) & (r <= 60),      # Accumulation
+        (f > 60) & (r > 70),                                 # Expansion
+        (f > 70) & (50 <= r) & (r <= 70) & ~falling,         # Trend
+        (f > 70) & falling,                                  # Distribution
+        (45 <= f) & (f <= 55) & (40 <= r) & (r <= 60),      # Balance
+        (f < 40) & (r < 30) & was_high,                      # Collapse
+        (f < 40) & (r < 30),                                 # Bear Exp.
+        (f < 30) & (30 <= r) & (r <= 50),                    # Bear Trend
+    ]
+    return np.select(conds, np.arange(len(PHASES)), default=-1)
+
+
+def stream_flow(df) -> tuple:
+    """(Flow, RSX) по барам df, посчитанные потоково через FlowState — без заглядывания вперёд:
+    скользящая медиана и min/max smart A/D на каждом баре знают только прошлое."""
+    state = FlowState(history_days=1)
+    flow  = np.empty(len(df))
+    rsx   = np.empty(len(df))
+    for i, (_, f, r) in enumerate(state.stream(df)):
+        flow[i], rsx[i] = f, r
+    return flow, rsx
+
+
+def backtest_symbol(df, horizons=BACKTEST_HORIZONS) -> dict:
+    """Фазы баров df и форвардные доходности по ним.
+
+    counts[p] — баров в фазе p; n/sum/hits[j][p] — баров с известной доходностью через
+    horizons[j], её сумма и число положительных.
+    """
+    flow, rsx = stream_flow(df)
+    phase = classify_phases(flow, rsx)
+    phase[:BACKTEST_WARMUP] = -1
+    close = df['Close'].to_numpy(dtype=float)
+    known = phase >= 0
+    out   = {
+        'bars':   len(df),
+        'first':  df.index[0].isoformat() if len(df) else None,
+        'last':   df.index[-1].isoformat() if len(df) else None,
+        'counts': np.bincount(phase[known], minlength=len(PHASES)).tolist(),
+        'n': [], 'sum': [], 'hits': [],
+    }
+    for h in horizons:
+        fwd = np.full(len(close), np.nan)
+        fwd[:-h] = close[h:] / close[:-h] - 1
+        ok  = known & ~np.isnan(fwd)
+        out['n'].append(np.bincount(phase[ok], minlength=len(PHASES)).tolist())
+        out['sum'].append(np.bincount(phase[ok], weights=fwd[ok], minlength=len(PHASES)).tolist())
+        out['hits'].append(np.bincount(phase[ok & (fwd > 0)], minlength=len(PHASES)).tolist())
+    return out
+
+
+def summarize_backtest(results: dict, horizons=BACKTEST_HORIZONS) -> pd.DataFrame:
+    """Сводка по фазам для {символ: backtest_symbol(...)}: доля баров, средняя доходность
+    и доля положительных исходов на каждом горизонте."""
+    results = [r for r in results.values() if r is not None]
+
+    def total(field, j=None):
+        rows = [r[field] if j is None else r[field][j] for r in results]
+        return np.sum(rows, axis=0) if rows else np.zeros(len(PHASES))
+
+    counts = total('counts')
+    table  = pd.DataFrame({'bars': counts.astype(int)}, index=[p[0] for p in PHASES])
+    table['share %'] = (counts / max(counts.sum(), 1) * 100).round(1)
+    for j, h in enumerate(horizons):
+        n = total('n', j)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            table[f'ret{h} %'] = (total('sum', j) / n * 100).round(2)
+            table[f'hit{h} %'] = (total('hits', j) / n * 100).round(1)
+    return table
+
+
+def _backtest_stored(path, symbol, interval, horizons):
+    ring = BarStore(path, 0, HISTORY_BARS).load(symbol, interval)
+    if ring is None or len(ring) <= BACKTEST_WARMUP:
+        return None
+    return backtest_symbol(ring.frame(), horizons)
+
+
+def run_backtest(symbols, interval=DEFAULT_INTERVAL, path=None, workers=None,
+                 horizons=BACKTEST_HORIZONS) -> dict:
+    """{символ: backtest_symbol или None} по барам локальной базы; символы — параллельно
+    в процессах. Сеть не нужна: история заранее загружается fetch_history."""
+    path    = path or HISTORY_DB_PATH
+    symbols = list(dict.fromkeys(symbols))
+    if not symbols:
+        return {}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                             mp_context=multiprocessing.get_context('spawn')) as ex:
+        futures = [ex.submit(_backtest_stored, path, sym, interval, tuple(horizons)) for sym in symbols]
+        return {sym: fut.result() for sym, fut in zip(symbols, futures)}
+
+
+def fetch_history(symbols, days, interval=DEFAULT_INTERVAL, path=None) -> dict:
+    """Загружает историю в локальную базу бэктеста; {символ: число баров}."""
+    store = BarStore(path or HISTORY_DB_PATH, 0, HISTORY_BARS)
+    out   = {}
+    for shard in shards(symbols):
+        for sym, df in store.get_many(shard, days, interval).items():
+            out[sym] = 0 if df is None else len(df)
+    return out
 
 
 # ────────────────────────────────────────────────
-# Лунные перигеи
+# Приём апдейтов: дедуп, лимиты, очередь
 # ────────────────────────────────────────────────
-def get_lunar_perigees(days_back: int = 175) -> list:
-    """Возвращает даты перигеев за последние days_back дней + один следующий."""
-    try:
-        import ephem
-    except ImportError:
-        return []
-    perigees  = []
-    start     = ephem.Date(datetime.now() - pd.Timedelta(days=days_back + 30))
-    end       = ephem.Date(datetime.now() + pd.Timedelta(days=35))
-    moon      = ephem.Moon()
-    cutoff    = pd.Timestamp(datetime.now() - pd.Timedelta(days=days_back))
-    now_ts    = pd.Timestamp(datetime.now())
-    date      = start
-    prev_dist = None
-    prev_date = None
-    while date < end:
-        moon.compute(date)
-        dist = moon.earth_distance
-        if prev_dist is not None and prev_dist < dist:
-            lo, hi = prev_date, date
-            for _ in range(30):
-                m1 = lo + (hi - lo) / 3
-                m2 = lo + (hi - lo) * 2 / 3
-                moon.compute(m1); d1 = moon.earth_distance
-                moon.compute(m2); d2 = moon.earth_distance
-                if d1 < d2:
-                    hi = m2
-                else:
-                    lo = m1
-            perigee = (lo + hi) / 2
-            p = pd.Timestamp(ephem.Date(perigee).datetime())
-            if (not perigees or (p - perigees[-1]).days > 20) and p >= cutoff:
-                perigees.append(p)
-                if p > now_ts:
-                    break
-        prev_dist = dist
-        prev_date = date
-        date += 0.5
-    return perigees
+class SingleFlight:
+    """Одновременные запросы с одинаковым ключом ждут одно вычисление, а не запускают своё."""
 
+    def __init__(self):
+        self._calls = {}
+        self.calls  = 0
+        self.shared = 0
 
-# ────────────────────────────────────────────────
-# Smart Money Flow
-# ────────────────────────────────────────────────
-def smart_money_flow(symbol, days=175):
-    df = yf.download(symbol, period=f"{days}d", interval="1d", progress=False, auto_adjust=True)
-    if df is None or len(df) < 20:
-        return None
-    if isinstance(df.columns, pd.MultiIndex):
-        df.columns = df.columns.droplevel(1)
+    async def do(self, key, fn, *args):
+        fut = self._calls.get(key)
+        if fut is None:
+            self.calls += 1
+            fut = asyncio.ensure_future(fn(*args))
+            self._calls[key] = fut
+            fut.add_done_callback(lambda f: self._calls.pop(key, None) if self._calls.get(key) is f else None)
+        else:
+            self.shared += 1
+        # shield: отмена одного ожидающего не отменяет общее вычисление
+        return await asyncio.shield(fut)
 
-    df['Vol_Pct'] = df['Volume'].rolling(20).apply(
-        lambda x: (x[:-1] < x[-1]).sum() / (len(x) - 1) * 100, raw=True
-    )
+    def stats(self) -> dict:
+        return {"in_flight": len(self._calls), "calls": self.calls, "shared": self.shared}
 
-    raw_trend       = df['Volume'].rolling(5).mean() / (df['Volume'].rolling(20).mean() + 1e-8) - 1
-    df['Vol_Trend'] = (raw_trend.clip(-1, 1) + 1) * 50
 
-    raw_acc         = df['Close'].pct_change().diff().fillna(0)
-    df['Price_Acc'] = (raw_acc.clip(-0.03, 0.03) / 0.03 + 1) * 50
+class ChatLimiter:
+    """Token bucket на чат: rate токенов в секунду, не больше burst в запасе."""
 
-    df['Signal'] = (
-        0.7 * df['Vol_Pct'] +
-        0.2 * df['Vol_Trend'] +
-        0.1 * df['Price_Acc']
-    ).fillna(50)
+    blocking = False
 
-    vol_std   = df['Volume'].rolling(20).std() / (df['Volume'].rolling(20).mean() + 1e-8)
-    span_vals = (3 + (1 - vol_std.clip(0, 1)) * 7).fillna(5).round().astype(int).values
-    sig_vals  = df['Signal'].values
-    result    = np.zeros(len(sig_vals))
-    result[0] = sig_vals[0]
-    for i in range(1, len(sig_vals)):
-        alpha     = 2.0 / (span_vals[i] + 1.0)
-        result[i] = alpha * sig_vals[i] + (1 - alpha) * result[i - 1]
+    def __init__(self, rate=CHAT_RATE, burst=CHAT_BURST, clock=time.monotonic):
+        self.rate    = rate
+        self.burst   = burst
+        self.clock   = clock
+        self._bucket = {}           # chat_id → (токены, время)
+        self._warned = set()        # чаты, которым уже ответили про лимит
 
-    vol_z     = (df['Volume'] - df['Volume'].rolling(20).mean()) / (df['Volume'].rolling(20).std() + 1e-8)
-    mfm       = ((df['Close'] - df['Low']) - (df['High'] - df['Close'])) / (df['High'] - df['Low'] + 1e-8)
-    smart_vol = (mfm * df['Volume'] * vol_z.clip(lower=1)).fillna(0)
-    smart_ad  = smart_vol.cumsum().ewm(span=5).mean().values
-    ad_min, ad_max = smart_ad.min(), smart_ad.max()
-    if ad_max - ad_min > 1e-8:
-        smart_ad_pct = (smart_ad - ad_min) / (ad_max - ad_min) * 100
-    else:
-        smart_ad_pct = np.full(len(smart_ad), 50.0)
-    smart_ad_s  = pd.Series(smart_ad_pct, index=df.index)
-    center      = smart_ad_s.rolling(200, min_periods=50).median()
-    direction   = np.sign(smart_ad_s - center).fillna(0).values
+    def allow(self, chat_id) -> bool:
+        now = self.clock()
+        tokens, last = self._bucket.get(chat_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= 1:
+            self._bucket[chat_id] = (tokens - 1, now)
+            self._warned.discard(chat_id)
+            return True
+        self._bucket[chat_id] = (tokens, now)
+        return False
 
-    flow_signed  = 50 + (result - 50) * direction
-    flow_clipped = np.clip(flow_signed, 0, 100)
+    def warn_once(self, chat_id) -> bool:
+        """True при первом отказе подряд — чтобы предупредить один раз, а не на каждую команду."""
+        if chat_id in self._warned:
+            return False
+        self._warned.add(chat_id)
+        return True
 
-    flow_s   = pd.Series(flow_clipped)
-    envelope = np.where(
-        flow_s >= 50,
-        flow_s.rolling(5, min_periods=1).max(),
-        flow_s.rolling(5, min_periods=1).min()
-    )
-    smoothed = pd.Series(envelope).ewm(span=3).mean().values
+    def prune(self):
+        """Убирает полностью восстановившиеся вёдра, чтобы словарь не рос бесконечно."""
+        now  = self.clock()
+        full = [c for c, (t, last) in self._bucket.items() if t + (now - last) * self.rate >= self.burst]
+        for chat_id in full:
+            del self._bucket[chat_id]
+            self._warned.discard(chat_id)
 
-    df['Flow'] = smoothed
-    return df
 
+class SharedChatLimiter:
+    """Лимит чата в общем состоянии воркеров: не больше burst команд за окно burst / rate сек.
 
-# ────────────────────────────────────────────────
-# RSX Джурика
-# ────────────────────────────────────────────────
-def calculate_rsx(series: pd.Series, length: int = 9) -> pd.Series:
-    src = series.values.astype(float)
-    n   = len(src)
-    rsx = np.zeros(n)
-    f8  = np.zeros(n); f10 = np.zeros(n); v8 = np.zeros(n)
-    f18 = 3.0 / (length + 2.0); f20 = 1.0 - f18
-    f28 = np.zeros(n); f30 = np.zeros(n)
-    f38 = np.zeros(n); f40 = np.zeros(n)
-    f48 = np.zeros(n); f50 = np.zeros(n)
-    f58 = np.zeros(n); f60 = np.zeros(n)
-    f68 = np.zeros(n); f70 = np.zeros(n)
-    f78 = np.zeros(n); f80 = np.zeros(n)
-    f88 = np.zeros(n); f90 = np.zeros(n)
+    Окно фиксированное (счётчик incr с TTL), а не token bucket: так он атомарен и в SQLite,
+    и в Redis. Средняя скорость та же, что у ChatLimiter.
+    """
 
-    for i in range(n):
-        f8[i]  = 100.0 * src[i]
-        f10[i] = f8[i - 1] if i > 0 else 0.0
-        v8[i]  = f8[i] - f10[i]
-        f28[i] = f20 * (f28[i-1] if i > 0 else 0.0) + f18 * v8[i]
-        f30[i] = f18 * f28[i] + f20 * (f30[i-1] if i > 0 else 0.0)
-        vC     = f28[i] * 1.5 - f30[i] * 0.5
-        f38[i] = f20 * (f38[i-1] if i > 0 else 0.0) + f18 * vC
-        f40[i] = f18 * f38[i] + f20 * (f40[i-1] if i > 0 else 0.0)
-        v10    = f38[i] * 1.5 - f40[i] * 0.5
-        f48[i] = f20 * (f48[i-1] if i > 0 else 0.0) + f18 * v10
-        f50[i] = f18 * f48[i] + f20 * (f50[i-1] if i > 0 else 0.0)
-        v14    = f48[i] * 1.5 - f50[i] * 0.5
-        f58[i] = f20 * (f58[i-1] if i > 0 else 0.0) + f18 * abs(v8[i])
-        f60[i] = f18 * f58[i] + f20 * (f60[i-1] if i > 0 else 0.0)
-        v18    = f58[i] * 1.5 - f60[i] * 0.5
-        f68[i] = f20 * (f68[i-1] if i > 0 else 0.0) + f18 * v18
-        f70[i] = f18 * f68[i] + f20 * (f70[i-1] if i > 0 else 0.0)
-        v1C    = f68[i] * 1.5 - f70[i] * 0.5
-        f78[i] = f20 * (f78[i-1] if i > 0 else 0.0) + f18 * v1C
-        f80[i] = f18 * f78[i] + f20 * (f80[i-1] if i > 0 else 0.0)
-        v20    = f78[i] * 1.5 - f80[i] * 0.5
-        f88[i] = length - 1 if (i > 0 and f90[i-1] == 0 and length - 1 >= 5) else 5
-        f90[i] = (
-            1 if i == 0 or f90[i-1] == 0
-            else f88[i] + 1 if f88[i] <= f90[i-1]
-            else f90[i-1] + 1
-        )
-        f0     = 1 if (f88[i] >= f90[i] and f8[i] != f10[i]) else 0
-        if f88[i] == f90[i] and f0 == 0:
-            f90[i] = 0
-        v4     = (v14 / v20 + 1.0) * 50.0 if (f88[i] < f90[i] and abs(v20) > 1e-8) else 50.0
-        rsx[i] = max(0.0, min(100.0, v4))
+    blocking = True
 
-    return pd.Series(rsx, index=series.index)
+    def __init__(self, state, rate=CHAT_RATE, burst=CHAT_BURST, clock=time.time):
+        self.state  = state
+        self.burst  = burst
+        self.window = burst / rate
+        self.clock  = clock
 
+    def _slot(self, chat_id) -> str:
+        return f"{chat_id}:{int(self.clock() // self.window)}"
 
-# ────────────────────────────────────────────────
-# График: Flow + RSX + таблица фаз
-# ────────────────────────────────────────────────
-def make_chart(df, symbol):
-    import matplotlib.gridspec as gridspec
+    def allow(self, chat_id) -> bool:
+        return self.state.incr(f"rate:{self._slot(chat_id)}", self.window * 2) <= self.burst
 
-    rsx      = calculate_rsx(df['Flow'], length=9)
-    perigees = get_lunar_perigees(175)
-    now_ts   = pd.Timestamp(datetime.now()).tz_localize(None)
+    def warn_once(self, chat_id) -> bool:
+        return self.state.add(f"rate_warned:{self._slot(chat_id)}", 1, self.window * 2)
 
-    if hasattr(df.index, 'tz') and df.index.tz is not None:
-        df = df.copy()
-        df.index = df.index.tz_localize(None)
-        rsx.index = rsx.index.tz_localize(None)
+    def prune(self):
+        pass                        # ключи истекают сами
 
-    fig = plt.figure(figsize=(12, 11))
-    gs  = gridspec.GridSpec(3, 1, height_ratios=[2.5, 1, 0.85], hspace=0.08)
-    ax1 = fig.add_subplot(gs[0])
-    ax2 = fig.add_subplot(gs[1], sharex=ax1)
-    ax3 = fig.add_subplot(gs[2])
-    ax3.axis('off')
-
-    ax1.plot(df.index, df['Flow'], label="Participation Index", linewidth=2, color='navy')
-    ax1.axhline(85, color='red',   linestyle='--', linewidth=1, label='Overbought (85)')
-    ax1.axhline(15, color='green', linestyle='--', linewidth=1, label='Oversold (15)')
-    ax1.axhline(50, color='gray',  linestyle='-',  alpha=0.4)
-    ax1.fill_between(df.index, 85, df['Flow'].clip(lower=85), alpha=0.15, color='red')
-    ax1.fill_between(df.index, df['Flow'].clip(upper=15), 15, alpha=0.15, color='blue')
-    ax1.set_title(f"{symbol} — Volume Stress / Participation Index", fontsize=14, fontweight='bold')
-    ax1.set_ylim(0, 100)
-    ax1.legend(loc='upper left', fontsize=9)
-    ax1.grid(alpha=0.3)
 
-    try:
-        last_flow = float(df['Flow'].iloc[-1])
-        last_date = df.index[-1]
-        ax1.annotate(
-            f"{last_date.strftime('%d.%m.%Y')}\n{last_flow:.1f}%",
-            xy=(last_date, last_flow),
-            xytext=(-60, 15), textcoords='offset points',
-            bbox=dict(boxstyle='round,pad=0.3', facecolor='yellow', alpha=0.8),
-            fontsize=9, fontweight='bold',
-        )
-    except Exception:
-        pass
-
-    ax2.plot(df.index, rsx, label="RSX(9)", linewidth=1.5, color='orange')
-    ax2.axhline(70, color='red',   linestyle='--', linewidth=1)
-    ax2.axhline(30, color='green', linestyle='--', linewidth=1)
-    ax2.axhline(50, color='gray',  linestyle='-',  alpha=0.4)
-    ax2.set_ylim(0, 100)
-    ax2.set_ylabel('RSX(9)', fontsize=9)
-    ax2.legend(loc='upper left', fontsize=9)
-    ax2.grid(alpha=0.3)
+def describe_update(update: Update) -> str:
+    """Короткое описание апдейта для лога: чат и начало текста, без полного JSON."""
+    chat = update.effective_chat
+    msg  = update.effective_message
+    text = (msg.text or '')[:40] if msg else ''
+    return f"chat {chat.id if chat else '-'} {text!r}"
 
-    try:
-        last_rsx_date = rsx.index[-1]
-        last_rsx_val  = float(rsx.iloc[-1])
-        ax2.annotate(
-            f"{last_rsx_date.strftime('%d.%m.%Y')}\nRSX: {last_rsx_val:.1f}",
-            xy=(last_rsx_date, last_rsx_val),
-            xytext=(-60, 15), textcoords='offset points',
-            bbox=dict(boxstyle='round,pad=0.3', facecolor='lightblue', alpha=0.8),
-            fontsize=9, fontweight='bold',
-        )
-    except Exception:
-        pass
-
-    for p in perigees:
-        p_n = p.tz_localize(None) if p.tzinfo is not None else p
-        if p_n <= now_ts:
-            ax1.axvline(p_n, color='red', linestyle='--', linewidth=0.9, alpha=0.6, zorder=5)
-            ax2.axvline(p_n, color='red', linestyle='--', linewidth=0.9, alpha=0.6, zorder=5)
-        else:
-            ax1.axvline(p_n, color='red', linestyle='--', linewidth=1.4, alpha=0.95, zorder=5)
-            ax2.axvline(p_n, color='red', linestyle='--', linewidth=1.4, alpha=0.95, zorder=5)
-            ax1.text(p_n, 93, f"↓ {p.strftime('%d.%m')}", color='red',
-                     fontsize=7.5, ha='center', fontweight='bold', zorder=6,
-                     bbox=dict(boxstyle='round,pad=0.2', fc='white', ec='crimson', alpha=0.9))
-            break
 
-    phases = [
-        ("Accumulation",  "Накопление",      "30–50",   "40–60",  "Участие начинает появляться",           "Формирование базы, подготовка режима",  "#4169E1"),
-        ("Expansion",     "Экспансия",       "> 60–70", "> 70",   "Резкое ускорение участия",              "Включился импульс режима",              "#32CD32"),
-        ("Trend",         "Тренд",           "> 70",    "50–70",  "Участие держится стабильно",            "Режим устойчив, идёт протяжка",         "#006400"),
-        ("Distribution",  "Распределение",   "> 70",    "↓ LH",   "Импульс участия слабеет",               "Смарт-деньги выгружаются",              "#FF8C00"),
-        ("Balance",       "Сжатие/Баланс",   "45–55",   "40–60",  "Нет явного режима",                     "Переходная зона",                       "#888888"),
-        ("Collapse",      "Коллапс",         "< 40",    "< 30",   "Резкий выход участия вниз",             "Смена режима / ликвидация",             "#DC143C"),
-        ("Bear Exp.",     "Медвежья эксп.",  "< 40",    "< 30",   "Ускорение вниз",                        "Активный продавец",                     "#8B0000"),
-        ("Bear Trend",    "Медвежий тренд",  "< 30",    "30–50",  "Давление удерживается",                 "Стабильный медвежий режим",             "#660000"),
-    ]
+async def notify_limited(chat_id):
+    await bot_app.bot.send_message(chat_id, "Too many requests, please wait a bit.")
 
-    col_labels = ["Фаза", "Рус. название", "Flow", "RSX(Flow)", "Что происходит", "Что это значит"]
-    col_widths  = [0.11,   0.13,            0.07,   0.07,        0.32,             0.30]
-    row_h    = 0.105
-    header_y = 0.95
 
-    x = 0.0
-    for label, w in zip(col_labels, col_widths):
-        ax3.add_patch(plt.Rectangle((x, header_y - 0.04), w, 0.09,
-                                    transform=ax3.transAxes,
-                                    fc='#1a1a2e', ec='none', clip_on=False))
-        ax3.text(x + w/2, header_y, label,
-                 ha='center', va='center', fontsize=7.5, fontweight='bold',
-                 color='white', transform=ax3.transAxes)
-        x += w
+class UpdateDispatcher:
+    """Вебхук кладёт апдейт в очередь и сразу отвечает; workers задач обрабатывают её в фоне.
 
-    for row_i, (eng, rus, flow_r, rsx_r, what, meaning, color) in enumerate(phases):
-        y  = header_y - 0.04 - (row_i + 1) * row_h
-        bg = '#f4f4f4' if row_i % 2 == 0 else '#ffffff'
-        row_data = [eng, rus, flow_r, rsx_r, what, meaning]
-        x = 0.0
-        for col_i, (val, w) in enumerate(zip(row_data, col_widths)):
-            ax3.add_patch(plt.Rectangle((x, y - row_h*0.45), w, row_h*0.9,
-                                        transform=ax3.transAxes,
-                                        fc=bg, ec='#dddddd', linewidth=0.4,
-                                        clip_on=False))
-            if col_i == 0:
-                ax3.add_patch(plt.Rectangle((x, y - row_h*0.45), 0.005, row_h*0.9,
-                                            transform=ax3.transAxes,
-                                            fc=color, ec='none', clip_on=False))
-            ax3.text(x + w/2, y, val,
-                     ha='center', va='center', fontsize=6.8,
-                     transform=ax3.transAxes, color='#111111')
-            x += w
+    Повторы update_id (Telegram ретраит при медленном ответе) отбрасываются, команды сверх
+    лимита чата — тоже (с одним предупреждением). При переполнении очереди апдейт не
+    запоминается как виденный ('dropped'): вебхук отвечает 503, и Telegram пришлёт его снова.
+    Виденные update_id хранятся в state: с общим состоянием повтор, пришедший на другой
+    воркер, тоже отбрасывается, а любой воркер может обработать любой апдейт.
+    """
 
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    plt.close(fig)
-    return buf
+    def __init__(self, process, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE,
+                 limiter=None, notify=notify_limited, state=None):
+        self.process = process
+        self.notify  = notify
+        self.workers = workers
+        self.queue   = asyncio.Queue(queue_size)
+        self.limiter = limiter or ChatLimiter()
+        self.state   = state or MemoryState(max_keys=10_000)
+        self._tasks  = []
+        self.counts  = Counter()
 
+    def _duplicate(self, update_id) -> bool:
+        return not self.state.add(f"update:{update_id}", 1, UPDATE_SEEN_TTL)
 
-# ────────────────────────────────────────────────
-# График распределения
-# ────────────────────────────────────────────────
-def make_distribution_chart():
-    assets = list(FUTURES.keys())
-    flow_data = {}
-    for a in assets:
-        df = smart_money_flow(FUTURES[a])
-        if df is not None:
-            flow_data[a] = df['Flow']
-    if not flow_data:
-        return None
+    async def _forget(self, update_id):
+        """Апдейт не принят — повтор от Telegram не должен считаться дублем."""
+        key = f"update:{update_id}"
+        try:
+            await off_loop(self.state, self.state.delete, key)
+        except PoolBusy:
+            self.state.delete(key)
 
-    fig = plt.figure(figsize=(19, 9))
-    gs  = fig.add_gridspec(1, 2, wspace=0.35)
+    async def submit(self, update: Update) -> str:
+        """'queued' | 'duplicate' | 'limited' | 'dropped'.
 
-    ax1 = fig.add_subplot(gs[0, 0])
-    assets_list = list(flow_data.keys())
-    scores = [float(flow_data[k].iloc[-1]) / 100.0 if len(flow_data[k]) > 0 else 0.0 for k in assets_list]
-    bar_colors = [
-        '#006400' if s > 0.7 else
-        '#32CD32' if s > 0.55 else
-        'gray'    if s > 0.45 else
-        '#FF8C00' if s > 0.30 else
-        '#DC143C'
-        for s in scores
-    ]
-    bars = ax1.bar([a.upper() for a in assets_list], scores, color=bar_colors, edgecolor='black', linewidth=1.0)
-    ax1.set_ylim(0, 1)
-    ax1.set_ylabel('Sentiment (0-1)')
-    ax1.set_title('Current Sentiment (CFTC, last trading day)', fontsize=12, fontweight='bold')
-    ax1.grid(axis='y', alpha=0.3)
-    for bar, score in zip(bars, scores):
-        ax1.text(bar.get_x() + bar.get_width() / 2, bar.get_height() + 0.02,
-                 f'{score*100:.1f}%', ha='center', va='bottom', fontweight='bold', fontsize=9)
+        Запросы к общему состоянию (SQLite, Redis) идут через io_pool — event loop не ждёт их;
+        при занятом io_pool поднимается PoolBusy.
+        """
+        status = await self._submit(update)
+        self.counts[status] += 1
+        return status
 
-    ax2 = fig.add_subplot(gs[0, 1])
-    colors       = ['#006400', '#32CD32', 'gray', '#FF8C00', '#DC143C']
-    level_ranges = [(70, 100), (55, 70), (45, 55), (30, 45), (0, 30)]
-    level_names  = ['Strong Bulls', 'Bulls', 'Neutral', 'Bears', 'Strong Bears']
-    x     = np.arange(len(assets_list))
-    width = 0.15
+    async def _submit(self, update: Update) -> str:
+        if await off_loop(self.state, self._duplicate, update.update_id):
+            return 'duplicate'
+        try:
+            status = await self._admit(update)
+        except PoolBusy:
+            await self._forget(update.update_id)
+            raise
+        if status == 'dropped':
+            await self._forget(update.update_id)
+        return status
 
-    for i, (low, high) in enumerate(level_ranges):
-        bottom = np.zeros(len(assets_list))
-        values = np.array([
-            int(((flow_data[asset] > low) & (flow_data[asset] <= high)).sum())
-            for asset in assets_list
-        ])
-        ax2.bar(x + i * width, values, width, bottom=bottom, color=colors[i], edgecolor='black')
-        for j, td_count in enumerate(values):
-            if td_count > 0:
-                ax2.text(x[j] + i * width, bottom[j] + td_count / 2, f'{td_count} d.',
-                         ha='center', va='center', fontsize=8, color='black', fontweight='bold')
+    async def _admit(self, update: Update) -> str:
+        msg  = update.effective_message
+        chat = update.effective_chat
+        if (msg and chat and (msg.text or '').startswith('/')
+                and not await off_loop(self.limiter, self.limiter.allow, chat.id)):
+            if await off_loop(self.limiter, self.limiter.warn_once, chat.id):
+                self._put(('notice', chat.id))
+            return 'limited'
+        return 'queued' if self._put(('update', update)) else 'dropped'
 
-    ax2.set_xticks(x + width * 2)
-    ax2.set_xticklabels([a.upper() for a in assets_list], fontsize=11)
-    ax2.set_ylabel('Number of trading days')
-    ax2.set_title('Distribution over 175 trading days', fontsize=12, fontweight='bold')
-    ax2.set_ylim(0, 175)
-    ax2.grid(axis='y', alpha=0.3)
-    legend_elements = [
-        plt.Line2D([0], [0], marker='s', color='w', markerfacecolor=colors[i],
-                   markersize=10, label=level_names[i])
-        for i in range(len(level_names))
-    ]
-    ax2.legend(handles=legend_elements, fontsize=8, loc='center left', bbox_to_anchor=(1.02, 0.5))
-    plt.suptitle(
-        'Sentiment: ' + ', '.join([a.upper() for a in assets_list]) +
-        ' (CFTC, 175 Trading Days)\nby Megatrend',
-        fontsize=14, fontweight='bold', y=0.995
-    )
-    plt.tight_layout(rect=[0, 0, 1, 0.96])
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    plt.close(fig)
-    return buf
+    def _put(self, item) -> bool:
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            return False
 
+    async def _worker(self):
+        while True:
+            kind, payload = await self.queue.get()
+            try:
+                if kind == 'notice':
+                    await self.notify(payload)
+                else:
+                    await self.process(payload)
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта: {e}")
+            finally:
+                self.queue.task_done()
+                if self.queue.empty():
+                    self.limiter.prune()
 
-# ────────────────────────────────────────────────
-# Ежедневная отправка в 03:00 UTC
-# ────────────────────────────────────────────────
-async def daily_sender():
-    if not CHAT_ID:
-        logger.warning("CHAT_ID не задан — ежедневная отправка отключена")
-        return
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
 
-    while True:
-        now      = datetime.now(timezone.utc)
-        next_run = now.replace(hour=3, minute=0, second=0, microsecond=0)
-        if now >= next_run:
-            next_run += timedelta(days=1)
-        wait_sec = (next_run - now).total_seconds()
-        logger.info(f"Ежедневная отправка через {wait_sec:.0f} сек ({next_run.strftime('%Y-%m-%d %H:%M UTC')})")
-        await asyncio.sleep(wait_sec)
-
-        logger.info("Запуск ежедневной отправки графиков...")
-        try:
-            for cmd, ticker in FUTURES.items():
-                df = None
-                for attempt in range(3):          # ← 3 попытки
-                    df = smart_money_flow(ticker)
-                    if df is not None:
-                        break
-                    logger.warning(f"{cmd.upper()}: попытка {attempt+1} вернула None, повтор через 10 сек...")
-                    await asyncio.sleep(10)
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
 
-                if df is None:
-                    logger.error(f"{cmd.upper()}: все попытки исчерпаны, пропускаем")
-                    await bot_app.bot.send_message(
-                        chat_id=CHAT_ID,
-                        text=f"⚠️ {cmd.upper()}: не удалось получить данные после 3 попыток"
-                    )
-                    continue
+    def stats(self) -> dict:
+        return {"queue": self.queue.qsize(), "workers": len(self._tasks), **self.counts}
 
-                buf = make_chart(df, cmd.upper())
-                await bot_app.bot.send_photo(
-                    chat_id=CHAT_ID,
-                    photo=buf,
-                    caption=f"{cmd.upper()} — Volume Stress / Participation Index + RSX(9)"
-                )
-                logger.info(f"{cmd.upper()}: отправлен ✅")
-
-            buf_dist = make_distribution_chart()
-            if buf_dist:
-                await bot_app.bot.send_photo(
-                    chat_id=CHAT_ID,
-                    photo=buf_dist,
-                    caption="Distribution (175 Trading Days)"
-                )
-            logger.info("Ежедневная отправка завершена")
-        except Exception as e:
-            logger.error(f"Ошибка ежедневной отправки: {e}")
+
+inflight   = SingleFlight()
+dispatcher = UpdateDispatcher(
+    bot_app.process_update,
+    limiter=SharedChatLimiter(shared_state) if shared_state.shared else ChatLimiter(),
+    state=shared_state,
+)
 
 
 # ────────────────────────────────────────────────
 # Команды
 # ────────────────────────────────────────────────
+def command_name(text: str) -> str:
+    """'/GC@SomeBot 1h' → 'gc'."""
+    return text.split()[0].lstrip('/').split('@')[0].lower() if text else ''
+
+
+def parse_interval(args):
+    """Интервал из аргументов команды ('/gc 1h' → '1h'): без аргумента — DEFAULT_INTERVAL,
+    неизвестный — None."""
+    if not args:
+        return DEFAULT_INTERVAL
+    interval = args[0].lower()
+    return interval if interval in INTERVALS else None
+
+
+def page_suffix(page: int) -> str:
+    pages = len(dist_pages())
+    return f" — page {page}/{pages}" if pages > 1 else ''
+
+
+async def asset_chart(asset: str, interval: str):
+    """(df, rsx, ключ, PNG) для команды актива или None, если данных мало."""
+    def load():
+        # RSX по готовому Flow — доли миллисекунды, отдельная задача cpu_pool дороже самого расчёта
+        df = smart_money_flow(FUTURES[asset], None, interval)
+        return None if df is None else (df, calculate_rsx(df['Flow'], length=9))
+
+    loaded = await io_pool.run(load)
+    if loaded is None:
+        return None
+    df, rsx   = loaded
+    key, data = await render_chart(df, asset.upper(), rsx, interval)
+    return df, rsx, key, data
+
+
 async def handle_asset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        asset = update.message.text.replace('/', '').lower()
+        asset = command_name(update.message.text)
         if asset not in FUTURES:
             await update.message.reply_text("Unknown command.")
             return
-        await update.message.reply_text(f"Fetching {asset.upper()} data...")
-        df = smart_money_flow(FUTURES[asset])
-        if df is None:
+        interval = parse_interval(context.args)
+        if interval is None:
+            await update.message.reply_text(f"Unknown interval. Use one of: {', '.join(INTERVALS)}")
+            return
+        label = asset.upper() if interval == DEFAULT_INTERVAL else f"{asset.upper()} {interval}"
+        await update.message.reply_text(f"Fetching {label} data...")
+        chart = await inflight.do(('asset', asset, interval), asset_chart, asset, interval)
+        if chart is None:
             await update.message.reply_text("Not enough data.")
             return
-        rsx       = calculate_rsx(df['Flow'], length=9)
+        df, rsx, key, data = chart
         last_flow = float(df['Flow'].iloc[-1]) if len(df)  > 0 else None
         last_rsx  = float(rsx.iloc[-1])        if len(rsx) > 0 else None
-        buf = make_chart(df, asset.upper())
-        await update.message.reply_photo(photo=buf)
-        txt  = f"{asset.upper()}:\n"
+        await send_chart(update.message.reply_photo, key, data)
+        date_fmt = '%d.%m.%Y' if interval == DEFAULT_INTERVAL else '%d.%m.%Y %H:%M UTC'
+        txt  = f"{label}:\n"
         txt += f"Participation Index: {last_flow:.1f}%\n" if last_flow is not None else "Participation Index: n/a\n"
         txt += f"RSX(9): {last_rsx:.1f}\n"               if last_rsx  is not None else "RSX(9): n/a\n"
-        txt += f"Date: {df.index[-1].strftime('%d.%m.%Y')}"
+        txt += f"Date: {df.index[-1].strftime(date_fmt)}"
         await update.message.reply_text(txt)
     except Exception as e:
         logger.error(f"Error in handle_asset: {e}")
@@ -496,10 +3686,18 @@ async def handle_asset(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def distribution(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
+        pages = len(dist_pages())
+        page  = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+        if not 1 <= page <= pages:
+            await update.message.reply_text(f"Page must be 1–{pages}.")
+            return
         await update.message.reply_text("Generating distribution chart...")
-        buf = make_distribution_chart()
-        if buf:
-            await update.message.reply_photo(photo=buf, caption="Smart Money Flow Distribution (175 Trading Days)")
+        dist = await inflight.do(('dist', page), render_distribution_chart, None, page)
+        if dist:
+            caption = "Smart Money Flow Distribution (175 Trading Days)" + page_suffix(page)
+            if page < pages:
+                caption += f"\nNext: /dist {page + 1}"
+            await send_chart(update.message.reply_photo, *dist, caption=caption)
         else:
             await update.message.reply_text("Could not generate chart.")
     except Exception as e:
@@ -510,32 +3708,268 @@ async def distribution(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await update.message.reply_text("Generating all charts...")
-        for cmd in FUTURES.keys():
-            df = smart_money_flow(FUTURES[cmd])
-            if df is None:
-                continue
-            buf = make_chart(df, cmd.upper())
-            await update.message.reply_photo(photo=buf, caption=f"{cmd.upper()} — Volume Stress / Participation Index + RSX(9)")
-        bufd = make_distribution_chart()
-        if bufd:
-            await update.message.reply_photo(photo=bufd, caption="Distribution")
+        chat_id = update.effective_chat.id
+        # загрузка, расчёт, отрисовка и отправка идут конвейером; Flow переиспользуется для распределения.
+        # strict: ошибка отправки доходит до except ниже и пользователь получает "Error: ..."
+        flow_data, _ = await deliver_charts(context.bot, [chat_id], list(FUTURES), prepare_flows, strict=True)
+        if flow_data:
+            await deliver_distribution(context.bot, [chat_id], flow_data, "Distribution", strict=True)
     except Exception as e:
         logger.error(f"Error in all_command: {e}")
         await update.message.reply_text(f"Error: {str(e)}")
 
 
+def describe_subs(subs) -> str:
+    if not subs:
+        return "none"
+    return "all assets" if '*' in subs else ", ".join(c.upper() for c in sorted(subs))
+
+
+async def subscribe_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        cmds    = [a.lower() for a in context.args or []]
+        unknown = [c for c in cmds if c not in FUTURES]
+        if unknown:
+            await update.message.reply_text(f"Unknown assets: {', '.join(unknown)}")
+            return
+        subs = await io_pool.run(alert_subs.change, 'subscribe', update.effective_chat.id, cmds)
+        await update.message.reply_text(
+            f"Alerts ({ALERT_INTERVAL} bars: Flow 85/15, RSX 70/30) for {describe_subs(subs)}"
+        )
+    except Exception as e:
+        logger.error(f"Error in subscribe_cmd: {e}")
+        await update.message.reply_text(f"Error: {str(e)}")
+
+
+async def unsubscribe_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        cmds = [a.lower() for a in context.args or []]
+        subs = await io_pool.run(alert_subs.change, 'unsubscribe', update.effective_chat.id, cmds)
+        await update.message.reply_text(f"Alerts now for: {describe_subs(subs)}")
+    except Exception as e:
+        logger.error(f"Error in unsubscribe_cmd: {e}")
+        await update.message.reply_text(f"Error: {str(e)}")
+
+
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         txt  = "Volume Stress / Participation Index by Megatrend — commands:\n"
-        txt += "/gc /cl /pl /6e /6j /dx — charts\n"
-        txt += "/dist — distribution\n"
+        for chunk in shards(FUTURES.keys(), 10):
+            txt += " ".join(f"/{cmd}" for cmd in chunk) + "\n"
+        intraday = ", ".join(i for i in INTERVALS if i != DEFAULT_INTERVAL)
+        txt += f"— charts; intraday: add {intraday}, e.g. /{next(iter(FUTURES), 'gc')} 1h\n"
+        pages = len(dist_pages())
+        txt += f"/dist [1–{pages}] — distribution\n" if pages > 1 else "/dist — distribution\n"
         txt += "/all — all charts + distribution\n"
+        txt += f"/subscribe [assets] — {ALERT_INTERVAL} alerts on Flow 85/15 and RSX 70/30\n"
+        txt += "/unsubscribe [assets] — stop alerts\n"
         await update.message.reply_text(txt)
     except Exception as e:
         logger.error(f"Error in start_cmd: {e}")
         await update.message.reply_text(f"Error: {str(e)}")
 
 
+# ────────────────────────────────────────────────
+# /api: Flow, RSX, фазы и распределение для дашбордов
+# ────────────────────────────────────────────────
+API_FORMATS = {
+    'json':    'application/json',
+    'msgpack': 'application/msgpack',
+    'arrow':   'application/vnd.apache.arrow.stream',
+}
+
+
+def _json_bytes(obj) -> bytes:
+    try:
+        import orjson
+    except ImportError:
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+    return orjson.dumps(obj)
+
+
+def _column_list(values) -> list:
+    """Столбец для JSON/msgpack: float округлены до API_DECIMALS, NaN → None."""
+    values = np.asarray(values)
+    if values.dtype.kind != 'f':
+        return values.tolist()
+    return [None if v != v else v for v in np.round(values, API_DECIMALS).tolist()]
+
+
+class ApiResult:
+    """Таблица ответа /api: meta (скаляры) и столбцы одинаковой длины.
+
+    Закодированные тела — по (формат, tail, gzip) — запоминаются при первом запросе, так что
+    опрос без изменений — это поиск в словаре. digest — хэш данных: одинаковые данные,
+    посчитанные заново, дают тот же ETag.
+    """
+
+    MAX_BODIES = 8              # вариантов (формат, tail, gzip) на одну таблицу
+
+    def __init__(self, meta: dict, columns: dict, expires: float):
+        self.meta    = meta
+        self.columns = columns
+        self.expires = expires
+        h = hashlib.sha1(_json_bytes(meta))
+        for name, values in columns.items():
+            h.update(name.encode())
+            h.update(np.ascontiguousarray(values).tobytes() if np.asarray(values).dtype.kind in 'iuf'
+                     else repr(list(values)).encode())
+        self.digest  = h.hexdigest()[:20]
+        self._bodies = {}
+
+    def etag(self, fmt, tail) -> str:
+        return f'"{self.digest}-{fmt}-{tail}"'
+
+    def _encode(self, fmt, tail) -> bytes:
+        columns = {name: values[-tail:] if tail else values for name, values in self.columns.items()}
+        if fmt == 'json':
+            return _json_bytes({**self.meta, 'columns': {k: _column_list(v) for k, v in columns.items()}})
+        if fmt == 'msgpack':
+            import msgpack
+            return msgpack.packb({**self.meta, 'columns': {k: _column_list(v) for k, v in columns.items()}})
+        import pyarrow as pa
+        table = pa.table({k: np.asarray(v) for k, v in columns.items()},
+                         metadata={'meta': _json_bytes(self.meta)})
+        sink  = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+    def body(self, fmt, tail, accept_gzip) -> tuple:
+        """(тело, сжато ли gzip) — из памяти или закодированное сейчас."""
+        key = (fmt, tail, accept_gzip)
+        out = self._bodies.get(key)
+        if out is None:
+            raw = self._encode(fmt, tail)
+            out = (gzip.compress(raw, API_GZIP_LEVEL, mtime=0), True) \
+                if accept_gzip and len(raw) >= API_GZIP_MIN else (raw, False)
+            if len(self._bodies) < self.MAX_BODIES:
+                self._bodies[key] = out
+        return out
+
+
+class ApiCache:
+    """ApiResult по ключу запроса: LRU на size записей, запись живёт до result.expires.
+
+    Одновременные промахи одного ключа ждут одно вычисление (SingleFlight).
+    """
+
+    def __init__(self, size=API_CACHE_SIZE, clock=time.monotonic):
+        self.size   = size
+        self.clock  = clock
+        self._items = OrderedDict()
+        self._calls = SingleFlight()
+        self.hits   = 0
+        self.misses = 0
+
+    async def get(self, key, compute, *args):
+        result = self._items.get(key)
+        if result is not None and result.expires > self.clock():
+            self._items.move_to_end(key)
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = await self._calls.do(key, compute, *args)
+        if result is not None:
+            self._items[key] = result
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return result
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size":      len(self._items),
+            "hits":      self.hits,
+            "misses":    self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+def api_ttl(interval) -> float:
+    """Сколько сек отдавать расчёт без пересчёта: столько же живут бары в bar_store."""
+    ttl = INTERVALS[interval]['ttl']
+    return BAR_CACHE_TTL if ttl is None else min(ttl, BAR_CACHE_TTL)
+
+
+def flow_columns(df) -> dict:
+    """Столбцы /api/flow по df c Flow: время (сек UTC; у дневных — полночь даты сессии),
+    Flow, RSX(9) и индекс фазы из PHASES."""
+    flow  = df['Flow']
+    rsx   = calculate_rsx(flow, length=9)
+    return {
+        'time':  np.asarray(df.index.as_unit('s').asi8),
+        'flow':  flow.to_numpy(dtype=float),
+        'rsx':   rsx.to_numpy(dtype=float),
+        'phase': classify_phases(flow.values, rsx.values).astype(np.int8),
+    }
+
+
+async def compute_api_flow(asset, interval):
+    df = await io_pool.run(smart_money_flow, FUTURES[asset], None, interval)
+    if df is None:
+        return None
+    columns = await cpu_pool.run(flow_columns, df)
+    meta    = {'asset': asset, 'ticker': FUTURES[asset], 'interval': interval}
+    return ApiResult(meta, columns, api_cache.clock() + api_ttl(interval))
+
+
+async def compute_api_distribution():
+    panel = await collect_flow_data()
+    if not len(panel):
+        return None
+    counts  = panel.bucket_counts(LEVEL_RANGES)
+    columns = {'asset': panel.keys(), 'flow': panel.last().astype(float)}
+    for name, row in zip(LEVEL_NAMES, counts):
+        columns[name.lower().replace(' ', '_')] = row.astype(np.int64)
+    meta = {'days': INTERVALS[DEFAULT_INTERVAL]['days'],
+            'levels': {name: list(rng) for name, rng in zip(LEVEL_NAMES, LEVEL_RANGES)}}
+    return ApiResult(meta, columns, api_cache.clock() + api_ttl(DEFAULT_INTERVAL))
+
+
+def _etag_match(header, etags):
+    """Тег из If-None-Match, совпавший с одним из etags, или None."""
+    if not header:
+        return None
+    if header.strip() == '*':
+        return etags[0]
+    for tag in header.split(','):
+        tag = tag.strip().removeprefix('W/')
+        if tag in etags:
+            return tag
+    return None
+
+
+def api_response(request: Request, result: ApiResult, fmt: str, tail: int = 0) -> Response:
+    """Ответ /api: 304 по If-None-Match, иначе тело в fmt (gzip, если клиент его принимает)."""
+    if fmt not in API_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(API_FORMATS)}")
+    etag    = result.etag(fmt, tail)
+    gz_etag = etag[:-1] + '-gz"'        # у сжатого представления свой ETag
+    accept  = 'gzip' in request.headers.get('accept-encoding', '')
+    headers = {
+        'Cache-Control': f"max-age={max(0, int(result.expires - api_cache.clock()))}",
+        'Vary':          'Accept-Encoding',
+    }
+    match = _etag_match(request.headers.get('if-none-match'), (etag, gz_etag))
+    if match:
+        metrics.inc('smartmoney_api_responses_total', status='304')
+        return Response(status_code=304, headers={**headers, 'ETag': match})
+    try:
+        body, compressed = result.body(fmt, tail, accept)
+    except ImportError:
+        raise HTTPException(status_code=406, detail=f"format {fmt} is not available on this server")
+    headers['ETag'] = gz_etag if compressed else etag
+    if compressed:
+        headers['Content-Encoding'] = 'gzip'
+    metrics.inc('smartmoney_api_responses_total', status='200')
+    return Response(content=body, media_type=API_FORMATS[fmt], headers=headers)
+
+
+api_cache = ApiCache()
+
+
 # ────────────────────────────────────────────────
 # Webhook + lifespan
 # ────────────────────────────────────────────────
@@ -546,9 +3980,12 @@ async def lifespan(app: FastAPI):
     # ✅ исправлено: регистрация хендлеров внутри lifespan — один раз, не на уровне модуля
     for cmd in FUTURES.keys():
         bot_app.add_handler(CommandHandler(cmd, handle_asset))
+    logger.info(f"Зарегистрировано {len(FUTURES)} команд активов")
     bot_app.add_handler(CommandHandler("dist",  distribution))
     bot_app.add_handler(CommandHandler("all",   all_command))
     bot_app.add_handler(CommandHandler("start", start_cmd))
+    bot_app.add_handler(CommandHandler("subscribe",   subscribe_cmd))
+    bot_app.add_handler(CommandHandler("unsubscribe", unsubscribe_cmd))
 
     try:
         await bot_app.bot.set_webhook(f"{URL}/webhook")
@@ -556,10 +3993,22 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"Webhook error: {e}")
     await bot_app.start()
-    task = asyncio.create_task(daily_sender())
+    dispatcher.start()
+    await io_pool.run(seed_jobs, job_store)
+    task   = asyncio.create_task(scheduler.run())
+    alerts = asyncio.create_task(alert_engine.run()) if ALERT_POLL_SEC > 0 else None
+    lag    = asyncio.create_task(watch_loop_lag()) if METRICS_ENABLED else None
     yield
     task.cancel()
+    await scheduler.stop()
+    for t in (alerts, lag):
+        if t:
+            t.cancel()
+    profiler.stop()
+    await dispatcher.stop()
     await bot_app.stop()
+    io_pool.shutdown()
+    cpu_pool.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -568,24 +4017,31 @@ app = FastAPI(lifespan=lifespan)
 @app.post("/webhook")
 async def webhook(request: Request):
     try:
-        json_update = await request.json()
-        logger.info(f"Incoming update: {json_update}")
-        update = Update.de_json(json_update, bot_app.bot)
-        if update:
-            await bot_app.process_update(update)
-        return {"ok": True}
+        update = Update.de_json(await request.json(), bot_app.bot)
     except Exception as e:
         logger.error(f"Webhook error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=400, detail=str(e))
+    if update:
+        try:
+            status = await dispatcher.submit(update)
+        except PoolBusy as e:
+            # не-2xx: Telegram повторит апдейт позже
+            raise HTTPException(status_code=503, detail=str(e))
+        logger.info(f"Update {update.update_id} ({describe_update(update)}): {status}")
+        if status == 'dropped':
+            raise HTTPException(status_code=503, detail="Update queue is full, try again later")
+    # отвечаем сразу: обработка идёт в фоне, и Telegram не ретраит медленные апдейты
+    return {"ok": True}
 
 
 @app.get("/test-gc")
 async def test_gc():
-    df = smart_money_flow(FUTURES['gc'])
+    asset = 'gc' if 'gc' in FUTURES else next(iter(FUTURES))
+    df = await io_pool.run(smart_money_flow, FUTURES[asset])
     if df is None:
         raise HTTPException(status_code=503, detail="Not enough data")
-    buf = make_chart(df, 'GC')
-    return StreamingResponse(buf, media_type="image/png")
+    _, data = await render_chart(df, asset.upper())
+    return Response(content=data, media_type="image/png")
 
 
 @app.api_route("/", methods=["GET", "HEAD"])
@@ -594,7 +4050,109 @@ async def root():
 
 @app.api_route("/health", methods=["GET", "HEAD"])
 async def health():
-    return {"status": "OK"}
+    return {
+        "status": "OK",
+        "pools":  {"io": io_pool.stats(), "cpu": cpu_pool.stats()},
+        "bars":   bar_store.stats(),
+        "charts": chart_cache.stats(),
+        "alerts": alert_engine.stats(),
+        "scheduler": scheduler.stats(),
+        "state":     {"backend": shared_state.name, "worker": WORKER_ID, "workers": WEB_CONCURRENCY},
+        "updates":  dispatcher.stats(),
+        "inflight": inflight.stats(),
+        "api":      api_cache.stats(),
+    }
+
+def metric_gauges() -> list:
+    """Текущие значения из stats() пулов, кэшей, очереди апдейтов и алертов — на момент запроса."""
+    out = []
+    for pool in (io_pool, cpu_pool):
+        st = pool.stats()
+        for field in ('active', 'waiting'):
+            out.append((f'smartmoney_pool_{field}', 'gauge', {'pool': pool.name}, st[field]))
+        for field in ('completed', 'failed', 'rejected'):
+            out.append((f'smartmoney_pool_{field}_total', 'counter', {'pool': pool.name}, st[field]))
+    for cache, st in (('bars', bar_store.stats()), ('charts', chart_cache.stats()), ('api', api_cache.stats())):
+        out.append(('smartmoney_cache_hits_total',   'counter', {'cache': cache}, st['hits']))
+        out.append(('smartmoney_cache_misses_total', 'counter', {'cache': cache}, st['misses']))
+        out.append(('smartmoney_cache_hit_ratio',    'gauge',   {'cache': cache}, st['hit_ratio']))
+    bars = bar_store.stats()
+    out.append(('smartmoney_fetch_downloads_total', 'counter', {}, bars['downloads']))
+    out.append(('smartmoney_fetch_failures_total',  'counter', {}, bars['failures']))
+    out.append(('smartmoney_bar_memory_kb',         'gauge',   {}, bars['memory_kb']))
+    updates = dispatcher.stats()
+    out.append(('smartmoney_update_queue_depth', 'gauge', {}, updates['queue']))
+    for status in ('queued', 'duplicate', 'limited', 'dropped'):
+        out.append(('smartmoney_updates_total', 'counter', {'status': status}, updates.get(status, 0)))
+    out.append(('smartmoney_inflight', 'gauge', {}, inflight.stats()['in_flight']))
+    out.append(('smartmoney_inflight_shared_total', 'counter', {}, inflight.shared))
+    alerts = alert_engine.stats()
+    for field in ('events', 'sent', 'suppressed'):
+        out.append((f'smartmoney_alerts_{field}_total', 'counter', {}, alerts[field]))
+    out.append(('smartmoney_loop_lag_last_seconds', 'gauge', {}, metrics.loop_lag))
+    out.append(('smartmoney_profiler_running', 'gauge', {}, int(profiler.running)))
+    return out
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(content=metrics.render(metric_gauges()), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/debug/profile")
+async def profile_endpoint(request: Request, action: str = "report", interval: float = 0.01):
+    """start [interval] / stop / report — стеки в collapsed-формате. Без PROFILE_TOKEN недоступно.
+
+    Токен — в заголовке X-Profile-Token: строка запроса попадает в access-лог uvicorn.
+    """
+    token = request.headers.get('x-profile-token', '')
+    if not PROFILE_TOKEN or not hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode()):
+        raise HTTPException(status_code=404)
+    if action == "start":
+        profiler.start(max(interval, 0.001))
+        return {"running": True, "interval": profiler.interval}
+    if action == "stop":
+        profiler.stop()
+        return {"running": False, "samples": profiler.samples}
+    if action != "report":
+        raise HTTPException(status_code=400, detail="action must be start, stop or report")
+    return Response(content=profiler.report(), media_type="text/plain")
+
+
+@app.get("/api/assets")
+async def api_assets():
+    return {
+        "assets":    FUTURES,
+        "intervals": list(INTERVALS),
+        "phases":    [row[0] for row in PHASES],
+        "levels":    {name: list(rng) for name, rng in zip(LEVEL_NAMES, LEVEL_RANGES)},
+        "formats":   list(API_FORMATS),
+    }
+
+
+@app.get("/api/flow/{asset}")
+async def api_flow(request: Request, asset: str, interval: str = DEFAULT_INTERVAL,
+                   format: str = "json", tail: int = 0):
+    """Столбцы time, flow, rsx, phase (индекс в /api/assets → phases, -1 — нет фазы); tail — последние N баров."""
+    asset = asset.lower()
+    if asset not in FUTURES:
+        raise HTTPException(status_code=404, detail="Unknown asset")
+    if interval not in INTERVALS:
+        raise HTTPException(status_code=400, detail=f"interval must be one of: {', '.join(INTERVALS)}")
+    result = await api_cache.get(('flow', asset, interval), compute_api_flow, asset, interval)
+    if result is None:
+        raise HTTPException(status_code=503, detail="Not enough data")
+    return api_response(request, result, format, max(0, tail))
+
+
+@app.get("/api/distribution")
+async def api_distribution(request: Request, format: str = "json"):
+    """По активу: последний Flow и число дней окна в каждом уровне (Strong Bulls … Strong Bears)."""
+    result = await api_cache.get(('distribution',), compute_api_distribution)
+    if result is None:
+        raise HTTPException(status_code=503, detail="Not enough data")
+    return api_response(request, result, format)
+
 
 @app.api_route("/ping", methods=["GET", "HEAD"])
 async def ping():